@@ -45,6 +45,16 @@
 #                will be extended by the list of matching files.
 #     "name"     An optional string specifying the group to which a hook belongs
 #                for overriding and organizing.
+#     "inputs"   An optional dict declaring what the hook's outcome depends on:
+#                "files" is a list of files or globs relative to the hook's
+#                working directory (directories are hashed recursively) and
+#                "deps" a list of dependency paths whose checked out revision
+#                matters. A hook with inputs is skipped when neither its inputs
+#                nor its action, cwd and condition changed since it last
+#                succeeded; "runhooks --force" and "sync --force" run it anyway.
+#     "parallel", "depends_on"
+#                Control the ordering of hooks with --hook-jobs; see
+#                _RunHooksInParallel().
 #
 #   Example:
 #     hooks = [
@@ -86,6 +96,9 @@ __version__ = '0.7'
 
 import collections
 import copy
+import functools
+import glob
+import hashlib
 import json
 import logging
 import optparse
@@ -95,6 +108,7 @@ import posixpath
 import pprint
 import re
 import sys
+import threading
 import time
 
 try:
@@ -163,7 +177,8 @@ class Hook(object):
   """Descriptor of command ran before/after sync or on demand."""
 
   def __init__(self, action, pattern=None, name=None, cwd=None, condition=None,
-               variables=None, verbose=False, cwd_base=None):
+               variables=None, verbose=False, cwd_base=None, parallel=False,
+               depends_on=None, inputs=None):
     """Constructor.
 
     Arguments:
@@ -173,6 +188,12 @@ class Hook(object):
       cwd (basestring): working directory to use
       condition (basestring): condition when to run the hook
       variables (dict): variables for evaluating the condition
+      parallel (bool): with --hook-jobs, don't wait for the hooks listed
+          before this one in the same DEPS file
+      depends_on (list of basestring): with --hook-jobs, names of hooks listed
+          before this one in the same DEPS file that must run first
+      inputs (dict): 'files' (globs relative to the cwd) and 'deps' (dependency
+          paths) the hook's outcome depends on; see fingerprint()
     """
     self._action = gclient_utils.freeze(action)
     self._pattern = pattern
@@ -182,6 +203,12 @@ class Hook(object):
     self._variables = variables
     self._verbose = verbose
     self._cwd_base = cwd_base
+    self._parallel = parallel
+    self._depends_on = tuple(depends_on or ())
+    self._inputs = gclient_utils.freeze(inputs) if inputs else None
+    # Set by run() once the hook's command was executed.
+    self._elapsed_time = None
+    self._exit_code = None
 
   @staticmethod
   def from_dict(d, variables=None, verbose=False, conditions=None,
@@ -198,7 +225,10 @@ class Hook(object):
         variables=variables,
         # Always print the header if not printing to a TTY.
         verbose=verbose or not setup_color.IS_TTY,
-        cwd_base=cwd_base)
+        cwd_base=cwd_base,
+        parallel=d.get('parallel', False),
+        depends_on=d.get('depends_on'),
+        inputs=d.get('inputs'))
 
   @property
   def action(self):
@@ -216,6 +246,29 @@ class Hook(object):
   def condition(self):
     return self._condition
 
+  @property
+  def parallel(self):
+    return self._parallel
+
+  @property
+  def depends_on(self):
+    return self._depends_on
+
+  @property
+  def inputs(self):
+    return self._inputs
+
+  @property
+  def elapsed_time(self):
+    """Seconds the command took, or None if it wasn't run."""
+    return self._elapsed_time
+
+  @property
+  def exit_code(self):
+    """Exit code of the command, or None if it wasn't run or couldn't be
+    started."""
+    return self._exit_code
+
   @property
   def effective_cwd(self):
     cwd = self._cwd_base
@@ -230,30 +283,165 @@ class Hook(object):
     pattern = re.compile(self._pattern)
     return bool([f for f in file_list if pattern.search(f)])
 
-  def run(self):
-    """Executes the hook's command (provided the condition is met)."""
-    if (self._condition and
-        not gclient_eval.EvaluateCondition(self._condition, self._variables)):
+  def fingerprint(self, dep_revisions):
+    """Returns a digest of everything the hook's outcome depends on, or None if
+    the hook doesn't declare its inputs.
+
+    |dep_revisions| maps the dependencies listed in the inputs to their checked
+    out revision.
+    """
+    if self._inputs is None:
+      return None
+    cwd = self.effective_cwd
+    files = {}
+    for pattern in self._inputs.get('files', ()):
+      matches = sorted(glob.glob(os.path.join(cwd, pattern)))
+      if not matches:
+        files[pattern] = None
+      for match in matches:
+        for path in _WalkFiles(match):
+          files[os.path.relpath(path, cwd).replace(os.sep, '/')] = (
+              _HashFile(path))
+    content = {
+        'action': list(self._action),
+        'cwd': cwd,
+        'condition': [self._condition, self.should_run()],
+        'files': files,
+        'deps': dep_revisions,
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+  def should_run(self):
+    """Returns true if the hook's condition, if any, is met."""
+    return (not self._condition or
+            gclient_eval.EvaluateCondition(self._condition, self._variables))
+
+  def run(self, out_fh=None):
+    """Executes the hook's command (provided the condition is met).
+
+    If |out_fh| is given, the command's output is written to it instead of
+    stdout so that hooks running in parallel don't interleave their output.
+    """
+    if not self.should_run():
       return
 
     cmd = [arg for arg in self._action]
 
+    if out_fh is None:
+      output_kwargs = {'print_stdout': True}
+    else:
+      output_kwargs = {
+          'print_stdout': False,
+          'filter_fn': lambda line: print(line.rstrip('\n'), file=out_fh),
+      }
     try:
       start_time = time.time()
       gclient_utils.CheckCallAndFilter(
-          cmd, cwd=self.effective_cwd, print_stdout=True, show_header=True,
-          always_show_header=self._verbose)
+          cmd, cwd=self.effective_cwd, show_header=True,
+          always_show_header=self._verbose, **output_kwargs)
+      self._exit_code = 0
     except (gclient_utils.Error, subprocess2.CalledProcessError) as e:
+      self._exit_code = getattr(e, 'returncode', None)
       # Use a discrete exit status code of 2 to indicate that a hook action
       # failed.  Users of this script may wish to treat hook action failures
       # differently from VC failures.
-      print('Error: %s' % str(e), file=sys.stderr)
+      print('Error: %s' % str(e), file=out_fh or sys.stderr)
       sys.exit(2)
     finally:
       elapsed_time = time.time() - start_time
+      self._elapsed_time = elapsed_time
       if elapsed_time > 10:
         print("Hook '%s' took %.2f secs" % (
-            gclient_utils.CommandToStr(cmd), elapsed_time))
+            gclient_utils.CommandToStr(cmd), elapsed_time), file=out_fh)
+
+
+def _WalkFiles(path):
+  """Yields |path| if it is a file, or the files below it if it is a
+  directory. Version control directories are skipped."""
+  if not os.path.isdir(path):
+    yield path
+    return
+  for dirpath, dirnames, filenames in os.walk(path):
+    dirnames[:] = sorted(d for d in dirnames if d not in ('.git', '.cipd'))
+    for filename in sorted(filenames):
+      yield os.path.join(dirpath, filename)
+
+
+def _HashFile(path):
+  """Returns the sha256 of the content of |path|, or None if it can't be
+  read."""
+  digest = hashlib.sha256()
+  try:
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        digest.update(chunk)
+  except (IOError, OSError):
+    return None
+  return digest.hexdigest()
+
+
+class HookFingerprints(object):
+  """Fingerprints of the hooks that last succeeded, persisted across runs so
+  that hooks declaring their inputs can be skipped when nothing changed.
+
+  Methods of this class are thread safe.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._lock = threading.Lock()
+    self._fingerprints = {}
+    self._dirty = False
+    if os.path.exists(path):
+      try:
+        self._fingerprints = json.loads(gclient_utils.FileRead(path))
+      except ValueError:
+        logging.warning('Ignoring corrupted hook fingerprints in %s', path)
+
+  def get(self, key):
+    with self._lock:
+      return self._fingerprints.get(key)
+
+  def set(self, key, fingerprint):
+    with self._lock:
+      if self._fingerprints.get(key) == fingerprint:
+        return
+      if fingerprint is None:
+        del self._fingerprints[key]
+      else:
+        self._fingerprints[key] = fingerprint
+      self._dirty = True
+
+  def save(self):
+    with self._lock:
+      if not self._dirty:
+        return
+      self._dirty = False
+      gclient_utils.FileWrite(
+          self._path, json.dumps(self._fingerprints, indent=2, sort_keys=True))
+
+
+class HookError(gclient_utils.Error):
+  """A hook run by the parallel hook runner failed."""
+
+
+class _HookWorkItem(gclient_utils.WorkItem):
+  """Runs one hook in an ExecutionQueue."""
+
+  def __init__(self, name, run_hook, requirements):
+    super(_HookWorkItem, self).__init__(name)
+    self.run_hook = run_hook
+    self.requirements = requirements
+
+  # Arguments number differs from overridden method
+  # pylint: disable=arguments-differ
+  def run(self, work_queue):
+    try:
+      self.run_hook(self.outbuf)
+    except SystemExit:
+      # Hook.run() exits the process on failure, which a worker thread can't do.
+      raise HookError('Hook %s failed.' % self.name)
 
 
 class DependencySettings(object):
@@ -369,7 +557,20 @@ class DependencySettings(object):
     if self.parent:
       url = self.parent.get_custom_deps(name, url)
     # None is a valid return value to disable a dependency.
-    return self.custom_deps.get(name, url)
+    custom_dep = self.custom_deps.get(name, url)
+    if isinstance(custom_dep, dict):
+      # e.g. {'url': ..., 'sparse_paths': [...]}, where url is optional.
+      return custom_dep.get('url', url)
+    return custom_dep
+
+  def get_custom_sparse_paths(self, name, sparse_paths):
+    """Returns the sparse_paths of a dependency set in custom_deps, if any."""
+    if self.parent:
+      sparse_paths = self.parent.get_custom_sparse_paths(name, sparse_paths)
+    custom_dep = self.custom_deps.get(name)
+    if isinstance(custom_dep, dict) and 'sparse_paths' in custom_dep:
+      return custom_dep['sparse_paths']
+    return sparse_paths
 
 
 class Dependency(gclient_utils.WorkItem, DependencySettings):
@@ -377,12 +578,19 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
 
   def __init__(self, parent, name, url, managed, custom_deps,
                custom_vars, custom_hooks, deps_file, should_process,
-               should_recurse, relative, condition, print_outbuf=False):
+               should_recurse, relative, condition, print_outbuf=False,
+               partial_clone=None, sparse_paths=None):
     gclient_utils.WorkItem.__init__(self, name)
     DependencySettings.__init__(
         self, parent, url, managed, custom_deps, custom_vars,
         custom_hooks, deps_file, should_process, relative, condition)
 
+    # Whether to check out the dependency without the blobs of its history,
+    # overriding --partial-clone. None to follow --partial-clone.
+    self._partial_clone = partial_clone
+    # The directories to check out, or None to check out everything.
+    self._sparse_paths = self.get_custom_sparse_paths(name, sparse_paths)
+
     # This is in both .gclient and DEPS files:
     self._deps_hooks = []
 
@@ -392,9 +600,10 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
     self._dependencies = []
     self._vars = {}
 
-    # A cache of the files affected by the current operation, necessary for
-    # hooks.
-    self._file_list = []
+    # The files affected by the current operation, relative to this
+    # dependency's checkout. Only collected when something consumes them (see
+    # _ShouldCollectFileList), since a fresh clone lists every file in the repo.
+    self._file_list = ()
     # List of host names from which dependencies are allowed.
     # Default is an empty set, meaning unspecified in DEPS file, and hence all
     # hosts will be allowed. Non-empty set means allowlist of hosts.
@@ -413,6 +622,8 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
     self._pre_deps_hooks_ran = False
     # This dependency had its hook run
     self._hooks_ran = False
+    # Outcome of each hook run by RunHooksRecursively(), see _AddHookResult().
+    self._hook_results = []
     # This is the scm used to checkout self.url. It may be used by dependencies
     # to get the datetime of the revision we checked out.
     self._used_scm = None
@@ -508,6 +719,10 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
     s = []
     condition_part = (['    "condition": %r,' % self.condition]
                       if self.condition else [])
+    if self.partial_clone is not None:
+      condition_part.append('    "partial_clone": %r,' % self.partial_clone)
+    if self.sparse_paths is not None:
+      condition_part.append('    "sparse_paths": %r,' % list(self.sparse_paths))
     s.extend([
         '  # %s' % self.hierarchy(include_url=False),
         '  "%s": {' % (self.name,),
@@ -552,6 +767,14 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
   def should_recurse(self):
     return self._should_recurse
 
+  @property
+  def partial_clone(self):
+    return self._partial_clone
+
+  @property
+  def sparse_paths(self):
+    return self._sparse_paths
+
   def verify_validity(self):
     """Verifies that this Dependency is fine to add as a child of another one.
 
@@ -597,6 +820,8 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
     # this line to the solution.
     for dep_name, dep_info in self.custom_deps.items():
       if dep_name not in deps:
+        if isinstance(dep_info, dict):
+          dep_info = dep_info.get('url')
         deps[dep_name] = {'url': dep_info, 'dep_type': 'git'}
 
     # Make child deps conditional on any parent conditions. This ensures that,
@@ -668,7 +893,9 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
                 should_process=should_process,
                 should_recurse=name in self.recursedeps,
                 relative=use_relative_paths,
-                condition=condition))
+                condition=condition,
+                partial_clone=dep_value.get('partial_clone'),
+                sparse_paths=dep_value.get('sparse_paths')))
 
     deps_to_add.sort(key=lambda x: x.name)
     return deps_to_add
@@ -849,8 +1076,10 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
       return []
     bad_deps = []
     for dep in self._dependencies:
-      # Don't enforce this for custom_deps.
-      if dep.name in self._custom_deps:
+      # Don't enforce this for the urls set in custom_deps.
+      custom_dep = self._custom_deps.get(dep.name)
+      if dep.name in self._custom_deps and (
+          not isinstance(custom_dep, dict) or 'url' in custom_dep):
         continue
       if isinstance(dep.url, basestring):
         parsed_url = urlparse.urlparse(dep.url)
@@ -896,7 +1125,7 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
           patch_refs, target_branches):
     """Runs |command| then parse the DEPS file."""
     logging.info('Dependency(%s).run()' % self.name)
-    assert self._file_list == []
+    assert not self._file_list
     if not self.should_process:
       return
     # When running runhooks, there's no need to consult the SCM.
@@ -904,7 +1133,7 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
     # copy state, so skip the SCM status check.
     run_scm = command not in (
         'flatten', 'runhooks', 'recurse', 'validate', None)
-    file_list = [] if not options.nohooks else None
+    file_list = [] if self._ShouldCollectFileList() else None
     revision_override = revision_overrides.pop(
         self.FuzzyMatchUrl(revision_overrides), None)
     if not revision_override and not self.managed:
@@ -913,6 +1142,9 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
       # Create a shallow copy to mutate revision.
       options = copy.copy(options)
       options.revision = revision_override
+      if self.partial_clone is not None:
+        options.partial_clone = self.partial_clone
+      options.sparse_paths = self.sparse_paths
       self._used_revision = options.revision
       self._used_scm = self.CreateSCM(out_cb=work_queue.out_cb)
       self._got_revision = self._used_scm.RunCommand(command, options, args,
@@ -927,25 +1159,12 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
                                        options, file_list)
 
       if file_list:
-        file_list = [os.path.join(self.name, f.strip()) for f in file_list]
-
-      # TODO(phajdan.jr): We should know exactly when the paths are absolute.
-      # Convert all absolute paths to relative.
-      for i in range(len(file_list or [])):
-        # It depends on the command being executed (like runhooks vs sync).
-        if not os.path.isabs(file_list[i]):
-          continue
-        prefix = os.path.commonprefix(
-            [self.root.root_dir.lower(), file_list[i].lower()])
-        file_list[i] = file_list[i][len(prefix):]
-        # Strip any leading path separators.
-        while file_list[i].startswith(('\\', '/')):
-          file_list[i] = file_list[i][1:]
+        file_list = self._RelativizeFileList(file_list)
 
     if self.should_recurse:
       self.ParseDepsFile()
 
-    self._run_is_done(file_list or [])
+    self._run_is_done(file_list or ())
 
     if self.should_recurse:
       if command in ('update', 'revert') and not options.noprehooks:
@@ -955,6 +1174,9 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
         if s.should_process:
           work_queue.enqueue(s)
 
+    if command == 'update':
+      self.StartCipdEnsureIfReady()
+
     if command == 'recurse':
       # Skip file only checkout.
       scm = self.GetScmName()
@@ -1011,6 +1233,33 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
         else:
           print('Skipped missing %s' % cwd, file=sys.stderr)
 
+  def _ShouldCollectFileList(self):
+    """Whether the SCM should report the files touched by this run.
+
+    Listing the files of a fresh clone is expensive for large repositories and
+    hooks don't consult the list with git, so only collect it when it ends up
+    in the --output-json document.
+    """
+    return bool(self._get_option('output_json_changed_files', False))
+
+  def _RelativizeFileList(self, file_list):
+    """Returns |file_list| as a tuple of paths relative to this checkout.
+
+    SCM wrappers report either absolute paths or paths relative to the
+    checkout, depending on the command being executed.
+    """
+    checkout_dir = os.path.join(self.root.root_dir, self.name)
+    prefix = os.path.normcase(os.path.join(checkout_dir, ''))
+    result = []
+    for f in file_list:
+      f = f.strip()
+      if os.path.normcase(f).startswith(prefix):
+        f = f[len(prefix):]
+      elif os.path.isabs(f):
+        f = os.path.relpath(f, checkout_dir)
+      result.append(f)
+    return tuple(result)
+
   def GetScmName(self):
     raise NotImplementedError()
 
@@ -1051,6 +1300,15 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
     RunOnDeps() must have been called before to load the DEPS.
     """
     result = []
+    for _, hooks in self.GetHooksByDependency(options):
+      result.extend(hooks)
+    return result
+
+  def GetHooksByDependency(self, options):
+    """Like GetHooks(), but returns a list of (dependency, hooks) tuples, one
+    for each DEPS file that declares hooks.
+    """
+    result = []
     if not self.should_process or not self.should_recurse:
       # Don't run the hook when it is above recursion_limit.
       return result
@@ -1060,23 +1318,175 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
       # TODO(maruel): If the user is using git, then we don't know
       # what files have changed so we always run all hooks. It'd be nice to fix
       # that.
-      result.extend(self.deps_hooks)
+      result.append((self, self.deps_hooks))
     for s in self.dependencies:
-      result.extend(s.GetHooks(options))
+      result.extend(s.GetHooksByDependency(options))
     return result
 
   def RunHooksRecursively(self, options, progress):
     assert self.hooks_ran == False
     self._hooks_ran = True
-    hooks = self.GetHooks(options)
-    if progress:
-      progress._total = len(hooks)
-    for hook in hooks:
+    fingerprints = HookFingerprints(os.path.join(
+        self.root.root_dir, options.hook_fingerprints_filename))
+    try:
+      hook_jobs = getattr(options, 'hook_jobs', 1)
+      if hook_jobs > 1:
+        self._RunHooksInParallel(options, hook_jobs, progress, fingerprints)
+        return
+      hooks_by_dep = self.GetHooksByDependency(options)
       if progress:
-        progress.update(extra=hook.name or '')
-      hook.run()
-    if progress:
-      progress.end()
+        progress._total = sum(len(hooks) for _, hooks in hooks_by_dep)
+      for dep, hooks in hooks_by_dep:
+        for hook in hooks:
+          if progress:
+            progress.update(extra=hook.name or '')
+          self._RunHookIfStale(dep, hook, options, fingerprints)
+      if progress:
+        progress.end()
+    finally:
+      fingerprints.save()
+      hook_report = getattr(options, 'hook_report', None)
+      if hook_report:
+        self._WriteHookReport(hook_report)
+
+  def _RunHookIfStale(self, dep, hook, options, fingerprints, out_fh=None):
+    """Runs |hook|, declared by |dep|, unless it declares inputs and neither
+    those nor the hook changed since it last succeeded.
+    """
+    key = '%s:%s' % (dep.name, hook.name or
+                     gclient_utils.CommandToStr(hook.action))
+    fingerprint = None
+    if hook.inputs is not None:
+      fingerprint = hook.fingerprint(self._GetHookInputRevisions(dep, hook))
+      if not options.force and fingerprints.get(key) == fingerprint:
+        print('Skipping hook %s: inputs are unchanged.' % key, file=out_fh)
+        self._AddHookResult(dep, hook, 'inputs_unchanged')
+        return
+    # Forget the previous fingerprint so that the hook is run again if it
+    # fails.
+    fingerprints.set(key, None)
+    status = 'failed'
+    try:
+      hook.run(out_fh=out_fh)
+      status = 'succeeded' if hook.elapsed_time is not None else (
+          'condition_not_met')
+    finally:
+      self._AddHookResult(dep, hook, status)
+    fingerprints.set(key, fingerprint)
+
+  @gclient_utils.lockedmethod
+  def _AddHookResult(self, dep, hook, status):
+    """Records the outcome of |hook|, declared by |dep|.
+
+    |status| is one of 'succeeded', 'failed', 'condition_not_met' or
+    'inputs_unchanged'.
+    """
+    elapsed_time = hook.elapsed_time
+    self._hook_results.append({
+        'dependency': dep.name,
+        'name': hook.name,
+        'action': list(hook.action),
+        'cwd': hook.effective_cwd,
+        'status': status,
+        'duration': round(elapsed_time, 3) if elapsed_time is not None else 0,
+        'exit_code': hook.exit_code,
+    })
+
+  def _WriteHookReport(self, path):
+    """Writes the hook results to |path|, as a JSON document or, if |path| ends
+    in .jsonl, as one JSON object per line."""
+    results = self.hook_results
+    if path.endswith('.jsonl'):
+      content = ''.join(json.dumps(r, sort_keys=True) + '\n' for r in results)
+    else:
+      content = json.dumps({'hooks': list(results)}, indent=2, sort_keys=True)
+    gclient_utils.FileWrite(path, content)
+
+  def PrintHookProfile(self):
+    """Prints the hooks that ran, the most expensive first."""
+    results = sorted(
+        self.hook_results, key=lambda r: r['duration'], reverse=True)
+    total = sum(r['duration'] for r in results)
+    print('\nHook profile (%d hooks, %.2f secs total):' % (len(results), total))
+    for r in results:
+      name = '%s:%s' % (r['dependency'], r['name'] or
+                        gclient_utils.CommandToStr(r['action']))
+      print('  %8.2fs  %5.1f%%  %-17s %s' % (
+          r['duration'], 100.0 * r['duration'] / total if total else 0,
+          r['status'], name))
+
+  def _GetHookInputRevisions(self, dep, hook):
+    """Returns the revisions of the dependencies listed in |hook|'s inputs."""
+    names = hook.inputs.get('deps', ())
+    if not names:
+      return {}
+    deps_by_name = {}
+    for d in self.root.subtree(False):
+      deps_by_name[d.name.replace(os.sep, '/').rstrip('/')] = d
+    revisions = {}
+    for name in names:
+      d = deps_by_name.get(name.replace(os.sep, '/').rstrip('/'))
+      if not d:
+        raise gclient_utils.Error(
+            'Hook %s in %s lists unknown dependency "%s" in its inputs.' % (
+                hook.name or gclient_utils.CommandToStr(hook.action),
+                dep.hierarchy(include_url=False), name))
+      revisions[name] = d.got_revision or d.GetCheckedOutRevision()
+    return revisions
+
+  def _RunHooksInParallel(self, options, hook_jobs, progress, fingerprints):
+    """Runs the hooks on |hook_jobs| threads.
+
+    Hooks from different DEPS files run in parallel. Within one DEPS file, a
+    hook waits for all the hooks listed before it, unless it sets 'parallel' or
+    names the hooks it needs in 'depends_on'.
+    """
+    work_queue = gclient_utils.ExecutionQueue(
+        hook_jobs, progress, ignore_requirements=False, verbose=True)
+    for dep, hooks in self.GetHooksByDependency(options):
+      prefix = dep.name or '.'
+      # Names of the work items of the hooks seen so far in this DEPS file, and
+      # of the last one for each hook name.
+      previous = []
+      by_hook_name = {}
+      # Hooks whose condition isn't met are not queued at all. Hooks requiring
+      # one require what it required instead.
+      skipped = {}
+      for i, hook in enumerate(hooks):
+        item_name = '%s:%s' % (prefix, hook.name or '#%d' % i)
+        if item_name in previous:
+          item_name = '%s:%s#%d' % (prefix, hook.name, i)
+        requirements = []
+        for depends_on in hook.depends_on:
+          if depends_on not in by_hook_name:
+            raise gclient_utils.Error(
+                'Hook %s in %s depends on "%s", which is not a hook listed '
+                'before it in the same DEPS file.' % (
+                    item_name, dep.hierarchy(include_url=False), depends_on))
+          requirements.append(by_hook_name[depends_on])
+        if not hook.depends_on and not hook.parallel:
+          requirements = previous[:]
+        previous.append(item_name)
+        if hook.name:
+          by_hook_name[hook.name] = item_name
+        resolved = []
+        for r in requirements:
+          for req in skipped.get(r, [r]):
+            if req not in resolved:
+              resolved.append(req)
+        requirements = resolved
+        if not hook.should_run():
+          skipped[item_name] = requirements
+          self._AddHookResult(dep, hook, 'condition_not_met')
+          continue
+        run_hook = functools.partial(
+            self._RunHookIfStale, dep, hook, options, fingerprints)
+        work_queue.enqueue(_HookWorkItem(item_name, run_hook, requirements))
+    try:
+      work_queue.flush()
+    except HookError:
+      # Same exit code as Hook.run() when running the hooks sequentially.
+      sys.exit(2)
 
   def RunPreDepsHooks(self):
     assert self.processed
@@ -1096,6 +1506,13 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
       return None
     return self.root.GetCipdRoot()
 
+  def StartCipdEnsureIfReady(self):
+    if self.root is self:
+      # Let's not infinitely recurse. If this is root and isn't an
+      # instance of GClient, do nothing.
+      return
+    self.root.StartCipdEnsureIfReady()
+
   def subtree(self, include_all):
     """Breadth first recursion excluding root node."""
     dependencies = self.dependencies
@@ -1151,6 +1568,11 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
   def hooks_ran(self):
     return self._hooks_ran
 
+  @property
+  @gclient_utils.lockedmethod
+  def hook_results(self):
+    return tuple(self._hook_results)
+
   @property
   @gclient_utils.lockedmethod
   def allowed_hosts(self):
@@ -1159,7 +1581,7 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
   @property
   @gclient_utils.lockedmethod
   def file_list(self):
-    return tuple(self._file_list)
+    return tuple(os.path.join(self.name, f) for f in self._file_list)
 
   @property
   def used_scm(self):
@@ -1171,6 +1593,16 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
   def got_revision(self):
     return self._got_revision
 
+  def GetCheckedOutRevision(self):
+    """Returns the revision currently checked out, or None if there is no
+    checkout."""
+    if not self.url:
+      return None
+    try:
+      return self.CreateSCM().revinfo(None, None, None)
+    except (gclient_utils.Error, subprocess2.CalledProcessError, OSError):
+      return None
+
   @property
   def file_list_and_children(self):
     result = list(self.file_list)
@@ -1381,6 +1813,13 @@ solutions = %(solution_list)s
     self._enforced_cpu = detect_host_arch.HostArch(),
     self._root_dir = root_dir
     self._cipd_root = None
+    # State of the `cipd ensure` started while git dependencies are still
+    # syncing, see StartCipdEnsureIfReady().
+    self._cipd_ensure_lock = threading.Lock()
+    self._cipd_ensure_entries = None
+    self._cipd_ensure_thread = None
+    self._cipd_ensure_outbuf = None
+    self._cipd_ensure_error = None
     self.config_content = None
 
   def _CheckConfig(self):
@@ -1766,39 +2205,52 @@ it or fix the checkout.
     work_queue = gclient_utils.ExecutionQueue(
         self._options.jobs, pm, ignore_requirements=ignore_requirements,
         verbose=self._options.verbose)
+    if command == 'update':
+      # The entries of the previous sync, to detect git dependencies moved to
+      # CIPD.
+      self._cipd_ensure_entries = self._ReadEntries()
     for s in self.dependencies:
       if s.should_process:
         work_queue.enqueue(s)
-    work_queue.flush(revision_overrides, command, args, options=self._options,
-                     patch_refs=patch_refs, target_branches=target_branches)
-
-    if revision_overrides:
-      print('Please fix your script, having invalid --revision flags will soon '
-            'be considered an error.', file=sys.stderr)
-
-    if patch_refs:
-      raise gclient_utils.Error(
-          'The following --patch-ref flags were not used. Please fix it:\n%s' %
-          ('\n'.join(
-              patch_repo + '@' + patch_ref
-              for patch_repo, patch_ref in patch_refs.items())))
+    synced = False
+    try:
+      work_queue.flush(revision_overrides, command, args, options=self._options,
+                       patch_refs=patch_refs, target_branches=target_branches)
 
-    # Once all the dependencies have been processed, it's now safe to write
-    # out the gn_args_file and run the hooks.
-    if command == 'update':
-      gn_args_dep = self.dependencies[0]
-      if gn_args_dep._gn_args_from:
-        deps_map = dict([(dep.name, dep) for dep in gn_args_dep.dependencies])
-        gn_args_dep = deps_map.get(gn_args_dep._gn_args_from)
-      if gn_args_dep and gn_args_dep.HasGNArgsFile():
-        gn_args_dep.WriteGNArgsFile()
+      if revision_overrides:
+        print('Please fix your script, having invalid --revision flags will '
+              'soon be considered an error.', file=sys.stderr)
 
-      self._RemoveUnversionedGitDirs()
+      if patch_refs:
+        raise gclient_utils.Error(
+            'The following --patch-ref flags were not used. Please fix it:\n%s'
+            % ('\n'.join(
+                patch_repo + '@' + patch_ref
+                for patch_repo, patch_ref in patch_refs.items())))
+
+      # Once all the dependencies have been processed, it's now safe to write
+      # out the gn_args_file and run the hooks.
+      if command == 'update':
+        gn_args_dep = self.dependencies[0]
+        if gn_args_dep._gn_args_from:
+          deps_map = dict([(dep.name, dep) for dep in gn_args_dep.dependencies])
+          gn_args_dep = deps_map.get(gn_args_dep._gn_args_from)
+        if gn_args_dep and gn_args_dep.HasGNArgsFile():
+          gn_args_dep.WriteGNArgsFile()
+
+        self._RemoveUnversionedGitDirs()
+      synced = True
+    finally:
+      # Don't leave a `cipd ensure` started while git dependencies were
+      # syncing running, nor its failure unreported, if the sync failed.
+      if self._cipd_ensure_thread:
+        self._WaitForCipdEnsure(raise_error=synced)
 
     # Sync CIPD dependencies once removed deps are deleted. In case a git
     # dependency was moved to CIPD, we want to remove the old git directory
-    # first and then sync the CIPD dep.
-    if self._cipd_root:
+    # first and then sync the CIPD dep. Otherwise `cipd ensure` was already
+    # started while git dependencies were syncing.
+    if not self._cipd_ensure_thread and self._cipd_root:
       self._cipd_root.run(command)
 
     if not self._options.nohooks:
@@ -1891,6 +2343,73 @@ it or fix the checkout.
     print('Loaded .gclient config in %s:\n%s' % (
         self.root_dir, self.config_content))
 
+  def StartCipdEnsureIfReady(self):
+    """Starts `cipd ensure` in the background if the set of CIPD packages is
+    final, so that CIPD downloads overlap with the remaining git syncs.
+
+    Called as dependencies finish syncing. The ensure is not started early when
+    a CIPD package would be installed in or around a git checkout which is
+    still syncing or which was removed from DEPS, i.e. when a git dependency is
+    being moved to CIPD; RunOnDeps() then runs it after the old git directory
+    is removed.
+    """
+    with self._cipd_ensure_lock:
+      if (self._cipd_ensure_thread or self._cipd_ensure_entries is None or
+          not self._cipd_root):
+        return
+      cipd_subdirs = set()
+      pending_git_dirs = []
+      for d in self.subtree(False):
+        if isinstance(d, CipdDependency):
+          if not d._cipd_package:
+            return
+          cipd_subdirs.add(d._cipd_subdir)
+        elif d.should_recurse and not d.deps_parsed:
+          # Its DEPS file may add CIPD packages.
+          return
+        elif d.url and not d.processed:
+          pending_git_dirs.append(d.name.replace(os.sep, '/'))
+      git_entries = set(
+          d.name.replace(os.sep, '/') for d in self.subtree(False) if d.url)
+      removed_git_dirs = [
+          entry.replace(os.sep, '/') for entry in self._cipd_ensure_entries
+          if entry.replace(os.sep, '/') not in git_entries and
+          os.path.exists(os.path.join(self.root_dir, entry))
+      ]
+      for subdir in cipd_subdirs:
+        for path in pending_git_dirs + removed_git_dirs:
+          if (subdir == path or subdir.startswith(path + '/') or
+              path.startswith(subdir + '/')):
+            return
+      logging.info('Starting cipd ensure while git dependencies sync.')
+      self._cipd_ensure_outbuf = gclient_utils.StringIO()
+      self._cipd_ensure_thread = threading.Thread(
+          name='cipd ensure', target=self._RunCipdEnsure)
+      self._cipd_ensure_thread.daemon = True
+      self._cipd_ensure_thread.start()
+
+  def _RunCipdEnsure(self):
+    try:
+      self._cipd_root.ensure(out_fh=self._cipd_ensure_outbuf)
+    except Exception:
+      self._cipd_ensure_error = sys.exc_info()
+
+  def _WaitForCipdEnsure(self, raise_error=True):
+    """Waits for the `cipd ensure` started by StartCipdEnsureIfReady().
+
+    If it failed, raises its error, or only prints it if |raise_error| is false.
+    """
+    self._cipd_ensure_thread.join()
+    output = self._cipd_ensure_outbuf.getvalue().strip()
+    if output:
+      print(output)
+    if not self._cipd_ensure_error:
+      return
+    if raise_error:
+      gclient_utils.reraise(*self._cipd_ensure_error)
+    print('cipd ensure failed: %s' % self._cipd_ensure_error[1],
+          file=sys.stderr)
+
   def GetCipdRoot(self):
     if not self._cipd_root:
       self._cipd_root = gclient_scm.CipdRoot(
@@ -2347,6 +2866,11 @@ def _DepsOsToLines(deps_os):
   return s
 
 
+def _InputsToDict(inputs):
+  """Converts frozen hook |inputs| back to the form used in DEPS files."""
+  return dict((key, list(value)) for key, value in sorted(inputs.items()))
+
+
 def _HooksToLines(name, hooks):
   """Converts |hooks| list to list of lines for output."""
   if not hooks:
@@ -2363,6 +2887,12 @@ def _HooksToLines(name, hooks):
       s.append('    "pattern": "%s",' % hook.pattern)
     if hook.condition is not None:
       s.append('    "condition": %r,' % hook.condition)
+    if hook.parallel:
+      s.append('    "parallel": True,')
+    if hook.depends_on:
+      s.append('    "depends_on": %r,' % list(hook.depends_on))
+    if hook.inputs is not None:
+      s.append('    "inputs": %r,' % _InputsToDict(hook.inputs))
     # Flattened hooks need to be written relative to the root gclient dir
     cwd = os.path.relpath(os.path.normpath(hook.effective_cwd))
     s.extend(
@@ -2393,6 +2923,12 @@ def _HooksOsToLines(hooks_os):
         s.append('      "pattern": "%s",' % hook.pattern)
       if hook.condition is not None:
         s.append('    "condition": %r,' % hook.condition)
+      if hook.parallel:
+        s.append('      "parallel": True,')
+      if hook.depends_on:
+        s.append('      "depends_on": %r,' % list(hook.depends_on))
+      if hook.inputs is not None:
+        s.append('      "inputs": %r,' % _InputsToDict(hook.inputs))
       # Flattened hooks need to be written relative to the root gclient dir
       cwd = os.path.relpath(os.path.normpath(hook.effective_cwd))
       s.extend(
@@ -2612,9 +3148,23 @@ os_deps, etc.)
     "<name>": {  # <name> is the posix-normalized path to the solution.
       "revision": [<git id hex string>|null],
       "scm": ["git"|null],
+      "changed_files": [<path>, ...],  # Only with --output-json-changed-files.
     }
-  }
+  },
+  "hooks": [
+    {
+      "dependency": <name of the dependency declaring the hook>,
+      "name": [<hook name>|null],
+      "action": [<arg>, ...],
+      "cwd": <working directory of the hook>,
+      "status": ["succeeded"|"failed"|"condition_not_met"|"inputs_unchanged"],
+      "duration": <seconds>,
+      "exit_code": [<int>|null],
+    }
+  ]
 }
+
+The same hook entries are written by --hook-report.
 """)
 @metrics.collector.collect_metrics('gclient sync')
 def CMDsync(parser, args):
@@ -2625,6 +3175,15 @@ def CMDsync(parser, args):
                     help='don\'t run hooks after the update is complete')
   parser.add_option('-p', '--noprehooks', action='store_true',
                     help='don\'t run pre-DEPS hooks', default=False)
+  parser.add_option('--hook-jobs', type='int', default=1,
+                    help='Number of hooks to run in parallel. Hooks from '
+                         'different DEPS files run concurrently; within a '
+                         'DEPS file the order is kept unless a hook sets '
+                         '"parallel" or "depends_on". Default: %default')
+  parser.add_option('--hook-report', metavar='PATH',
+                    help='Write the duration, exit code and cwd of every hook '
+                         'to PATH, as JSON or, if PATH ends in .jsonl, as '
+                         'one JSON object per line.')
   parser.add_option('-r', '--revision', action='append',
                     dest='revisions', metavar='REV', default=[],
                     help='Enforces git ref/hash for the solutions with the '
@@ -2687,12 +3246,32 @@ def CMDsync(parser, args):
   parser.add_option('--output-json',
                     help='Output a json document to this path containing '
                          'summary information about the sync.')
+  parser.add_option('--output-json-changed-files', action='store_true',
+                    help='Include the list of files touched by the sync for '
+                         'each dependency in the --output-json document. '
+                         'Listing files is expensive for large repositories, '
+                         'so it is only done when this flag is given.')
   parser.add_option('--no-history', action='store_true',
                     help='GIT ONLY - Reduces the size/time of the checkout at '
                     'the cost of no history. Requires Git 1.9+')
   parser.add_option('--shallow', action='store_true',
                     help='GIT ONLY - Do a shallow clone into the cache dir. '
                          'Requires Git 1.9+')
+  parser.add_option('--use-worktrees', action='store_true',
+                    help='GIT ONLY - With a cache dir, check out new '
+                         'dependencies as worktrees of their cache mirror, '
+                         'sharing its objects and refs. Their HEAD is always '
+                         'detached. Requires Git 2.20+')
+  parser.add_option('--exact-sha', action='store_true',
+                    help='GIT ONLY - For dependencies pinned to a full SHA-1, '
+                         'only fetch the pinned commit, with --depth=1 and no '
+                         'branch, both when cloning and when the pin changes. '
+                         'Ignored with a cache dir.')
+  parser.add_option('--partial-clone', action='store_true',
+                    help='GIT ONLY - Don\'t fetch the blobs of the history of '
+                         'new checkouts and cache mirrors; they are fetched '
+                         'on demand. DEPS entries can override it with '
+                         '"partial_clone". Requires Git 2.36+')
   parser.add_option('--no_bootstrap', '--no-bootstrap',
                     action='store_true',
                     help='Don\'t bootstrap from Google Storage.')
@@ -2705,6 +3284,12 @@ def CMDsync(parser, args):
   parser.add_option('--lock_timeout', type='int', default=5000,
                     help='GIT ONLY - Deadline (in seconds) to wait for git '
                          'cache lock to become available. Default is %default.')
+  parser.add_option('--cache-ttl', type='int', default=0, metavar='SECONDS',
+                    help='GIT ONLY - Don\'t update git cache mirrors fetched '
+                         'less than SECONDS ago when syncing to a branch; '
+                         'the branch is resolved against the mirror as is. '
+                         'Pinned revisions missing from the mirror are '
+                         'always fetched. Default is %default (disabled).')
   parser.add_option('--no-rebase-patch-ref', action='store_false',
                     dest='rebase_patch_ref', default=True,
                     help='Bypass rebase of the patch ref after checkout.')
@@ -2712,6 +3297,11 @@ def CMDsync(parser, args):
                     dest='reset_patch_ref', default=True,
                     help='Bypass calling reset after patching the ref.')
   (options, args) = parser.parse_args(args)
+  if options.output_json_changed_files and not options.output_json:
+    parser.error('--output-json-changed-files requires --output-json.')
+  if options.use_worktrees and (options.no_history or options.exact_sha):
+    parser.error('--use-worktrees can\'t be used with --no-history or '
+                 '--exact-sha, as worktrees have the history of the mirror.')
   client = GClient.LoadCurrentConfig(options)
 
   if not client:
@@ -2741,8 +3331,11 @@ def CMDsync(parser, args):
           'url': str(d.url) if d.url else None,
           'was_processed': d.should_process,
       }
+      if options.output_json_changed_files:
+        slns[normed]['changed_files'] = [
+            f.replace('\\', '/') for f in d.file_list]
     with open(options.output_json, 'w') as f:
-      json.dump({'solutions': slns}, f)
+      json.dump({'solutions': slns, 'hooks': list(client.hook_results)}, f)
   return ret
 
 
@@ -2796,6 +3389,9 @@ def CMDrevert(parser, args):
                     help='don\'t run pre-DEPS hooks', default=False)
   parser.add_option('--upstream', action='store_true',
                     help='Make repo state match upstream branch.')
+  parser.add_option('--exact-sha', action='store_true',
+                    help='GIT ONLY - Only fetch the pinned commit of '
+                         'dependencies pinned to a full SHA-1, as with sync.')
   parser.add_option('--break_repo_locks',
                     action='store_true',
                     help='No longer used.')
@@ -2822,17 +3418,32 @@ def CMDrunhooks(parser, args):
                     help='override deps for the specified (comma-separated) '
                          'platform(s); \'all\' will process all deps_os '
                          'references')
-  parser.add_option('-f', '--force', action='store_true', default=True,
-                    help='Deprecated. No effect.')
+  parser.add_option('-f', '--force', action='store_true',
+                    help='Run all hooks, even those whose declared inputs '
+                         'haven\'t changed since they last succeeded.')
+  parser.add_option('--hook-jobs', type='int', default=1,
+                    help='Number of hooks to run in parallel. Hooks from '
+                         'different DEPS files run concurrently; within a '
+                         'DEPS file the order is kept unless a hook sets '
+                         '"parallel" or "depends_on". Default: %default')
+  parser.add_option('--hook-report', metavar='PATH',
+                    help='Write the duration, exit code and cwd of every hook '
+                         'to PATH, as JSON or, if PATH ends in .jsonl, as '
+                         'one JSON object per line.')
+  parser.add_option('--profile', action='store_true',
+                    help='Print how long each hook took, the slowest first.')
   (options, args) = parser.parse_args(args)
   client = GClient.LoadCurrentConfig(options)
   if not client:
     raise gclient_utils.Error('client not configured; see \'gclient config\'')
   if options.verbose:
     client.PrintLocationAndContents()
-  options.force = True
   options.nohooks = False
-  return client.RunOnDeps('runhooks', args)
+  try:
+    return client.RunOnDeps('runhooks', args)
+  finally:
+    if options.profile:
+      client.PrintHookProfile()
 
 
 @metrics.collector.collect_metrics('gclient revinfo')
@@ -3107,6 +3718,8 @@ class OptionParser(optparse.OptionParser):
     if not options.config_filename:
       options.config_filename = self.gclientfile_default
     options.entries_filename = options.config_filename + '_entries'
+    options.hook_fingerprints_filename = (
+        options.config_filename + '_hook_fingerprints')
     if options.jobs < 1:
       self.error('--jobs must be 1 or higher')
 
@@ -111,6 +111,14 @@ _GCLIENT_DEPS_SCHEMA = _NodeDictSchema({
                 # if the condition evaluates to True.
                 schema.Optional('condition'): basestring,
                 schema.Optional('dep_type', default='git'): basestring,
+
+                # Whether to check out the repo without the blobs of its
+                # history, overriding --partial-clone.
+                schema.Optional('partial_clone'): bool,
+
+                # Directories to check out in cone-mode sparse checkout, with
+                # the files directly in their parent directories.
+                schema.Optional('sparse_paths'): [basestring],
             }),
             # CIPD package.
             _NodeDictSchema({
@@ -145,6 +153,25 @@ _GCLIENT_HOOKS_SCHEMA = [
         # Optional condition string. The hook will only be run
         # if the condition evaluates to True.
         schema.Optional('condition'): basestring,
+
+        # With --hook-jobs, don't wait for the hooks listed before this one in
+        # the same DEPS file.
+        schema.Optional('parallel'): bool,
+
+        # With --hook-jobs, names of the hooks listed before this one in the
+        # same DEPS file that must be run first. Other hooks before this one
+        # may run concurrently.
+        schema.Optional('depends_on'): [basestring],
+
+        # Optional inputs the outcome of the hook depends on. When given, the
+        # hook is skipped if neither its inputs nor the hook itself changed
+        # since it last succeeded.
+        schema.Optional('inputs'): _NodeDictSchema({
+            # Files or globs, relative to the hook's working directory.
+            schema.Optional('files'): [basestring],
+            # Paths of dependencies whose checked out revision matters.
+            schema.Optional('deps'): [basestring],
+        }),
     })
 ]
 
@@ -9,6 +9,7 @@ from __future__ import print_function
 import collections
 import contextlib
 import errno
+import hashlib
 import json
 import logging
 import os
@@ -26,6 +27,7 @@ except ImportError:  # For Py3 compatibility
 
 import gclient_utils
 import git_cache
+import lockfile
 import scm
 import shutil
 import subprocess2
@@ -211,6 +213,10 @@ class GitWrapper(SCMWrapper):
   """Wrapper for Git"""
   name = 'git'
   remote = 'origin'
+  # Fetches the blobs missing from checkouts of partial cache mirrors.
+  PROMISOR_REMOTE = 'gclient-promisor'
+  # Set in checkouts whose sparse checkout is managed by gclient.
+  SPARSE_CHECKOUT_CONFIG = 'gclient.sparseCheckout'
 
   @property
   def cache_dir(self):
@@ -241,21 +247,22 @@ class GitWrapper(SCMWrapper):
     # time-stamp of the currently checked out revision.
     return self._Capture(['log', '-n', '1', '--format=%ai'])
 
-  def _GetDiffFilenames(self, base):
+  def _GetDiffFilenames(self, base, options):
     """Returns the names of files modified since base."""
     return self._Capture(
         # Filter to remove base if it is None.
         list(filter(bool, ['-c', 'core.quotePath=false', 'diff', '--name-only',
                            base])
-        )).split()
+        ) + self._SparsePathspec(options)).split()
 
   def diff(self, options, _args, _file_list):
     _, revision = gclient_utils.SplitUrlRevision(self.url)
     if not revision:
       revision = 'refs/remotes/%s/master' % self.remote
-    self._Run(['-c', 'core.quotePath=false', 'diff', revision], options)
+    self._Run(['-c', 'core.quotePath=false', 'diff', revision] +
+              self._SparsePathspec(options), options)
 
-  def pack(self, _options, _args, _file_list):
+  def pack(self, options, _args, _file_list):
     """Generates a patch file which can be applied to the root of the
     repository.
 
@@ -267,7 +274,7 @@ class GitWrapper(SCMWrapper):
     except subprocess2.CalledProcessError:
       merge_base = []
     gclient_utils.CheckCallAndFilter(
-        ['git', 'diff'] + merge_base,
+        ['git', 'diff'] + merge_base + self._SparsePathspec(options),
         cwd=self.checkout_path,
         filter_fn=GitDiffFilterer(self.relpath, print_func=self.Print).Filter)
 
@@ -300,11 +307,15 @@ class GitWrapper(SCMWrapper):
     """Equivalent to git fetch; git reset."""
     self._SetFetchConfig(options)
 
-    self._Fetch(options, prune=True, quiet=options.verbose)
+    if self._UseExactSha(options, revision):
+      self._Fetch(options, refspec=revision, depth=1)
+    else:
+      self._Fetch(options, prune=True, quiet=options.verbose)
     self._Scrub(revision, options)
     if file_list is not None:
       files = self._Capture(
-          ['-c', 'core.quotePath=false', 'ls-files']).splitlines()
+          ['-c', 'core.quotePath=false', 'ls-files'] +
+          self._SparsePathspec(options)).splitlines()
       file_list.extend(
           [os.path.join(self.checkout_path, f) for f in files])
 
@@ -409,7 +420,8 @@ class GitWrapper(SCMWrapper):
     self.Print('Revision to patch is %r @ %r.' % (patch_repo, patch_rev))
     self.Print('Current dir is %r' % self.checkout_path)
     self._Capture(['reset', '--hard'])
-    self._Capture(['fetch', '--no-tags', patch_repo, patch_rev])
+    with self._WorktreeMirrorLock(options):
+      self._Capture(['fetch', '--no-tags', patch_repo, patch_rev])
     patch_rev = self._Capture(['rev-parse', 'FETCH_HEAD'])
 
     if not options.rebase_patch_ref:
@@ -455,7 +467,7 @@ class GitWrapper(SCMWrapper):
         raise
 
     if file_list is not None:
-      file_list.extend(self._GetDiffFilenames(base_rev))
+      file_list.extend(self._GetDiffFilenames(base_rev, options))
 
     if options.reset_patch_ref:
       self._Capture(['reset', '--soft', base_rev])
@@ -543,7 +555,10 @@ class GitWrapper(SCMWrapper):
         (os.path.isdir(self.checkout_path) and
          not os.path.exists(os.path.join(self.checkout_path, '.git')))):
       if mirror:
-        self._UpdateMirrorIfNotContains(mirror, options, rev_type, revision)
+        self._UpdateMirrorIfNotContains(
+            mirror, options, rev_type, revision,
+            worktree=getattr(options, 'use_worktrees', False))
+        mirror.register_checkout(os.path.join(self.checkout_path, '.git'))
       try:
         self._Clone(revision, url, options)
       except subprocess2.CalledProcessError:
@@ -551,10 +566,11 @@ class GitWrapper(SCMWrapper):
         self._Clone(revision, url, options)
       if file_list is not None:
         files = self._Capture(
-            ['-c', 'core.quotePath=false', 'ls-files']).splitlines()
+            ['-c', 'core.quotePath=false', 'ls-files'] +
+            self._SparsePathspec(options)).splitlines()
         file_list.extend(
             [os.path.join(self.checkout_path, f) for f in files])
-      if mirror:
+      if mirror and not self._IsMirrorWorktree(mirror):
         self._Capture(
             ['remote', 'set-url', '--push', 'origin', mirror.url])
       if not verbose:
@@ -563,6 +579,11 @@ class GitWrapper(SCMWrapper):
         self.Print('')
       return self._Capture(['rev-parse', '--verify', 'HEAD'])
 
+    self._CheckNotForeignWorktree(mirror)
+    if self._IsMirrorWorktree(mirror):
+      return self._UpdateWorktree(mirror, revision, rev_type, managed, options,
+                                  file_list)
+
     if mirror:
       self._Capture(
           ['remote', 'set-url', '--push', 'origin', mirror.url])
@@ -573,9 +594,11 @@ class GitWrapper(SCMWrapper):
       return self._Capture(['rev-parse', '--verify', 'HEAD'])
 
     self._maybe_break_locks(options)
+    self._UpdateSparseCheckout(options)
 
     if mirror:
       self._UpdateMirrorIfNotContains(mirror, options, rev_type, revision)
+      mirror.register_checkout(os.path.join(self.checkout_path, '.git'))
 
     # See if the url has changed (the unittests use git://foo for the url, let
     # that through).
@@ -657,7 +680,10 @@ class GitWrapper(SCMWrapper):
 
     # Fetch upstream if we don't already have |revision|.
     if not scm.GIT.IsValidRevision(self.checkout_path, revision, sha_only=True):
-      self._Fetch(options, prune=options.force)
+      if self._UseExactSha(options, revision):
+        self._Fetch(options, refspec=revision, depth=1)
+      else:
+        self._Fetch(options, prune=options.force)
 
       if not scm.GIT.IsValidRevision(self.checkout_path, revision,
                                      sha_only=True):
@@ -749,7 +775,9 @@ class GitWrapper(SCMWrapper):
         raise gclient_utils.Error(switch_error)
     else:
       # case 3 - the default case
-      rebase_files = self._GetDiffFilenames(upstream_branch)
+      rebase_files = []
+      if file_list is not None:
+        rebase_files = self._GetDiffFilenames(upstream_branch, options)
       if verbose:
         self.Print('Trying fast-forward merge to branch : %s' % upstream_branch)
       try:
@@ -866,6 +894,7 @@ class GitWrapper(SCMWrapper):
       # Don't reuse the args.
       return self.update(options, [], file_list)
 
+    self._CheckNotForeignWorktree(self.GetCacheMirror())
     default_rev = "refs/heads/master"
     if options.upstream:
       if self._GetCurrentBranch():
@@ -874,7 +903,9 @@ class GitWrapper(SCMWrapper):
     _, deps_revision = gclient_utils.SplitUrlRevision(self.url)
     if not deps_revision:
       deps_revision = default_rev
-    if deps_revision.startswith('refs/heads/'):
+    if (deps_revision.startswith('refs/heads/') and
+        not self._IsMirrorWorktree(self.GetCacheMirror())):
+      # Worktrees of cache mirrors have the remote branches as local ones.
       deps_revision = deps_revision.replace('refs/heads/', self.remote + '/')
     try:
       deps_revision = self.GetUsableRev(deps_revision, options)
@@ -886,8 +917,9 @@ class GitWrapper(SCMWrapper):
           e.message)
       return self.update(options, [], file_list)
 
+    self._UpdateSparseCheckout(options)
     if file_list is not None:
-      files = self._GetDiffFilenames(deps_revision)
+      files = self._GetDiffFilenames(deps_revision, options)
 
     self._Scrub(deps_revision, options)
     self._Run(['clean', '-f', '-d'], options)
@@ -914,10 +946,12 @@ class GitWrapper(SCMWrapper):
         if base_rev:
           merge_base = [base_rev]
       self._Run(
-          ['-c', 'core.quotePath=false', 'diff', '--name-status'] + merge_base,
+          ['-c', 'core.quotePath=false', 'diff', '--name-status'] + merge_base +
+          self._SparsePathspec(options),
           options, always_show_header=options.verbose)
       if file_list is not None:
-        files = self._GetDiffFilenames(merge_base[0] if merge_base else None)
+        files = self._GetDiffFilenames(merge_base[0] if merge_base else None,
+                                       options)
         file_list.extend([os.path.join(self.checkout_path, f) for f in files])
 
   def GetUsableRev(self, rev, options):
@@ -932,7 +966,10 @@ class GitWrapper(SCMWrapper):
     else:
       # May exist in origin, but we don't have it yet, so fetch and look
       # again.
-      self._Fetch(options)
+      if self._UseExactSha(options, rev):
+        self._Fetch(options, refspec=rev, depth=1)
+      else:
+        self._Fetch(options)
       if scm.GIT.IsValidRevision(cwd=self.checkout_path, rev=rev):
         sha1 = rev
 
@@ -969,16 +1006,36 @@ class GitWrapper(SCMWrapper):
       mirror_kwargs['commits'].append(revision)
     return git_cache.Mirror(url, **mirror_kwargs)
 
-  def _UpdateMirrorIfNotContains(self, mirror, options, rev_type, revision):
+  def _UpdateMirrorIfNotContains(self, mirror, options, rev_type, revision,
+                                 worktree=False):
     """Update a git mirror by fetching the latest commits from the remote,
     unless mirror already contains revision whose type is sha1 hash.
+
+    Worktrees get the branch heads and tags only from the mirror, so it is
+    also updated if it hasn't fetched them yet.
     """
-    if rev_type == 'hash' and mirror.contains_revision(revision):
+    lock_timeout = getattr(options, 'lock_timeout', 0)
+    partial_clone = getattr(options, 'partial_clone', False)
+    # Full checkouts need the blobs missing from partial mirrors.
+    needs_blobs = not partial_clone and mirror.is_partial()
+    needs_refs = worktree and not mirror.has_fetched_refs()
+    if (rev_type == 'hash' and not needs_blobs and not needs_refs and
+        mirror.contains_revision(revision, lock_timeout)):
       if options.verbose:
         self.Print('skipping mirror update, it has rev=%s already' % revision,
                    timestamp=False)
       return
 
+    # Branches are resolved against the mirror as is if it was fetched
+    # recently, e.g. by another gclient process.
+    cache_ttl = getattr(options, 'cache_ttl', 0)
+    if (rev_type != 'hash' and not needs_blobs and cache_ttl and
+        mirror.is_fresh(cache_ttl)):
+      if options.verbose:
+        self.Print('skipping mirror update, it was fetched less than %ds ago' %
+                   cache_ttl, timestamp=False)
+      return
+
     if getattr(options, 'shallow', False):
       # HACK(hinoka): These repositories should be super shallow.
       if 'flash' in mirror.url:
@@ -990,7 +1047,19 @@ class GitWrapper(SCMWrapper):
     mirror.populate(verbose=options.verbose,
                     bootstrap=not getattr(options, 'no_bootstrap', False),
                     depth=depth,
-                    lock_timeout=getattr(options, 'lock_timeout', 0))
+                    lock_timeout=lock_timeout,
+                    partial_clone=partial_clone,
+                    need_blobs=needs_blobs)
+
+  @contextlib.contextmanager
+  def _MirrorReadLock(self, url, options):
+    """Holds a shared lock on the cache mirror at |url|, if any, so that it
+    isn't fetched into while a checkout is cloned from it."""
+    if not self.cache_dir or not os.path.isdir(url):
+      yield
+      return
+    with lockfile.lock(url, getattr(options, 'lock_timeout', 0), shared=True):
+      yield
 
   def _Clone(self, revision, url, options):
     """Clone a git repository from the given URL.
@@ -1000,14 +1069,19 @@ class GitWrapper(SCMWrapper):
     leave HEAD detached as it makes future updates simpler -- in this case the
     user should first create a new branch or switch to an existing branch before
     making changes in the repo."""
+    if self.cache_dir and getattr(options, 'use_worktrees', False):
+      return self._AddWorktree(self.GetCacheMirror(), revision, options)
     if not options.verbose:
       # git clone doesn't seem to insert a newline properly before printing
       # to stdout
       self.Print('')
     cfg = gclient_utils.DefaultIndexPackConfig(url)
     clone_cmd = cfg + ['clone', '--no-checkout', '--progress']
+    partial_clone = getattr(options, 'partial_clone', False)
     if self.cache_dir:
       clone_cmd.append('--shared')
+    elif partial_clone:
+      clone_cmd.append('--filter=%s' % git_cache.Mirror.PARTIAL_CLONE_FILTER)
     if options.verbose:
       clone_cmd.append('--verbose')
     clone_cmd.append(url)
@@ -1016,8 +1090,12 @@ class GitWrapper(SCMWrapper):
     parent_dir = os.path.dirname(self.checkout_path)
     gclient_utils.safe_makedirs(parent_dir)
 
+    exact_sha = self._UseExactSha(options, revision)
     template_dir = None
-    if hasattr(options, 'no_history') and options.no_history:
+    if exact_sha:
+      # Nothing is cloned; only |revision| is fetched once the repo exists.
+      pass
+    elif hasattr(options, 'no_history') and options.no_history:
       if gclient_utils.IsGitSha(revision):
         # In the case of a subproject, the pinned sha is not necessarily the
         # head of the remote branch (so we can't just use --depth=N). Instead,
@@ -1045,8 +1123,24 @@ class GitWrapper(SCMWrapper):
       else:
         print_stdout = False
         filter_fn = self.filter
-      self._Run(clone_cmd, options, cwd=self._root_dir, retry=True,
-                print_stdout=print_stdout, filter_fn=filter_fn)
+      if exact_sha:
+        self._Run(['init', tmp_dir], options, cwd=self._root_dir)
+        self._Run(['remote', 'add', self.remote, url], options, cwd=tmp_dir)
+        if partial_clone:
+          # What clone --filter sets up, so that the fetch of |revision| leaves
+          # out the blobs, which are fetched from the remote when needed.
+          remote = 'remote.%s.' % self.remote
+          scm.GIT.UpdateConfigFile(os.path.join(tmp_dir, '.git', 'config'), [
+              ('set', 'core.repositoryformatversion', '1'),
+              ('set', 'extensions.partialclone', self.remote),
+              ('set', remote + 'promisor', 'true'),
+              ('set', remote + 'partialclonefilter',
+               git_cache.Mirror.PARTIAL_CLONE_FILTER),
+          ])
+      else:
+        with self._MirrorReadLock(url, options):
+          self._Run(clone_cmd, options, cwd=self._root_dir, retry=True,
+                    print_stdout=print_stdout, filter_fn=filter_fn)
       gclient_utils.safe_makedirs(self.checkout_path)
       gclient_utils.safe_rename(os.path.join(tmp_dir, '.git'),
                                 os.path.join(self.checkout_path, '.git'))
@@ -1067,10 +1161,19 @@ class GitWrapper(SCMWrapper):
       gclient_utils.rmtree(tmp_dir)
       if template_dir:
         gclient_utils.rmtree(template_dir)
+    if self.cache_dir and partial_clone:
+      mirror = self.GetCacheMirror()
+      if mirror and mirror.is_partial():
+        self._SetPromisorRemote()
     self._SetFetchConfig(options)
-    self._Fetch(options, prune=options.force)
+    if exact_sha:
+      self._Fetch(options, refspec=revision, depth=1)
+    else:
+      self._Fetch(options, prune=options.force)
     revision = self._AutoFetchRef(options, revision)
     remote_ref = scm.GIT.RefToRemoteRef(revision, self.remote)
+    # Before anything is checked out, so that only the sparse paths are.
+    self._UpdateSparseCheckout(options)
     self._Checkout(options, ''.join(remote_ref or revision), quiet=True)
     if self._GetCurrentBranch() is None:
       # Squelch git's very verbose detached HEAD warning and use our own
@@ -1080,6 +1183,126 @@ class GitWrapper(SCMWrapper):
          'an existing branch or use \'git checkout %s -b <branch>\' to\n'
          'create a new branch for your work.') % (revision, self.remote))
 
+  def _GetGitDirs(self):
+    """Returns the git dir of the checkout and the common dir it shares with
+    other worktrees, if any, read without running git."""
+    git_dir = os.path.join(self.checkout_path, '.git')
+    if not os.path.isfile(git_dir):
+      return git_dir, git_dir
+    # .git points to the checkout's git dir in the main repository.
+    git_dir = gclient_utils.FileRead(git_dir).strip()[len('gitdir:'):].strip()
+    git_dir = os.path.join(self.checkout_path, git_dir)
+    common_dir = git_dir
+    commondir_path = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir_path):
+      common_dir = os.path.join(
+          git_dir, gclient_utils.FileRead(commondir_path).strip())
+    return git_dir, common_dir
+
+  def _GetWorktreeCommonDir(self):
+    """Returns the real path of the repository the checkout is a worktree
+    of, or None if it isn't one."""
+    if not os.path.isfile(os.path.join(self.checkout_path, '.git')):
+      return None
+    _, common_dir = self._GetGitDirs()
+    common_dir = os.path.realpath(common_dir)
+    checkout_path = os.path.realpath(self.checkout_path)
+    if (common_dir == checkout_path or
+        common_dir.startswith(checkout_path + os.sep)):
+      return None
+    return common_dir
+
+  def _IsMirrorWorktree(self, mirror):
+    """Returns true if the checkout is a worktree of the cache |mirror|."""
+    common_dir = self._GetWorktreeCommonDir()
+    return bool(mirror and common_dir and
+                os.path.normcase(common_dir) ==
+                os.path.normcase(os.path.realpath(mirror.mirror_path)))
+
+  def _CheckNotForeignWorktree(self, mirror):
+    """Raises if the checkout is a worktree of another repository than the
+    cache |mirror|, e.g. because the url of the dependency or the cache dir
+    changed. Its config and refs are the other repository's, so it can't be
+    fetched into nor reconfigured."""
+    common_dir = self._GetWorktreeCommonDir()
+    if common_dir and not self._IsMirrorWorktree(mirror):
+      raise gclient_utils.Error(
+          '\n____ %s is a worktree of %s, which isn\'t the git cache of %s.\n'
+          'Its url or the cache dir changed. Delete it (after saving your '
+          'work) and run gclient again.' % (
+              self.relpath, common_dir,
+              gclient_utils.SplitUrlRevision(self.url)[0]))
+
+  def _AddWorktree(self, mirror, revision, options):
+    """Checks out |revision| in a new worktree of the cache |mirror|, which
+    shares the objects and refs of the mirror instead of copying them.
+
+    HEAD is always detached, as the branches are those of the mirror.
+    """
+    ref = scm.GIT.RemoteRefToRef(revision, self.remote) or revision
+    gclient_utils.safe_makedirs(os.path.dirname(self.checkout_path))
+    # Exclusive, as pruning edits the mirror's worktrees dir.
+    with mirror.lock(getattr(options, 'lock_timeout', 0)):
+      commit = self._Capture(['rev-parse', '--verify', ref + '^{commit}'],
+                             cwd=mirror.mirror_path)
+      # Forget the worktrees of deleted checkouts, whose names may be reused.
+      self._Run(['worktree', 'prune'], options, cwd=mirror.mirror_path)
+      self._Run(['worktree', 'add', '--detach', '--no-checkout',
+                 self.checkout_path, commit], options, cwd=mirror.mirror_path)
+    # Before anything is checked out, so that only the sparse paths are.
+    self._UpdateSparseCheckout(options)
+    self._Checkout(options, commit, quiet=True)
+
+  def _UpdateWorktree(self, mirror, revision, rev_type, managed, options,
+                      file_list):
+    """Updates a checkout which is a worktree of the cache |mirror|.
+
+    Fetching the mirror is all it takes to fetch the checkout. Nothing is
+    configured in the checkout, as its config is the mirror's.
+    """
+    if not managed:
+      self.Print('________ unmanaged solution; skipping %s' % self.relpath)
+      return self._Capture(['rev-parse', '--verify', 'HEAD'])
+
+    # Before fetching, which would delete it.
+    branch = self._GetCurrentBranch()
+    if branch is not None:
+      raise gclient_utils.Error(
+          '\n____ %s is on branch %s, which is a branch of the git cache it is '
+          'a worktree of, and is updated or deleted by every fetch.\n'
+          'Run `git checkout --detach` in it and run gclient again.' % (
+              self.relpath, branch))
+
+    self._maybe_break_locks(options)
+    self._UpdateSparseCheckout(options)
+    self._UpdateMirrorIfNotContains(mirror, options, rev_type, revision,
+                                    worktree=True)
+    mirror.register_checkout(os.path.join(self.checkout_path, '.git'))
+
+    if options.force or options.reset:
+      self._Scrub('HEAD', options)
+    ref = scm.GIT.RemoteRefToRef(revision, self.remote) or revision
+    commit = self._Capture(['rev-parse', '--verify', ref + '^{commit}'])
+    head = self._Capture(['rev-parse', 'HEAD'])
+    if head == commit:
+      self.Print('Up-to-date; skipping checkout.')
+    else:
+      if not (options.force or options.reset):
+        self._CheckClean(revision)
+      self._CheckDetachedHead(revision, options)
+      self._Checkout(
+          options,
+          commit,
+          force=(options.force and options.delete_unversioned_trees),
+          quiet=True,
+      )
+      if file_list is not None:
+        file_list.extend(os.path.join(self.checkout_path, f)
+                         for f in self._GetDiffFilenames(head, options))
+    if not options.verbose:
+      self.Print('_____ %s at %s' % (self.relpath, revision), timestamp=False)
+    return self._Capture(['rev-parse', '--verify', 'HEAD'])
+
   def _AskForData(self, prompt, options):
     if options.jobs > 1:
       self.Print(prompt)
@@ -1093,7 +1316,7 @@ class GitWrapper(SCMWrapper):
                      branch=None, printed_path=False, merge=False):
     """Attempt to rebase onto either upstream or, if specified, newbase."""
     if files is not None:
-      files.extend(self._GetDiffFilenames(upstream))
+      files.extend(self._GetDiffFilenames(upstream, options))
     revision = upstream
     if newbase:
       revision = newbase
@@ -1235,7 +1458,7 @@ class GitWrapper(SCMWrapper):
                                 '\tPlease commit, stash, or reset.\n'
                                   % (self.relpath, revision))
 
-  def _CheckDetachedHead(self, revision, _options):
+  def _CheckDetachedHead(self, revision, options):
     # HEAD is detached. Make sure it is safe to move away from (i.e., it is
     # reference by a commit). If not, error out -- most likely a rebase is
     # in progress, try to detect so we can give a better error.
@@ -1243,6 +1466,10 @@ class GitWrapper(SCMWrapper):
       scm.GIT.Capture(['name-rev', '--no-undefined', 'HEAD'],
           cwd=self.checkout_path)
     except subprocess2.CalledProcessError:
+      if (self._UseExactSha(options, revision) and
+          self._Capture(['rev-parse', 'HEAD']) in self._GetShallowCommits()):
+        # The previously pinned commit, fetched alone; nothing to save.
+        return
       # Commit is not contained by any rev. See if the user is rebasing:
       if self._IsRebasing():
         # Punt to the user
@@ -1255,10 +1482,23 @@ class GitWrapper(SCMWrapper):
       # Let's just save off the commit so we can proceed.
       name = ('saved-by-gclient-' +
               self._Capture(['rev-parse', '--short', 'HEAD']))
-      self._Capture(['branch', '-f', name])
+      if self._IsMirrorWorktree(self.GetCacheMirror()):
+        # Branches are the mirror's, and deleted when the mirror is fetched.
+        name = 'refs/worktree/' + name
+        self._Capture(['update-ref', name, 'HEAD'])
+      else:
+        self._Capture(['branch', '-f', name])
       self.Print('_____ found an unreferenced commit and saved it as \'%s\'' %
           name)
 
+  def _GetShallowCommits(self):
+    """Returns the commits whose parents weren't fetched."""
+    shallow_file = os.path.join(self.checkout_path, self._Capture(
+        ['rev-parse', '--git-path', 'shallow']))
+    if not os.path.exists(shallow_file):
+      return []
+    return gclient_utils.FileRead(shallow_file).split()
+
   def _GetCurrentBranch(self):
     # Returns name of current branch or None for detached HEAD
     branch = self._Capture(['rev-parse', '--abbrev-ref=strict', 'HEAD'])
@@ -1311,7 +1551,9 @@ class GitWrapper(SCMWrapper):
     return self._Capture(checkout_args)
 
   def _Fetch(self, options, remote=None, prune=False, quiet=False,
-             refspec=None):
+             refspec=None, depth=None):
+    if self._GetWorktreeCommonDir():
+      return self._FetchIntoMirror(options, refspec)
     cfg = gclient_utils.DefaultIndexPackConfig(self.url)
     # When updating, the ref is modified to be a remote ref .
     # (e.g. refs/heads/NAME becomes refs/remotes/REMOTE/NAME).
@@ -1335,6 +1577,8 @@ class GitWrapper(SCMWrapper):
 
     if prune:
       fetch_cmd.append('--prune')
+    if depth:
+      fetch_cmd.append('--depth=%d' % depth)
     if options.verbose:
       fetch_cmd.append('--verbose')
     if not hasattr(options, 'with_tags') or not options.with_tags:
@@ -1343,30 +1587,181 @@ class GitWrapper(SCMWrapper):
       fetch_cmd.append('--quiet')
     self._Run(fetch_cmd, options, show_header=options.verbose, retry=True)
 
+  def _FetchIntoMirror(self, options, refspec=None):
+    """Fetches for a checkout which is a worktree of its cache mirror.
+
+    Fetching everything is populating the mirror. Other refspecs are fetched
+    from the mirror's url into FETCH_HEAD only, which is per worktree, while
+    holding the mirror's lock like its fetches do.
+    """
+    mirror = self.GetCacheMirror()
+    self._CheckNotForeignWorktree(mirror)
+    if not refspec:
+      self._UpdateMirrorIfNotContains(mirror, options, 'branch', None)
+      return
+    refspec = scm.GIT.RemoteRefToRef(refspec, self.remote) or refspec
+    fetch_cmd = ['fetch', '--no-tags', mirror.url, refspec.split(':')[0]]
+    if options.verbose:
+      fetch_cmd.append('--verbose')
+    with self._WorktreeMirrorLock(options):
+      self._Run(fetch_cmd, options, show_header=options.verbose, retry=True)
+
+  @contextlib.contextmanager
+  def _WorktreeMirrorLock(self, options):
+    """Holds the lock of the cache mirror the checkout is a worktree of, if
+    any, as fetching into the checkout fetches into the mirror."""
+    if not self._GetWorktreeCommonDir():
+      yield
+      return
+    mirror = self.GetCacheMirror()
+    self._CheckNotForeignWorktree(mirror)
+    with mirror.lock(getattr(options, 'lock_timeout', 0)):
+      yield
+
+  def _UseExactSha(self, options, revision):
+    """Returns true if only the pinned commit |revision| should be fetched,
+    without history nor refs.
+
+    Checkouts of cache mirrors borrow all the objects of the mirror anyway.
+    """
+    return bool(getattr(options, 'exact_sha', False) and not self.cache_dir and
+                revision and gclient_utils.IsFullGitSha(revision))
+
+  @staticmethod
+  def _GetSparsePaths(options):
+    """Returns the directories to check out, or None to check out everything."""
+    sparse_paths = getattr(options, 'sparse_paths', None)
+    if sparse_paths is None:
+      return None
+    sparse_paths = set(p.replace('\\', '/').strip('/') for p in sparse_paths)
+    return sorted(p for p in sparse_paths if p)
+
+  def _SparsePathspec(self, options):
+    """Returns the arguments limiting git commands to the files of the sparse
+    checkout, i.e. what cone mode checks out: everything under the sparse paths
+    and the files directly in their parent directories."""
+    sparse_paths = self._GetSparsePaths(options)
+    if sparse_paths is None:
+      return []
+    pathspec = set([':(glob)*'])
+    for path in sparse_paths:
+      pathspec.add(':(literal)' + path)
+      parent = posixpath.dirname(path)
+      while parent:
+        pathspec.add(':(glob)%s/*' % parent)
+        parent = posixpath.dirname(parent)
+    return ['--'] + sorted(pathspec)
+
+  def _UpdateSparseCheckout(self, options):
+    """Makes the sparse checkout match the sparse_paths of the dependency.
+
+    Only sparse checkouts set up by gclient are turned back into full ones.
+    """
+    sparse_paths = self._GetSparsePaths(options)
+    managed = self._IsSparseCheckoutManaged()
+    if sparse_paths is None:
+      if managed:
+        self.Print('_____ checking out all of %s' % self.relpath)
+        self._Run(['sparse-checkout', 'disable'], options)
+        # The marker may be in either file, depending on the git version and
+        # whether the checkout is a worktree; git exits with 5 if it's unset.
+        for scope in ('--local', '--worktree'):
+          try:
+            self._Capture(
+                ['config', scope, '--unset-all', self.SPARSE_CHECKOUT_CONFIG])
+          except subprocess2.CalledProcessError:
+            pass
+      return
+    if managed:
+      try:
+        current = self._Capture(['sparse-checkout', 'list']).splitlines()
+      except subprocess2.CalledProcessError:
+        # Disabled by hand.
+        current = None
+      if current is not None and sorted(current) == sparse_paths:
+        return
+    self.Print('_____ sparse checkout of %s: %s' % (
+        self.relpath, ', '.join(sparse_paths) or 'top-level files only'))
+    self._Run(['sparse-checkout', 'set', '--cone', '--'] + sparse_paths,
+              options)
+    # Per worktree, should the checkout be a worktree of its cache mirror.
+    self._Capture(
+        ['config', '--worktree', self.SPARSE_CHECKOUT_CONFIG, 'true'])
+
+  def _IsSparseCheckoutManaged(self):
+    """Returns true if gclient made the checkout sparse.
+
+    The config files are read directly, so that checking deps which aren't
+    sparse doesn't cost a git process.
+    """
+    git_dir, common_dir = self._GetGitDirs()
+    key = self.SPARSE_CHECKOUT_CONFIG.lower()
+    for path in (os.path.join(common_dir, 'config'),
+                 os.path.join(git_dir, 'config.worktree')):
+      if not os.path.exists(path):
+        continue
+      try:
+        config = scm.GIT.ReadConfigFile(path)
+      except (IOError, OSError, subprocess2.CalledProcessError):
+        continue
+      if any(k == key and v == 'true' for k, v in config):
+        return True
+    return False
+
+  def _SetPromisorRemote(self):
+    """Lets a checkout cloned from a partial mirror fetch the blobs it is
+    missing.
+
+    The mirror can't serve them, as it doesn't fetch missing objects on behalf
+    of others, so they are fetched from the mirror's origin, under a remote of
+    their own.
+    """
+    url, _ = gclient_utils.SplitUrlRevision(self.url)
+    remote = 'remote.%s.' % self.PROMISOR_REMOTE
+    scm.GIT.UpdateConfigFile(self._GetGitConfigPath(), [
+        # Extensions are only honored by repository format version 1.
+        ('set', 'core.repositoryformatversion', '1'),
+        ('set', 'extensions.partialclone', self.PROMISOR_REMOTE),
+        ('set', remote + 'url', url),
+        ('set', remote + 'promisor', 'true'),
+        ('set', remote + 'partialclonefilter',
+         git_cache.Mirror.PARTIAL_CLONE_FILTER),
+        ('set', remote + 'skipfetchall', 'true'),
+    ])
+
   def _SetFetchConfig(self, options):
     """Adds, and optionally fetches, "branch-heads" and "tags" refspecs
     if requested."""
+    if self._GetWorktreeCommonDir():
+      # The config is the mirror's, which fetches the refs requested from it.
+      return
+    changes = []
     if options.force or options.reset:
-      try:
-        self._Run(['config', '--unset-all', 'remote.%s.fetch' % self.remote],
-                  options)
-        self._Run(['config', 'remote.%s.fetch' % self.remote,
-                   '+refs/heads/*:refs/remotes/%s/*' % self.remote], options)
-      except subprocess2.CalledProcessError as e:
-        # If exit code was 5, it means we attempted to unset a config that
-        # didn't exist. Ignore it.
-        if e.returncode != 5:
-          raise
+      changes.append(('unset', 'remote.%s.fetch' % self.remote))
+      changes.append(('set', 'remote.%s.fetch' % self.remote,
+                      '+refs/heads/*:refs/remotes/%s/*' % self.remote))
     if hasattr(options, 'with_branch_heads') and options.with_branch_heads:
-      config_cmd = ['config', 'remote.%s.fetch' % self.remote,
-                    '+refs/branch-heads/*:refs/remotes/branch-heads/*',
-                    '^\\+refs/branch-heads/\\*:.*$']
-      self._Run(config_cmd, options)
+      changes.append(('replace', 'remote.%s.fetch' % self.remote,
+                      '+refs/branch-heads/*:refs/remotes/branch-heads/*',
+                      '^\\+refs/branch-heads/\\*:.*$'))
     if hasattr(options, 'with_tags') and options.with_tags:
-      config_cmd = ['config', 'remote.%s.fetch' % self.remote,
-                    '+refs/tags/*:refs/tags/*',
-                    '^\\+refs/tags/\\*:.*$']
-      self._Run(config_cmd, options)
+      changes.append(('replace', 'remote.%s.fetch' % self.remote,
+                      '+refs/tags/*:refs/tags/*',
+                      '^\\+refs/tags/\\*:.*$'))
+    if not changes:
+      return
+    # Read the config once and only write what differs, in a single update.
+    if scm.GIT.UpdateConfigFile(self._GetGitConfigPath(), changes):
+      self.Print('Updated fetch config for %s' % self.relpath)
+
+  def _GetGitConfigPath(self):
+    """Returns the path of the config file of the checkout's repository."""
+    git_dir = os.path.join(self.checkout_path, '.git')
+    if not os.path.isdir(git_dir):
+      # .git is a file pointing elsewhere, e.g. in a worktree.
+      git_dir = os.path.join(self.checkout_path, self._Capture(
+          ['rev-parse', '--git-common-dir']))
+    return os.path.join(git_dir, 'config')
 
   def _AutoFetchRef(self, options, revision):
     """Attempts to fetch |revision| if not available in local repo.
@@ -1420,6 +1815,11 @@ class CipdPackage(object):
 
 class CipdRoot(object):
   """A representation of a single CIPD root."""
+  # Records what the last successful `cipd ensure` deployed, see ensure().
+  _ENSURE_STATE_FILE = 'gclient_ensure_state.json'
+  # Versions that can't move, i.e. tags and instance IDs (as opposed to refs).
+  _PINNED_VERSION_RE = re.compile(r'^([^:]+:.+|[0-9a-f]{40}|[\w-]{44})$')
+
   def __init__(self, root_dir, service_url):
     self._all_packages = set()
     self._mutator_lock = threading.Lock()
@@ -1469,15 +1869,19 @@ class CipdRoot(object):
         if os.path.exists(cipd_cache_dir):
           raise
 
+  def _ensure_file_contents(self):
+    contents = '$ParanoidMode CheckPresence\n\n'
+    for subdir, packages in sorted(self._packages_by_subdir.items()):
+      contents += '@Subdir %s\n' % subdir
+      for package in sorted(packages, key=lambda p: p.name):
+        contents += '%s %s\n' % (package.name, package.version)
+      contents += '\n'
+    return contents
+
   @contextlib.contextmanager
   def _create_ensure_file(self):
     try:
-      contents = '$ParanoidMode CheckPresence\n\n'
-      for subdir, packages in sorted(self._packages_by_subdir.items()):
-        contents += '@Subdir %s\n' % subdir
-        for package in sorted(packages, key=lambda p: p.name):
-          contents += '%s %s\n' % (package.name, package.version)
-        contents += '\n'
+      contents = self._ensure_file_contents()
       ensure_file = None
       with tempfile.NamedTemporaryFile(
           suffix='.ensure', delete=False, mode='wb') as ensure_file:
@@ -1487,9 +1891,95 @@ class CipdRoot(object):
       if ensure_file is not None and os.path.exists(ensure_file.name):
         os.remove(ensure_file.name)
 
-  def ensure(self):
-    """Run `cipd ensure`."""
+  def _deployed_instances(self):
+    """Returns the instance ID deployed for each package directory in the .cipd
+    directory, keyed by the directory name."""
+    deployed = {}
+    pkgs_dir = os.path.join(self.root_dir, '.cipd', 'pkgs')
+    if os.path.isdir(pkgs_dir):
+      for name in sorted(os.listdir(pkgs_dir)):
+        current = os.path.join(pkgs_dir, name, '_current')
+        if os.path.islink(current):
+          deployed[name] = os.readlink(current)
+        elif os.path.isfile(current + '.txt'):
+          # Windows doesn't use symlinks.
+          deployed[name] = gclient_utils.FileRead(current + '.txt').strip()
+        else:
+          deployed[name] = None
+    return deployed
+
+  def _ensure_fingerprint(self):
+    """Returns a digest of the ensure file and of the instances deployed in
+    the .cipd directory, or None if some package version is a ref that may
+    have moved since the last ensure.
+    """
+    for packages in self._packages_by_subdir.values():
+      for package in packages:
+        if not self._PINNED_VERSION_RE.match(package.version):
+          return None
+    content = json.dumps(
+        [self._ensure_file_contents(), self._deployed_instances()],
+        sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+  def _deployed_files(self):
+    """Returns the files CIPD deployed, relative to this root, as listed in
+    the manifests of the deployed instances, or None if some can't be read.
+    """
+    files = []
+    pkgs_dir = os.path.join(self.root_dir, '.cipd', 'pkgs')
+    for name, instance in sorted(self._deployed_instances().items()):
+      if not instance:
+        return None
+      try:
+        description = json.loads(gclient_utils.FileRead(
+            os.path.join(pkgs_dir, name, 'description.json')))
+        manifest = json.loads(gclient_utils.FileRead(os.path.join(
+            pkgs_dir, name, instance, '.cipdpkg', 'manifest.json')))
+      except (IOError, OSError, ValueError):
+        return None
+      subdir = description.get('subdir') or ''
+      for f in manifest.get('files') or []:
+        files.append(posixpath.join(subdir, f['name']))
+    return files
+
+  def _is_up_to_date(self, state_path):
+    """Whether the last ensure deployed the current packages and all of its
+    files are still there."""
+    fingerprint = self._ensure_fingerprint()
+    if not fingerprint or not os.path.exists(state_path):
+      return False
+    try:
+      state = json.loads(gclient_utils.FileRead(state_path))
+    except ValueError:
+      return False
+    if state.get('fingerprint') != fingerprint:
+      return False
+    return all(os.path.lexists(os.path.join(self.root_dir, f))
+               for f in state.get('files', []))
+
+  def ensure(self, out_fh=None):
+    """Run `cipd ensure`, unless the packages and the .cipd directory didn't
+    change since the last run and no deployed file was deleted.
+
+    If |out_fh| is given, the command's output is written to it instead of
+    stdout.
+    """
+    if out_fh is None:
+      output_kwargs = {'print_stdout': True}
+    else:
+      output_kwargs = {
+          'filter_fn': lambda line: print(line.rstrip('\n'), file=out_fh),
+      }
     with self._mutator_lock:
+      state_path = os.path.join(
+          self.root_dir, '.cipd', self._ENSURE_STATE_FILE)
+      if self._is_up_to_date(state_path):
+        logging.info('CIPD packages in %s are up to date, skipping ensure.',
+                     self.root_dir)
+        return
+      if os.path.exists(state_path):
+        os.remove(state_path)
       with self._create_ensure_file() as ensure_file:
         cmd = [
             'cipd', 'ensure',
@@ -1498,7 +1988,14 @@ class CipdRoot(object):
             '-ensure-file', ensure_file,
         ]
         gclient_utils.CheckCallAndFilter(
-            cmd, print_stdout=True, show_header=True)
+            cmd, show_header=True, **output_kwargs)
+      fingerprint = self._ensure_fingerprint()
+      files = self._deployed_files() if fingerprint else None
+      if files is not None and os.path.isdir(os.path.dirname(state_path)):
+        gclient_utils.FileWrite(state_path, json.dumps({
+            'fingerprint': fingerprint,
+            'files': files,
+        }))
 
   def run(self, command):
     if command == 'update':
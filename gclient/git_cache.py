@@ -7,12 +7,17 @@
 
 from __future__ import print_function
 
+import collections
 import contextlib
 import errno
+import hashlib
+import json
 import logging
 import optparse
 import os
+import random
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -24,10 +29,17 @@ try:
 except ImportError:  # For Py3 compatibility
   import urllib.parse as urlparse
 
+try:
+  import urllib2 as urllib
+except ImportError:  # For Py3 compatibility
+  import urllib.request as urllib
+
 from download_from_google_storage import Gsutil
+import gclient_eval
 import gclient_utils
 import lockfile
 import metrics
+import scm
 import subcommand
 
 # Analogous to gc.autopacklimit git config.
@@ -81,6 +93,416 @@ def exponential_backoff_retry(fn, excs=(Exception,), name=None, count=10,
       sleep_time *= 2
 
 
+def _RunInParallel(fn, items, jobs, key=None, key_jobs=1):
+  """Calls |fn| on each of |items|, |jobs| at a time, and returns the list of
+  results. If some calls raise, the first exception is re-raised once all the
+  calls are done.
+
+  If |key| is given, at most |key_jobs| items with the same key(item) run at
+  once, and items with other keys are run meanwhile.
+  """
+  results = [None] * len(items)
+  errors = []
+  pending = [(i, item, key(item) if key else None)
+             for i, item in enumerate(items)]
+  running = collections.Counter()
+  pending_cond = threading.Condition()
+
+  def pick():
+    for n, (i, item, k) in enumerate(pending):
+      if k is None or running[k] < key_jobs:
+        del pending[n]
+        running[k] += 1
+        return i, item, k
+    return None
+
+  def worker():
+    while True:
+      with pending_cond:
+        picked = None
+        while pending and not picked:
+          picked = pick()
+          if not picked:
+            pending_cond.wait()
+        if not picked:
+          return
+      i, item, k = picked
+      try:
+        results[i] = fn(item)
+      except Exception:
+        errors.append(sys.exc_info())
+      with pending_cond:
+        running[k] -= 1
+        pending_cond.notify_all()
+
+  threads = [threading.Thread(target=worker) for _ in range(max(1, jobs))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  if errors:
+    gclient_utils.reraise(*errors[0])
+  return results
+
+
+class BootstrapSource(object):
+  """Somewhere to download prebuilt copies of mirrors from.
+
+  A source holds a directory per repo, named after Mirror.basedir. It contains
+  numbered generations of the repo, either as a copy of the bare repo in <N>/
+  or as a git bundle in <N>.bundle. A generation may only be used once
+  <N>.ready exists.
+  """
+
+  def __init__(self, root):
+    self.root = root.rstrip('/')
+
+  def __str__(self):
+    return self.root
+
+  def list(self, basedir):
+    """Returns the names in the directory of the repo, with a trailing slash
+    for directories."""
+    raise NotImplementedError()
+
+  def list_files(self, basedir, name):
+    """Returns the files of the generation |name| of the repo as a list of
+    (path, size) tuples, with paths relative to the directory of the repo.
+
+    The size is None if the file can't be downloaded in chunks.
+    """
+    raise NotImplementedError()
+
+  def download_file(self, basedir, path, dest):
+    """Downloads the whole file |path| of the repo to |dest|. Raises IOError on
+    failure."""
+    raise NotImplementedError()
+
+  def download_range(self, basedir, path, start, end, out):
+    """Writes bytes [|start|, |end|) of the file |path| of the repo to the file
+    object |out|. Raises IOError on failure."""
+    raise NotImplementedError()
+
+  def latest(self, basedir):
+    """Returns the name of the newest ready generation of the repo, or None."""
+    names = set(self.list(basedir))
+    generations = []
+    for name in names:
+      m = re.match(r'^(\d+)\.ready$', name)
+      if not m:
+        continue
+      for candidate in (m.group(1) + '/', m.group(1) + '.bundle'):
+        if candidate in names:
+          generations.append((int(m.group(1)), candidate))
+    if not generations:
+      return None
+    return max(generations)[1]
+
+
+class GcsBootstrapSource(BootstrapSource):
+  """Bootstraps from a Google Storage bucket, e.g. gs://chromium-git-cache.
+
+  gsutil resumes interrupted downloads and splits large files into parallel
+  slices itself, so files are downloaded whole.
+  """
+
+  def __init__(self, root, gsutil_exe):
+    """|root| is either a bucket, whose bootstraps are in its v2/ directory as
+    uploaded by `git cache update-bootstrap`, or a gs:// url of the directory
+    holding them."""
+    if not root.startswith('gs://'):
+      root = 'gs://' + root
+    root = root.rstrip('/')
+    if '/' not in root[len('gs://'):]:
+      root += '/v2'
+    super(GcsBootstrapSource, self).__init__(root)
+    self.gsutil_exe = gsutil_exe
+    self._gsutil = None
+
+  @property
+  def gsutil(self):
+    # Only built when used, as it fails if gsutil is missing.
+    if self._gsutil is None:
+      self._gsutil = Gsutil(self.gsutil_exe, boto_path=None)
+    return self._gsutil
+
+  def _path(self, basedir, name=''):
+    return '%s/%s/%s' % (self.root, basedir, name)
+
+  def url(self, basedir):
+    """Returns the gs:// url of the bootstraps of |basedir|."""
+    return self._path(basedir).rstrip('/')
+
+  def list(self, basedir):
+    prefix = self._path(basedir)
+    code, ls_out, ls_err = self.gsutil.check_call('ls', prefix)
+    if code:
+      logging.warning('gsutil ls %s failed:\n%s', prefix, ls_err)
+    return [name[len(prefix):] for name in ls_out.strip().splitlines()
+            if name.startswith(prefix)]
+
+  def list_files(self, basedir, name):
+    prefix = self._path(basedir)
+    code, ls_out, ls_err = self.gsutil.check_call(
+        'ls', '-l', '-r', self._path(basedir, name))
+    if code:
+      raise IOError('gsutil ls %s failed:\n%s' % (prefix + name, ls_err))
+    files = []
+    for line in ls_out.splitlines():
+      m = re.match(r'^\s*\d+\s+\S+\s+(gs://\S+)$', line)
+      if m and m.group(1).startswith(prefix) and not m.group(1).endswith('/'):
+        files.append((m.group(1)[len(prefix):], None))
+    return files
+
+  def download_file(self, basedir, path, dest):
+    if self.gsutil.call('cp', self._path(basedir, path), dest):
+      raise IOError('gsutil cp %s failed' % self._path(basedir, path))
+
+
+class LocalBootstrapSource(BootstrapSource):
+  """Bootstraps from a local or network-mounted directory."""
+
+  def _path(self, basedir, name=''):
+    return os.path.join(self.root, basedir, name)
+
+  def list(self, basedir):
+    path = self._path(basedir)
+    try:
+      names = os.listdir(path)
+    except OSError:
+      return []
+    return [n + '/' if os.path.isdir(os.path.join(path, n)) else n
+            for n in names]
+
+  def list_files(self, basedir, name):
+    base = self._path(basedir)
+    if not name.endswith('/'):
+      return [(name, os.path.getsize(os.path.join(base, name)))]
+    files = []
+    for root, _, names in os.walk(os.path.join(base, name)):
+      for n in names:
+        path = os.path.join(root, n)
+        files.append((os.path.relpath(path, base).replace(os.sep, '/'),
+                      os.path.getsize(path)))
+    return files
+
+  def download_file(self, basedir, path, dest):
+    shutil.copyfile(self._path(basedir, path), dest)
+
+  def download_range(self, basedir, path, start, end, out):
+    with open(self._path(basedir, path), 'rb') as f:
+      f.seek(start)
+      while start < end:
+        data = f.read(min(1024 * 1024, end - start))
+        if not data:
+          raise IOError('%s is truncated' % self._path(basedir, path))
+        out.write(data)
+        start += len(data)
+
+
+class HttpBootstrapSource(BootstrapSource):
+  """Bootstraps from a plain HTTP(S) server.
+
+  The server must list directories, the way Apache, nginx autoindex or
+  `python -m http.server` do. Files are downloaded in chunks if the server
+  supports range requests.
+  """
+
+  def _url(self, basedir, name=''):
+    return '%s/%s/%s' % (self.root, basedir, urlparse.quote(name))
+
+  @staticmethod
+  def _list_url(url):
+    try:
+      page = urllib.urlopen(url).read().decode('utf-8', 'replace')
+    except (urllib.URLError, IOError) as e:
+      logging.warning('Listing %s failed: %s', url, e)
+      return []
+    names = set()
+    for href in re.findall(r'href="([^"?#]+)"', page):
+      href = urlparse.unquote(href)
+      # Skip parent directories and links elsewhere.
+      if href.startswith(('/', '.')) or ':' in href or '/' in href[:-1]:
+        continue
+      names.add(href)
+    return sorted(names)
+
+  def list(self, basedir):
+    return self._list_url(self._url(basedir))
+
+  def _file_size(self, url):
+    request = urllib.Request(url)
+    request.get_method = lambda: 'HEAD'
+    response = urllib.urlopen(request)
+    size = response.info().get('Content-Length')
+    if response.info().get('Accept-Ranges') != 'bytes' or not size:
+      return None
+    return int(size)
+
+  def list_files(self, basedir, name):
+    if not name.endswith('/'):
+      return [(name, self._file_size(self._url(basedir, name)))]
+    files = []
+    for entry in self._list_url(self._url(basedir, name)):
+      if entry.endswith('/'):
+        files.extend(self.list_files(basedir, name + entry))
+      else:
+        files.append((name + entry,
+                      self._file_size(self._url(basedir, name + entry))))
+    return files
+
+  def download_file(self, basedir, path, dest):
+    response = urllib.urlopen(self._url(basedir, path))
+    with open(dest, 'wb') as f:
+      shutil.copyfileobj(response, f)
+
+  def download_range(self, basedir, path, start, end, out):
+    request = urllib.Request(self._url(basedir, path))
+    request.add_header('Range', 'bytes=%d-%d' % (start, end - 1))
+    response = urllib.urlopen(request)
+    if response.getcode() != 206:
+      raise IOError('%s ignored the range request' % self._url(basedir, path))
+    while start < end:
+      data = response.read(min(1024 * 1024, end - start))
+      if not data:
+        raise IOError('Download of %s was cut short' %
+                      self._url(basedir, path))
+      out.write(data)
+      start += len(data)
+
+
+def _VerifyPack(pack_path, idx_path):
+  """Checks that the pack and its index are complete and match each other.
+
+  Both files end with their own SHA-1, and the index also holds the SHA-1 of
+  its pack right before it. Raises IOError if something doesn't match.
+  """
+  def digest(path):
+    h = hashlib.sha1()
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+      remaining = size - 20
+      while remaining > 0:
+        data = f.read(min(1024 * 1024, remaining))
+        if not data:
+          break
+        h.update(data)
+        remaining -= len(data)
+      trailer = f.read(20)
+    return h.digest(), trailer
+
+  pack_digest, pack_trailer = digest(pack_path)
+  if pack_digest != pack_trailer:
+    raise IOError('%s is corrupt' % pack_path)
+  idx_digest, idx_trailer = digest(idx_path)
+  if idx_digest != idx_trailer:
+    raise IOError('%s is corrupt' % idx_path)
+  with open(idx_path, 'rb') as f:
+    f.seek(-40, os.SEEK_END)
+    if f.read(20) != pack_trailer:
+      raise IOError('%s does not match %s' % (idx_path, pack_path))
+
+
+class BootstrapDownloader(object):
+  """Downloads a generation of a repo from a BootstrapSource.
+
+  Large files are downloaded in chunks, in parallel, next to their final
+  location. An interrupted download is resumed when started again with the
+  same destination: finished files and chunks are kept. Packs are checked
+  against their index before being renamed into place.
+  """
+
+  CHUNK_SIZE = 64 * 1024 * 1024
+
+  def __init__(self, source, basedir, jobs=8, rename=os.rename,
+               print_func=print):
+    self.source = source
+    self.basedir = basedir
+    self.jobs = jobs
+    self.rename = rename
+    self.print = print_func
+
+  def _local_path(self, dest, path):
+    # Files of a <N>/ generation go in |dest| directly.
+    return os.path.join(dest, *path.split('/')[1:] or [path])
+
+  def _tasks(self, path, size, local_path):
+    partial = local_path + '.download'
+    if not size or not self.CHUNK_SIZE or size <= self.CHUNK_SIZE:
+      return [(path, None, None, partial)]
+    return [(path, start, min(start + self.CHUNK_SIZE, size),
+             '%s.%d' % (partial, start))
+            for start in range(0, size, self.CHUNK_SIZE)]
+
+  def _run_task(self, task):
+    path, start, end, partial = task
+    if start is None:
+      if not os.path.exists(partial):
+        self.source.download_file(self.basedir, path, partial + '.tmp')
+        os.rename(partial + '.tmp', partial)
+      return
+    done = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if done > end - start:
+      os.remove(partial)
+      done = 0
+    if done < end - start:
+      with open(partial, 'ab') as out:
+        self.source.download_range(self.basedir, path, start + done, end, out)
+
+  def _assemble(self, tasks, partial):
+    """Concatenates the chunks of a file into |partial|."""
+    if len(tasks) == 1:
+      return
+    with open(partial + '.tmp', 'wb') as out:
+      for _, _, _, chunk in tasks:
+        with open(chunk, 'rb') as f:
+          shutil.copyfileobj(f, out)
+    os.rename(partial + '.tmp', partial)
+    for _, _, _, chunk in tasks:
+      os.remove(chunk)
+
+  def download(self, name, dest):
+    """Downloads the generation |name| into the directory |dest|."""
+    files = []
+    for path, size in self.source.list_files(self.basedir, name):
+      local_path = self._local_path(dest, path)
+      if not os.path.exists(local_path):
+        files.append((path, size, local_path))
+    self.print('Downloading %d files of %s/%s/%s.' % (
+        len(files), self.source, self.basedir, name))
+
+    tasks = {}
+    for path, size, local_path in files:
+      gclient_utils.safe_makedirs(os.path.dirname(local_path))
+      tasks[path] = self._tasks(path, size, local_path)
+    _RunInParallel(self._run_task, sum(tasks.values(), []), self.jobs)
+
+    partials = {}
+    for path, _, local_path in files:
+      self._assemble(tasks[path], local_path + '.download')
+      partials[local_path] = local_path + '.download'
+
+    def partial_or_final(local_path):
+      return partials.get(local_path, local_path)
+
+    packs = set(os.path.splitext(p)[0] for p in partials
+                if p.endswith(('.pack', '.idx')))
+    for pack in sorted(packs):
+      try:
+        _VerifyPack(partial_or_final(pack + '.pack'),
+                    partial_or_final(pack + '.idx'))
+      except (IOError, OSError):
+        # Download both of them again next time, including one which was
+        # already in place or is missing.
+        for path in (pack + '.pack', pack + '.idx'):
+          for p in (partial_or_final(path), path):
+            if os.path.exists(p):
+              os.remove(p)
+        raise
+    for local_path, partial in sorted(partials.items()):
+      self.rename(partial, local_path)
+
+
 class Mirror(object):
 
   git_exe = 'git.bat' if sys.platform.startswith('win') else 'git'
@@ -93,6 +515,37 @@ class Mirror(object):
   # Used for tests
   _GIT_CONFIG_LOCATION = []
 
+  # The values of the cache.<url>.<key> git configs, by key and then by mirror
+  # url, or None for keys which aren't set for any url. See _get_url_config().
+  _url_configs = {}
+  url_configs_lock = threading.Lock()
+
+  # Records when the mirror was last fetched, and what, along with a counter
+  # incremented by every fetch. See populate().
+  FETCH_STATE_FILE = 'gclient-fetch-state.json'
+
+  # Touched whenever the mirror is used, so that `git cache gc` can evict the
+  # least recently used mirrors first.
+  ACCESS_STAMP_FILE = 'gclient-access-stamp'
+
+  # Holds a file per checkout borrowing objects from the mirror, naming the
+  # checkout's git dir. See register_checkout(). It is created with the
+  # mirror; mirrors created before checkouts were registered may have
+  # unregistered checkouts, and get UNTRACKED_CHECKOUTS_FILE in it instead.
+  CHECKOUTS_DIR = 'gclient-checkouts'
+  UNTRACKED_CHECKOUTS_FILE = '.untracked'
+
+  # Registered checkouts not cloned yet are considered live for this long.
+  CHECKOUT_CLONE_GRACE_PERIOD = 60 * 60
+
+  # Existing mirrors not fetched for this long are first brought up to date
+  # with incremental bundles from their bootstrap source, if there are any.
+  INCREMENTAL_BOOTSTRAP_AGE = 24 * 60 * 60
+
+  # Partial mirrors are fetched without any blob; checkouts fetch the blobs
+  # they need from the origin on demand.
+  PARTIAL_CLONE_FILTER = 'blob:none'
+
   @staticmethod
   def parse_fetch_spec(spec):
     """Parses and canonicalizes a fetch spec.
@@ -142,8 +595,160 @@ class Mirror(object):
     # Not recognized.
     return None
 
+  def _get_url_config(self, key):
+    """Returns the value of the git config cache.<url>.<key> whose url best
+    matches the url of the mirror, or None.
+
+    Values are read once per process, and git is only run per url for keys set
+    for some url.
+    """
+    # Mirrors are populated and listed from several threads.
+    with Mirror.url_configs_lock:
+      if key not in Mirror._url_configs:
+        try:
+          subprocess.check_output(
+              [self.git_exe, 'config'] + self._GIT_CONFIG_LOCATION +
+              ['--get-regexp', r'^cache\.(.*\.)?%s$' % key.lower()])
+          Mirror._url_configs[key] = {}
+        except subprocess.CalledProcessError:
+          Mirror._url_configs[key] = None
+      configs = Mirror._url_configs[key]
+      if configs is None:
+        return None
+      if self.url not in configs:
+        try:
+          configs[self.url] = subprocess.check_output(
+              [self.git_exe, 'config'] + self._GIT_CONFIG_LOCATION +
+              ['--get-urlmatch', 'cache.' + key, self.url]
+          ).decode('utf-8', 'ignore').strip() or None
+        except subprocess.CalledProcessError:
+          configs[self.url] = None
+      return configs[self.url]
+
+  @property
+  def objects_from(self):
+    """Returns the Mirror this one borrows objects from, or None.
+
+    Forks and aliases of a repo are configured with the cache.<url>.objectsFrom
+    git config, e.g. cache.https://example.com/fork.objectsFrom set to
+    https://example.com/project, so that populating the fork only fetches the
+    objects missing from the project's mirror.
+    """
+    if not hasattr(self, '_objects_from'):
+      url = self._get_url_config('objectsFrom')
+      other = Mirror(url) if url else None
+      # Borrowing in a cycle would leave no mirror with the objects.
+      seen = set([self.mirror_path])
+      mirror = other
+      while mirror:
+        if mirror.mirror_path in seen:
+          logging.warning('%s borrows objects from %s in a cycle, ignoring.',
+                          self.url, mirror.url)
+          other = None
+          break
+        seen.add(mirror.mirror_path)
+        url = mirror._get_url_config('objectsFrom')
+        mirror = Mirror(url) if url else None
+      self._objects_from = other
+    return self._objects_from
+
+  def _borrows_objects(self):
+    return bool(self.objects_from and self.objects_from.exists())
+
+  @contextlib.contextmanager
+  def _lock_borrowed_objects(self, timeout):
+    """Keeps the mirror borrowed from from being repacked while in use."""
+    if not self._borrows_objects():
+      yield
+      return
+    with self.objects_from.lock(timeout, shared=True):
+      yield
+
+  def _borrow_objects(self):
+    """Points objects/info/alternates to the mirror borrowed from, if any."""
+    if not self._borrows_objects():
+      return
+    objects_dir = os.path.join(self.objects_from.mirror_path, 'objects')
+    alternates_path = os.path.join(
+        self.mirror_path, 'objects', 'info', 'alternates')
+    alternates = []
+    if os.path.exists(alternates_path):
+      alternates = gclient_utils.FileRead(alternates_path).splitlines()
+    if objects_dir not in alternates:
+      self.print('Borrowing objects from %s' % self.objects_from.mirror_path)
+      gclient_utils.safe_makedirs(os.path.dirname(alternates_path))
+      alternates.append(objects_dir)
+      gclient_utils.FileWrite(
+          alternates_path, ''.join(a + '\n' for a in alternates))
+    # Don't let `git cache gc` evict it from under this mirror.
+    self.objects_from.register_checkout(self.mirror_path)
+    # Objects this mirror borrows may only be reachable from refs the mirror
+    # borrowed from had when they were fetched; don't let gc --auto drop them
+    # once they aren't anymore.
+    try:
+      scm.GIT.UpdateConfigFile(
+          os.path.join(self.objects_from.mirror_path, 'config'),
+          [('set', 'gc.pruneExpire', 'never')])
+    except (IOError, OSError, subprocess.CalledProcessError) as e:
+      logging.warning('Could not configure %s to keep unreachable objects: %s',
+                      self.objects_from.mirror_path, e)
+
+  def borrowing_mirrors(self):
+    """Returns the paths of the mirrors borrowing objects from this one.
+
+    They may need objects which are unreachable in this mirror, so it must only
+    ever be fetched into and repacked keeping unreachable objects, never
+    replaced.
+    """
+    cache_path = os.path.realpath(self.GetCachePath())
+    return [path for path in self.live_checkouts(forget=False)
+            if os.path.dirname(os.path.realpath(path)) == cache_path]
+
+  @property
+  def bootstrap_source(self):
+    """Returns the BootstrapSource to bootstrap the mirror from, or None.
+
+    Sources are configured per url with e.g.
+      git config --global cache.https://example.com/.bootstrapSource <source>
+    where <source> is a gs:// bucket or directory, a local directory or an
+    http(s):// url.
+    """
+    if not hasattr(self, '_bootstrap_source'):
+      source = None
+      spec = self._bootstrap_spec()
+      if spec:
+        if spec.startswith('gs://'):
+          source = self._gcs_bootstrap_source(spec)
+        elif spec.startswith(('http://', 'https://')):
+          source = HttpBootstrapSource(spec)
+        else:
+          if spec.startswith('file://'):
+            spec = spec[len('file://'):]
+          source = LocalBootstrapSource(os.path.expanduser(spec))
+      elif self.bootstrap_bucket:
+        source = self._gcs_bootstrap_source(self.bootstrap_bucket)
+      self._bootstrap_source = source
+    return self._bootstrap_source
+
+  def _bootstrap_spec(self):
+    """Returns the bootstrapSource configured for the url, or None."""
+    if os.getenv('OVERRIDE_BOOTSTRAP_BUCKET'):
+      return None
+    return self._get_url_config('bootstrapSource')
+
+  def _gcs_bootstrap_source(self, root):
+    if not os.path.exists(self.gsutil_exe):
+      logging.warning('Not bootstrapping %s from %s: gsutil not found in %s',
+                      self.url, root, self.gsutil_exe)
+      return None
+    return GcsBootstrapSource(root, self.gsutil_exe)
+
   @property
   def _gs_path(self):
+    # Upload where bootstraps are downloaded from.
+    spec = self._bootstrap_spec()
+    if spec and spec.startswith('gs://'):
+      return GcsBootstrapSource(spec, self.gsutil_exe).url(self.basedir)
     return 'gs://%s/v2/%s' % (self.bootstrap_bucket, self.basedir)
 
   @classmethod
@@ -225,6 +830,160 @@ class Mirror(object):
         name='rename [%s] => [%s]' % (src, dst),
         printerr=self.print)
 
+  @property
+  def _fetch_state_path(self):
+    return os.path.join(self.mirror_path, self.FETCH_STATE_FILE)
+
+  def read_fetch_state(self):
+    """Returns the state recorded by the last successful fetch, or {}."""
+    try:
+      return json.loads(gclient_utils.FileRead(self._fetch_state_path))
+    except (IOError, OSError, ValueError):
+      return {}
+
+  def _write_fetch_state(self, state):
+    tmp_path = self._fetch_state_path + '.tmp'
+    gclient_utils.FileWrite(tmp_path, json.dumps(state))
+    getattr(os, 'replace', os.rename)(tmp_path, self._fetch_state_path)
+
+  def is_fresh(self, ttl):
+    """Returns true if the mirror was fetched less than |ttl| seconds ago,
+    including all the refs this Mirror was asked for."""
+    state = self.read_fetch_state()
+    last_fetch = state.get('last_fetch')
+    if last_fetch is None or not 0 <= time.time() - last_fetch <= ttl:
+      return False
+    return self.has_fetched_refs(state)
+
+  def has_fetched_refs(self, state=None):
+    """Returns true if the last fetch, whose |state| is read if not given,
+    included all the refs this Mirror was asked for."""
+    if state is None:
+      state = self.read_fetch_state()
+    fetched_specs = set(state.get('fetch_specs', []))
+    return all(spec in fetched_specs for spec, _ in self.fetch_specs)
+
+  def _fetched_while_waiting(self, generation, depth):
+    """Returns true if another process fetched everything this Mirror needs,
+    at least |depth| deep, since the fetch state had |generation|.
+
+    Must be called with the mirror lock held.
+    """
+    state = self.read_fetch_state()
+    if state.get('generation', 0) <= generation:
+      return False
+    if state.get('depth') and (not depth or state['depth'] < depth):
+      return False
+    if not self.has_fetched_refs(state):
+      return False
+    return all(self._contains_revision(c) for c in self.fetch_commits)
+
+  def touch(self):
+    """Records that the mirror was just used."""
+    path = os.path.join(self.mirror_path, self.ACCESS_STAMP_FILE)
+    try:
+      with open(path, 'a'):
+        pass
+      os.utime(path, None)
+    except (IOError, OSError) as e:
+      logging.warning('Could not update %s: %s', path, e)
+
+  def last_access(self):
+    """Returns when the mirror was last used, as a timestamp."""
+    for name in (self.ACCESS_STAMP_FILE, 'config'):
+      try:
+        return os.path.getmtime(os.path.join(self.mirror_path, name))
+      except OSError:
+        pass
+    return 0
+
+  def register_checkout(self, git_dir):
+    """Records that the checkout at |git_dir| borrows objects from the mirror.
+
+    This should be called before cloning, so that the mirror isn't evicted
+    while it is cloned from.
+    """
+    git_dir = os.path.abspath(git_dir)
+    checkouts_dir = os.path.join(self.mirror_path, self.CHECKOUTS_DIR)
+    path = os.path.join(
+        checkouts_dir,
+        hashlib.sha1(git_dir.encode('utf-8', 'replace')).hexdigest())
+    if os.path.exists(path):
+      return
+    try:
+      if not os.path.isdir(checkouts_dir):
+        gclient_utils.safe_makedirs(checkouts_dir)
+        gclient_utils.FileWrite(
+            os.path.join(checkouts_dir, self.UNTRACKED_CHECKOUTS_FILE), '')
+      gclient_utils.FileWrite(path, git_dir)
+    except (IOError, OSError) as e:
+      logging.warning('Could not register checkout %s: %s', git_dir, e)
+
+  def tracks_checkouts(self):
+    """Returns true if all the checkouts of the mirror made by gclient were
+    registered, i.e. it was created after checkouts started being registered.
+
+    Checkouts cloned outside of gclient are never registered.
+    """
+    checkouts_dir = os.path.join(self.mirror_path, self.CHECKOUTS_DIR)
+    return (os.path.isdir(checkouts_dir) and not os.path.exists(
+        os.path.join(checkouts_dir, self.UNTRACKED_CHECKOUTS_FILE)))
+
+  def live_checkouts(self, forget=True):
+    """Returns the git dirs of the checkouts still borrowing objects from the
+    mirror through their objects/info/alternates, or which are worktrees of
+    it. Unless |forget| is false, the others are unregistered."""
+    checkouts_dir = os.path.join(self.mirror_path, self.CHECKOUTS_DIR)
+    try:
+      names = os.listdir(checkouts_dir)
+    except OSError:
+      return []
+    objects_dir = os.path.realpath(os.path.join(self.mirror_path, 'objects'))
+    remove = os.remove if forget else lambda _path: None
+    live = []
+    for name in names:
+      if name == self.UNTRACKED_CHECKOUTS_FILE:
+        continue
+      path = os.path.join(checkouts_dir, name)
+      try:
+        git_dir = gclient_utils.FileRead(path).strip()
+        registered = os.path.getmtime(path)
+      except (IOError, OSError):
+        continue
+      if not os.path.exists(git_dir):
+        if time.time() - registered < self.CHECKOUT_CLONE_GRACE_PERIOD:
+          # Probably being cloned.
+          live.append(git_dir)
+        else:
+          remove(path)
+        continue
+      if os.path.isfile(git_dir):
+        # The .git file of a worktree of the mirror.
+        try:
+          worktree_dir = gclient_utils.FileRead(git_dir).strip()
+        except (IOError, OSError):
+          continue
+        worktree_dir = os.path.realpath(os.path.join(
+            os.path.dirname(git_dir), worktree_dir[len('gitdir:'):].strip()))
+        if (worktree_dir.startswith(os.path.realpath(self.mirror_path) + os.sep)
+            and os.path.isdir(worktree_dir)):
+          live.append(git_dir)
+        else:
+          remove(path)
+        continue
+      try:
+        alternates = gclient_utils.FileRead(
+            os.path.join(git_dir, 'objects', 'info', 'alternates'))
+      except (IOError, OSError):
+        remove(path)
+        continue
+      if any(os.path.realpath(line.strip()) == objects_dir
+             for line in alternates.splitlines() if line.strip()):
+        live.append(git_dir)
+      else:
+        remove(path)
+    return live
+
   def RunGit(self, cmd, **kwargs):
     """Run git in a subprocess."""
     cwd = kwargs.setdefault('cwd', self.mirror_path)
@@ -240,76 +999,84 @@ class Mirror(object):
     if cwd is None:
       cwd = self.mirror_path
 
+    changes = []
     if reset_fetch_config:
-      try:
-        self.RunGit(['config', '--unset-all', 'remote.origin.fetch'], cwd=cwd)
-      except subprocess.CalledProcessError as e:
-        # If exit code was 5, it means we attempted to unset a config that
-        # didn't exist. Ignore it.
-        if e.returncode != 5:
-          raise
+      changes.append(('unset', 'remote.origin.fetch'))
 
     # Don't run git-gc in a daemon.  Bad things can happen if it gets killed.
-    try:
-      self.RunGit(['config', 'gc.autodetach', '0'], cwd=cwd)
-    except subprocess.CalledProcessError:
-      # Hard error, need to clobber.
-      raise ClobberNeeded()
+    changes.append(('set', 'gc.autodetach', '0'))
 
     # Don't combine pack files into one big pack file.  It's really slow for
     # repositories, and there's no way to track progress and make sure it's
     # not stuck.
     if self.supported_project():
-      self.RunGit(['config', 'gc.autopacklimit', '0'], cwd=cwd)
+      changes.append(('set', 'gc.autopacklimit', '0'))
 
     # Allocate more RAM for cache-ing delta chains, for better performance
     # of "Resolving deltas".
-    self.RunGit(['config', 'core.deltaBaseCacheLimit',
-                 gclient_utils.DefaultDeltaBaseCacheLimit()], cwd=cwd)
+    changes.append(('set', 'core.deltaBaseCacheLimit',
+                    gclient_utils.DefaultDeltaBaseCacheLimit()))
 
-    self.RunGit(['config', 'remote.origin.url', self.url], cwd=cwd)
-    self.RunGit(['config', '--replace-all', 'remote.origin.fetch',
-                 '+refs/heads/*:refs/heads/*', r'\+refs/heads/\*:.*'], cwd=cwd)
+    changes.append(('set', 'remote.origin.url', self.url))
+    changes.append(('replace', 'remote.origin.fetch',
+                    '+refs/heads/*:refs/heads/*', r'\+refs/heads/\*:.*'))
     for spec, value_regex in self.fetch_specs:
-      self.RunGit(
-          ['config', '--replace-all', 'remote.origin.fetch', spec, value_regex],
-          cwd=cwd)
+      changes.append(('replace', 'remote.origin.fetch', spec, value_regex))
+
+    # Only run git when the mirror isn't configured yet.
+    try:
+      if scm.GIT.UpdateConfigFile(os.path.join(cwd, 'config'), changes):
+        self.print('Updated git config in "%s"' % cwd)
+    except (IOError, OSError, subprocess.CalledProcessError):
+      # Hard error, need to clobber.
+      raise ClobberNeeded()
 
   def bootstrap_repo(self, directory):
-    """Bootstrap the repo from Google Storage if possible.
+    """Bootstrap the repo from its bootstrap source if possible.
 
     More apt-ly named bootstrap_repo_from_cloud_if_possible_else_do_nothing().
     """
-    if not self.bootstrap_bucket:
+    source = self.bootstrap_source
+    if not source:
       return False
 
-    gsutil = Gsutil(self.gsutil_exe, boto_path=None)
-
     # Get the most recent version of the directory.
     # This is determined from the most recent version of a .ready file.
     # The .ready file is only uploaded when an entire directory has been
-    # uploaded to GS.
-    _, ls_out, ls_err = gsutil.check_call('ls', self._gs_path)
-    ls_out_set = set(ls_out.strip().splitlines())
-    latest_dir = self._GetMostRecentCacheDirectory(ls_out_set)
+    # uploaded.
+    latest = source.latest(self.basedir)
+    if not latest:
+      self.print('No bootstrap file for %s found in %s' %
+                 (self.mirror_path, source))
+      return False
 
-    if not latest_dir:
-      self.print('No bootstrap file for %s found in %s, stderr:\n  %s' %
-                 (self.mirror_path, self.bootstrap_bucket,
-                '  '.join((ls_err or '').splitlines(True))))
+    # Partial downloads are kept, per generation, so that they can be resumed.
+    partial_root = os.path.join(
+        self.GetCachePath(), '_cache_tmp_bootstrap', self.basedir)
+    generation = latest.rstrip('/')
+    tempdir = os.path.join(partial_root, generation)
+    if os.path.isdir(partial_root):
+      for stale in os.listdir(partial_root):
+        if stale != generation:
+          gclient_utils.rmtree(os.path.join(partial_root, stale))
+    gclient_utils.safe_makedirs(tempdir)
+
+    downloader = BootstrapDownloader(source, self.basedir, rename=self.Rename,
+                                     print_func=self.print)
+    try:
+      with self.print_duration_of('download'):
+        downloader.download(latest, tempdir)
+    except (IOError, OSError) as e:
+      self.print('Download of %s failed, it will be resumed next time: %s' %
+                 (latest, e), file=sys.stderr)
       return False
 
     try:
-      # create new temporary directory locally
-      tempdir = tempfile.mkdtemp(prefix='_cache_tmp', dir=self.GetCachePath())
       self.RunGit(['init', '--bare'], cwd=tempdir)
-      self.print('Downloading files in %s/* into %s.' %
-                 (latest_dir, tempdir))
-      with self.print_duration_of('download'):
-        code = gsutil.call('-m', 'cp', '-r', latest_dir + "/*",
-                           tempdir)
-      if code:
-        return False
+      if latest.endswith('.bundle'):
+        bundle = os.path.join(tempdir, latest)
+        self.RunGit(['fetch', bundle, '+refs/*:refs/*'], cwd=tempdir)
+        os.remove(bundle)
       # A quick validation that all references are valid.
       self.RunGit(['for-each-ref'], cwd=tempdir)
     except Exception as e:
@@ -320,9 +1087,148 @@ class Mirror(object):
     if os.path.exists(directory):
       gclient_utils.rmtree(directory)
     self.Rename(tempdir, directory)
+    for path in (partial_root, os.path.dirname(partial_root)):
+      try:
+        os.rmdir(path)
+      except OSError:
+        break
+    return True
+
+  def _has_objects(self, objects):
+    """Returns true if the mirror has all of |objects|."""
+    return not self._missing_objects(objects)
+
+  def _missing_objects(self, objects):
+    """Returns the set of |objects| the mirror doesn't have."""
+    objects = list(objects)
+    proc = subprocess.Popen(
+        [self.git_exe, 'cat-file', '--batch-check'], stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, cwd=self.mirror_path)
+    out, _ = proc.communicate(''.join(o + '\n' for o in objects).encode())
+    if proc.returncode:
+      return set(objects)
+    return set(line.split()[0].decode('utf-8', 'ignore')
+               for line in out.splitlines() if line.endswith(b' missing'))
+
+  def _fetched_long_ago(self):
+    """Returns true if the mirror was last fetched more than
+    INCREMENTAL_BOOTSTRAP_AGE ago.
+
+    Mirrors last fetched by older versions have no fetch state, FETCH_HEAD
+    tells when they were instead. If there is neither, returns False.
+    """
+    last_fetch = self.read_fetch_state().get('last_fetch')
+    if last_fetch is None:
+      try:
+        last_fetch = os.path.getmtime(
+            os.path.join(self.mirror_path, 'FETCH_HEAD'))
+      except OSError:
+        return False
+    return time.time() - last_fetch > self.INCREMENTAL_BOOTSTRAP_AGE
+
+  def _bootstrap_incrementally(self):
+    """Brings the existing mirror up to date with the fewest incremental
+    bundles from its bootstrap source, if possible. Returns True if some were
+    applied.
+
+    Generation <N> of a repo has bundles <N>.from-<M>.bundle of what it has
+    on top of earlier generations <M>, whose refs are listed in <M>.refs.
+    """
+    source = self.bootstrap_source
+    if not source:
+      return False
+    names = set(source.list(self.basedir))
+    bundles = {}
+    for name in names:
+      m = re.match(r'^(\d+)\.from-(\d+)\.bundle$', name)
+      if m and m.group(1) + '.ready' in names:
+        bundles.setdefault(int(m.group(2)), []).append(int(m.group(1)))
+    if not bundles:
+      return False
+    latest = max(max(targets) for targets in bundles.values())
+
+    partial_root = os.path.join(
+        self.GetCachePath(), '_cache_tmp_bootstrap', self.basedir)
+    tempdir = os.path.join(partial_root, 'incremental')
+    gclient_utils.safe_makedirs(tempdir)
+    downloader = BootstrapDownloader(source, self.basedir, rename=self.Rename,
+                                     print_func=self.print)
+
+    def has_generation(generation):
+      name = '%d.refs' % generation
+      if name not in names:
+        return False
+      path = os.path.join(tempdir, name)
+      try:
+        source.download_file(self.basedir, name, path)
+        refs = gclient_utils.FileRead(path)
+      except (IOError, OSError):
+        return False
+      finally:
+        if os.path.exists(path):
+          os.remove(path)
+      return self._has_objects(
+          line.split()[0] for line in refs.splitlines() if line.strip())
+
+    try:
+      if has_generation(latest):
+        return False
+      # Start from the newest generation the mirror has, and take the chain
+      # of bundles with the fewest hops from there.
+      chain = None
+      for start in sorted(bundles, reverse=True):
+        if not has_generation(start):
+          continue
+        paths = {start: []}
+        queue = [start]
+        while queue and latest not in paths:
+          current = queue.pop(0)
+          for target in sorted(bundles.get(current, []), reverse=True):
+            if target not in paths:
+              paths[target] = paths[current] + [
+                  '%d.from-%d.bundle' % (target, current)]
+              queue.append(target)
+        chain = paths.get(latest)
+        break
+      if not chain:
+        return False
+
+      self.print('Bringing %s up to date with %s' % (
+          self.mirror_path, ', '.join(chain)))
+      for name in chain:
+        with self.print_duration_of('download'):
+          downloader.download(name, tempdir)
+        bundle = os.path.join(tempdir, name)
+        self.RunGit(['fetch', bundle, '+refs/*:refs/*'])
+        os.remove(bundle)
+    except (IOError, OSError, subprocess.CalledProcessError) as e:
+      self.print('Incremental bootstrap failed, fetching instead: %s' % e,
+                 file=sys.stderr)
+      return False
+    finally:
+      for path in (tempdir, partial_root, os.path.dirname(partial_root)):
+        try:
+          os.rmdir(path)
+        except OSError:
+          break
     return True
 
-  def contains_revision(self, revision):
+  def lock(self, timeout=0, shared=False):
+    """Locks the mirror. Fetches take an exclusive lock; readers, e.g. clones
+    from the mirror, take a shared one so they may run concurrently."""
+    return lockfile.lock(self.mirror_path, timeout, shared=shared)
+
+  def contains_revision(self, revision, lock_timeout=0):
+    try:
+      with self.lock(lock_timeout, shared=True):
+        if self.exists():
+          self.touch()
+        return self._contains_revision(revision)
+    except lockfile.LockError:
+      # The mirror is being fetched; let the caller update it instead.
+      return False
+
+  def _contains_revision(self, revision):
     if not self.exists():
       return False
 
@@ -343,9 +1249,31 @@ class Mirror(object):
   def exists(self):
     return os.path.isfile(os.path.join(self.mirror_path, 'config'))
 
+  def has_worktrees(self):
+    """Returns true if checkouts are worktrees of the mirror, in which case it
+    must be fetched into, never replaced."""
+    try:
+      return bool(os.listdir(os.path.join(self.mirror_path, 'worktrees')))
+    except OSError:
+      return False
+
+  def is_partial(self):
+    """Returns true if the mirror was populated with partial_clone, i.e. is
+    missing blobs."""
+    if not self.exists():
+      return False
+    try:
+      config = scm.GIT.ReadConfigFile(os.path.join(self.mirror_path, 'config'))
+    except (IOError, OSError, subprocess.CalledProcessError):
+      return False
+    return any(key == 'remote.origin.partialclonefilter' for key, _ in config)
+
   def supported_project(self):
     """Returns true if this repo is known to have a bootstrap zip file."""
     u = urlparse.urlparse(self.url)
+    # Whether or not the source can be used here, e.g. without gsutil.
+    if self.bootstrap_bucket or self._bootstrap_spec():
+      return True
     return u.netloc in [
         'chromium.googlesource.com',
         'chrome-internal.googlesource.com']
@@ -370,24 +1298,112 @@ class Mirror(object):
           '%s and "git cache fetch" again.' %
           os.path.join(self.mirror_path, 'config'))
 
+  def needs_bootstrap(self, pack_files):
+    """Returns true if the mirror must be (re-)bootstrapped, given its
+    |pack_files| once repacked."""
+    if not self.exists():
+      return True
+    if not (len(pack_files) > GC_AUTOPACKLIMIT or
+            (len(pack_files) == 0 and not self._borrows_objects())):
+      return False
+    if self.has_worktrees():
+      # Bootstrapping replaces the mirror, and the worktrees with it.
+      logging.warning('Not re-bootstrapping %s, checkouts are worktrees of it.',
+                      self.mirror_path)
+      return False
+    if self.borrowing_mirrors():
+      # And the objects they borrow.
+      logging.warning('Not re-bootstrapping %s, other mirrors borrow its '
+                      'objects.', self.mirror_path)
+      return False
+    return True
+
+  def _pack_files(self):
+    pack_dir = os.path.join(self.mirror_path, 'objects', 'pack')
+    if not os.path.isdir(pack_dir):
+      return []
+    return [f for f in os.listdir(pack_dir) if f.endswith('.pack')]
+
+  def repack(self):
+    """Brings the number of packs down locally, without downloading anything.
+
+    Packs are merged geometrically, so that only the small, recent packs are
+    rewritten, and a multi-pack-index with a bitmap is written over the rest.
+    Returns False if repacking failed.
+    """
+    before = len(self._pack_files())
+    shallow = os.path.exists(os.path.join(self.mirror_path, 'shallow'))
+    # Merge the packs so that each one is at least twice as big as the next
+    # smaller one. Bitmaps don't work with shallow repositories.
+    repack_cmd = ['repack', '-d', '-l', '--geometric=2', '--write-midx']
+    if not shallow:
+      repack_cmd.append('--write-bitmap-index')
+    try:
+      with self.print_duration_of('repack'):
+        self.RunGit(repack_cmd)
+    except subprocess.CalledProcessError:
+      # Git older than 2.33 can't repack geometrically; rewrite everything into
+      # a single pack instead.
+      logging.warning('Geometric repack of %s failed, repacking fully.',
+                      self.mirror_path)
+      repack_cmd = ['repack', '-a', '-d', '-l']
+      if self.borrowing_mirrors():
+        repack_cmd.append('--keep-unreachable')
+      if not shallow:
+        repack_cmd.append('--write-bitmap-index')
+      try:
+        with self.print_duration_of('repack'):
+          self.RunGit(repack_cmd)
+      except subprocess.CalledProcessError:
+        logging.warning('Repack of %s failed.', self.mirror_path)
+        return False
+    self.print('Repacked %s from %d to %d .pack files.' % (
+        self.mirror_path, before, len(self._pack_files())))
+    return True
+
+  def maintain(self):
+    """Removes stale temporary packs, repacks the mirror and writes a
+    commit-graph, which speed up fetches and rev-lists of every checkout
+    borrowing objects from the mirror. Returns False if a step failed."""
+    self.DeleteTmpPackFiles(self.mirror_path)
+    try:
+      # Forget the worktrees of deleted checkouts.
+      self.RunGit(['worktree', 'prune'])
+    except subprocess.CalledProcessError:
+      logging.warning('Pruning the worktrees of %s failed.', self.mirror_path)
+    ok = self.repack()
+    try:
+      with self.print_duration_of('commit-graph write'):
+        # Split commit-graphs are updated incrementally, like the packs.
+        self.RunGit(['commit-graph', 'write', '--reachable', '--split'])
+    except subprocess.CalledProcessError:
+      logging.warning('Writing the commit-graph of %s failed.',
+                      self.mirror_path)
+      ok = False
+    return ok
+
   def _ensure_bootstrapped(
       self, depth, bootstrap, reset_fetch_config, force=False):
-    pack_dir = os.path.join(self.mirror_path, 'objects', 'pack')
-    pack_files = []
-    if os.path.isdir(pack_dir):
-      pack_files = [f for f in os.listdir(pack_dir) if f.endswith('.pack')]
-      self.print('%s has %d .pack files, re-bootstrapping if >%d or ==0' %
-                (self.mirror_path, len(pack_files), GC_AUTOPACKLIMIT))
+    pack_files = self._pack_files()
+    if pack_files:
+      self.print('%s has %d .pack files, repacking if >%d, re-bootstrapping '
+                 'if ==0' % (self.mirror_path, len(pack_files),
+                             GC_AUTOPACKLIMIT))
 
-    should_bootstrap = (force or
-                        not self.exists() or
-                        len(pack_files) > GC_AUTOPACKLIMIT or
-                        len(pack_files) == 0)
+    if (not force and self.exists() and len(pack_files) > GC_AUTOPACKLIMIT and
+        self.repack()):
+      pack_files = self._pack_files()
+
+    should_bootstrap = force or self.needs_bootstrap(pack_files)
 
     if not should_bootstrap:
       if depth and os.path.exists(os.path.join(self.mirror_path, 'shallow')):
         logging.warning(
             'Shallow fetch requested, but repo cache already exists.')
+      elif (not depth and bootstrap and
+            not os.path.exists(os.path.join(self.mirror_path, 'shallow')) and
+            self._fetched_long_ago()):
+        self._bootstrap_incrementally()
       return
 
     if not self.exists():
@@ -401,7 +1417,8 @@ class Mirror(object):
       # Re-bootstrapping an existing mirror; preserve existing fetch spec.
       self._preserve_fetchspec()
 
-    bootstrapped = (not depth and bootstrap and
+    # Bootstrapping would download what is borrowed.
+    bootstrapped = (not depth and bootstrap and not self._borrows_objects() and
                     self.bootstrap_repo(self.mirror_path))
 
     if not bootstrapped:
@@ -424,10 +1441,26 @@ class Mirror(object):
              depth,
              no_fetch_tags,
              reset_fetch_config,
-             prune=True):
+             prune=True,
+             partial=False,
+             refetch=False):
     self.config(rundir, reset_fetch_config)
 
-    fetch_cmd = ['fetch']
+    filter_args = []
+    if partial:
+      filter_args.append('--filter=%s' % self.PARTIAL_CLONE_FILTER)
+    elif refetch:
+      # Turn a partial mirror into a full one, fetching the missing blobs.
+      self.print('Fetching the blobs missing from partial mirror %s' %
+                 self.mirror_path)
+      scm.GIT.UpdateConfigFile(os.path.join(rundir, 'config'), [
+          ('unset', 'remote.origin.promisor'),
+          ('unset', 'remote.origin.partialclonefilter'),
+          ('unset', 'extensions.partialclone'),
+      ])
+      filter_args.append('--refetch')
+
+    fetch_cmd = ['fetch'] + filter_args
     if verbose:
       fetch_cmd.extend(['-v', '--progress'])
     if depth:
@@ -441,22 +1474,55 @@ class Mirror(object):
     fetch_specs = subprocess.check_output(
         [self.git_exe, 'config', '--get-all', 'remote.origin.fetch'],
         cwd=rundir).decode('utf-8', 'ignore').strip().splitlines()
-    for spec in fetch_specs:
-      try:
-        self.print('Fetching %s' % spec)
-        with self.print_duration_of('fetch %s' % spec):
-          self.RunGit(fetch_cmd + [spec], cwd=rundir, retry=True)
-      except subprocess.CalledProcessError:
-        if spec == '+refs/heads/*:refs/heads/*':
-          raise ClobberNeeded()  # Corrupted cache.
-        logging.warning('Fetch of %s failed' % spec)
-    for commit in self.fetch_commits:
-      self.print('Fetching %s' % commit)
-      try:
-        with self.print_duration_of('fetch %s' % commit):
-          self.RunGit(['fetch', 'origin', commit], cwd=rundir, retry=True)
-      except subprocess.CalledProcessError:
-        logging.warning('Fetch of %s failed' % commit)
+    # Fetch all the specs at once to pay for the connection and the ref
+    # negotiation only once. If that fails, fetch them one by one to find out
+    # which one is failing.
+    fetched_specs = list(fetch_specs)
+    if not self._fetch_grouped(fetch_cmd, fetch_specs, rundir):
+      for spec in fetch_specs:
+        try:
+          self.print('Fetching %s' % spec)
+          with self.print_duration_of('fetch %s' % spec):
+            self.RunGit(fetch_cmd + [spec], cwd=rundir, retry=True)
+        except subprocess.CalledProcessError:
+          if spec == '+refs/heads/*:refs/heads/*':
+            raise ClobberNeeded()  # Corrupted cache.
+          logging.warning('Fetch of %s failed' % spec)
+          fetched_specs.remove(spec)
+    commit_fetch_cmd = ['fetch'] + filter_args + ['origin']
+    if not self._fetch_grouped(
+        commit_fetch_cmd, sorted(self.fetch_commits), rundir):
+      for commit in self.fetch_commits:
+        self.print('Fetching %s' % commit)
+        try:
+          with self.print_duration_of('fetch %s' % commit):
+            self.RunGit(commit_fetch_cmd + [commit], cwd=rundir, retry=True)
+        except subprocess.CalledProcessError:
+          logging.warning('Fetch of %s failed' % commit)
+    self._write_fetch_state({
+        'generation': self.read_fetch_state().get('generation', 0) + 1,
+        'last_fetch': time.time(),
+        'fetch_specs': fetched_specs,
+        'depth': depth,
+    })
+
+  def _fetch_grouped(self, fetch_cmd, items, rundir):
+    """Fetches all |items| (refspecs or commits) with a single git fetch.
+
+    Returns False if that isn't worth it (a single item) or if the fetch
+    failed, in which case the items should be fetched one by one.
+    """
+    if len(items) < 2:
+      return False
+    self.print('Fetching %s' % ', '.join(items))
+    try:
+      with self.print_duration_of('fetch %d items' % len(items)):
+        self.RunGit(fetch_cmd + list(items), cwd=rundir)
+    except subprocess.CalledProcessError:
+      logging.warning('Fetch of %s failed, fetching them one by one',
+                      ', '.join(items))
+      return False
+    return True
 
   def populate(self,
                depth=None,
@@ -465,29 +1531,129 @@ class Mirror(object):
                bootstrap=False,
                verbose=False,
                lock_timeout=0,
-               reset_fetch_config=False):
+               reset_fetch_config=False,
+               partial_clone=False,
+               need_blobs=False):
+    """Fetches the mirror, creating it if needed.
+
+    With |partial_clone|, new mirrors are created without blobs. Partial
+    mirrors stay partial, unless |need_blobs| asks for all their missing blobs.
+    """
     assert self.GetCachePath()
     if shallow and not depth:
       depth = 10000
     gclient_utils.safe_makedirs(self.GetCachePath())
 
-    with lockfile.lock(self.mirror_path, lock_timeout):
+    # If other processes fetch the mirror while this one waits for the lock,
+    # their fetch may make this one unnecessary.
+    generation = self.read_fetch_state().get('generation', 0)
+    with self.lock(lock_timeout), self._lock_borrowed_objects(lock_timeout):
+      created = not self.exists()
+      # Full mirrors stay full, as their checkouts can't fetch missing blobs.
+      refetch = need_blobs and self.is_partial()
+      partial = ((partial_clone and created) or
+                 (not created and not refetch and self.is_partial()))
+      if (not reset_fetch_config and not refetch and
+          self._fetched_while_waiting(generation, depth)):
+        self.print('%s was fetched by another process while waiting for the '
+                   'lock, skipping fetch.' % self.mirror_path)
+        self.touch()
+        return
       try:
-        self._ensure_bootstrapped(depth, bootstrap, reset_fetch_config)
+        # Bootstraps have every blob.
+        self._ensure_bootstrapped(depth, bootstrap and not partial,
+                                  reset_fetch_config)
+        self._borrow_objects()
         self._fetch(self.mirror_path, verbose, depth, no_fetch_tags,
-                    reset_fetch_config)
+                    reset_fetch_config, partial=partial, refetch=refetch)
       except ClobberNeeded:
+        if self.has_worktrees():
+          raise RuntimeError(
+              '%s is corrupt, but checkouts are worktrees of it. Delete them '
+              'and the mirror, then sync again.' % self.mirror_path)
+        borrowers = self.borrowing_mirrors()
+        if borrowers:
+          raise RuntimeError(
+              '%s is corrupt, but %s borrow objects from it. Delete them and '
+              'the mirror, then sync again.' % (
+                  self.mirror_path, ', '.join(borrowers)))
         # This is a major failure, we need to clean and force a bootstrap.
         gclient_utils.rmtree(self.mirror_path)
         self.print(GIT_CACHE_CORRUPT_MESSAGE)
         self._ensure_bootstrapped(depth,
-                                  bootstrap,
+                                  bootstrap and not partial_clone,
                                   reset_fetch_config,
                                   force=True)
+        self._borrow_objects()
         self._fetch(self.mirror_path, verbose, depth, no_fetch_tags,
-                    reset_fetch_config)
+                    reset_fetch_config, partial=partial_clone)
+      if created:
+        # All its checkouts will be registered.
+        gclient_utils.safe_makedirs(
+            os.path.join(self.mirror_path, self.CHECKOUTS_DIR))
+      self.touch()
+
+  @staticmethod
+  def _GetReadyGenerations(ls_out_set):
+    """Returns the numbers of the generations which have a .ready file, in
+    increasing order."""
+    generations = []
+    for name in ls_out_set:
+      m = re.match(r'.*/(\d+)\.ready$', name)
+      if m:
+        generations.append(int(m.group(1)))
+    return sorted(generations)
+
+  def _upload_incremental_bundles(self, gsutil, generations, dest_prefix):
+    """Uploads the refs of the mirror and bundles of what it has on top of
+    each of |generations|, as <N>.refs and <N>.from-<generation>.bundle."""
+    refs = subprocess.check_output(
+        [self.git_exe, 'for-each-ref', '--format=%(objectname) %(refname)'],
+        cwd=self.mirror_path).decode('utf-8', 'ignore')
+    tempdir = tempfile.mkdtemp(prefix='_bundle_tmp', dir=self.GetCachePath())
+    try:
+      refs_file = os.path.join(tempdir, 'refs')
+      gclient_utils.FileWrite(refs_file, refs)
+      gsutil.call('cp', refs_file, dest_prefix + '.refs')
+      for generation in generations:
+        code, prev_refs, _ = gsutil.check_call(
+            'cat', '%s/%d.refs' % (self._gs_path, generation))
+        if code:
+          # Published before incremental bundles were.
+          continue
+        tips = set(line.split()[0] for line in prev_refs.splitlines()
+                   if line.strip())
+        # Tips the mirror lost, e.g. to force pushes, can't be excluded. The
+        # bundle then has all their history, up to a full bundle.
+        tips -= self._missing_objects(tips)
+        exclude = ''.join('^%s\n' % tip for tip in sorted(tips)).encode('utf-8')
+        proc = subprocess.Popen(
+            [self.git_exe, 'rev-list', '-n', '1', '--all', '--stdin'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self.mirror_path)
+        new, _ = proc.communicate(exclude)
+        if not proc.returncode and not new.strip():
+          # Mirrors at that generation already have all the commits, and git
+          # refuses to create empty bundles.
+          logging.info('Nothing new since generation %d.', generation)
+          continue
+        bundle = os.path.join(tempdir, '%d.bundle' % generation)
+        proc = subprocess.Popen(
+            [self.git_exe, 'bundle', 'create', bundle, '--all', '--stdin'],
+            stdin=subprocess.PIPE, cwd=self.mirror_path)
+        proc.communicate(exclude)
+        if proc.returncode:
+          # Before the .ready file, so that no generation has a hole.
+          raise RuntimeError(
+              'Failed to create the bundle of %s from generation %d.' % (
+                  self.mirror_path, generation))
+        gsutil.call('cp', bundle, '%s.from-%d.bundle' % (
+            dest_prefix, generation))
+        os.remove(bundle)
+    finally:
+      gclient_utils.rmtree(tempdir)
 
-  def update_bootstrap(self, prune=False, gc_aggressive=False, branch='master'):
+  def update_bootstrap(self, prune=False, gc_aggressive=False, branch='master',
+                       incremental=0):
     # The folder is <git number>
     gen_number = subprocess.check_output(
         [self.git_exe, 'number', branch],
@@ -507,6 +1673,13 @@ class Mirror(object):
       print('Cache %s already exists.' % dest_prefix)
       return
 
+    borrowers = self.borrowing_mirrors()
+    if borrowers:
+      # Garbage collecting would drop objects they need.
+      raise RuntimeError(
+          'Not updating the bootstrap of %s, %s borrow objects from it.' % (
+              self.mirror_path, ', '.join(borrowers)))
+
     # Reduce the number of individual files to download & write on disk.
     self.RunGit(['pack-refs', '--all'])
 
@@ -540,6 +1713,13 @@ class Mirror(object):
 
     gsutil.call('-m', 'cp', '-r', src_name, dest_prefix)
 
+    # Let mirrors which already have one of the previous generations download
+    # only what is new.
+    generations = self._GetReadyGenerations(ls_out_set)
+    if incremental:
+      self._upload_incremental_bundles(
+          gsutil, generations[-incremental:], dest_prefix)
+
     # Create .ready file and upload
     _, ready_file_name =  tempfile.mkstemp(suffix='.ready')
     try:
@@ -556,9 +1736,14 @@ class Mirror(object):
     prev_dest_prefix = self._GetMostRecentCacheDirectory(ls_out_set)
     if not prev_dest_prefix:
       return
+    # Keep the refs of the generations to create incremental bundles from
+    # next time.
+    kept_refs = set('%s/%d.refs' % (self._gs_path, g)
+                    for g in generations[-incremental:] if incremental)
     for path in ls_out_set:
       if (path == prev_dest_prefix + '/' or
-          path == prev_dest_prefix + '.ready'):
+          path.startswith(prev_dest_prefix + '.') or
+          path in kept_refs):
         continue
       if path.endswith('.ready'):
         gsutil.call('rm', path)
@@ -614,6 +1799,9 @@ def CMDupdate_bootstrap(parser, args):
                     help='Prune all other cached bundles of the same repo.')
   parser.add_option('--branch', default='master',
                     help='Branch to use for bootstrap. (Default \'master\')')
+  parser.add_option('--incremental', type='int', default=3,
+                    help='Also upload bundles of what is new since each of '
+                         'the last INCREMENTAL bootstraps. (Default 3)')
 
   populate_args = args[:]
   options, args = parser.parse_args(args)
@@ -628,7 +1816,8 @@ def CMDupdate_bootstrap(parser, args):
   _, args2 = parser.parse_args(args)
   url = args2[0]
   mirror = Mirror(url)
-  mirror.update_bootstrap(options.prune, options.gc_aggressive, options.branch)
+  mirror.update_bootstrap(options.prune, options.gc_aggressive, options.branch,
+                         options.incremental)
   return 0
 
 
@@ -661,6 +1850,9 @@ def CMDpopulate(parser, args):
                     help='Break any existing lock instead of just ignoring it')
   parser.add_option('--reset-fetch-config', action='store_true', default=False,
                     help='Reset the fetch config before populating the cache.')
+  parser.add_option('--partial-clone', action='store_true',
+                    help='Don\'t fetch blobs into a new mirror; checkouts '
+                         'fetch the blobs they need on demand.')
 
   options, args = parser.parse_args(args)
   if not len(args) == 1:
@@ -679,12 +1871,237 @@ def CMDpopulate(parser, args):
       'bootstrap': not options.no_bootstrap,
       'lock_timeout': options.timeout,
       'reset_fetch_config': options.reset_fetch_config,
+      'partial_clone': options.partial_clone,
   }
   if options.depth:
     kwargs['depth'] = options.depth
   mirror.populate(**kwargs)
 
 
+def _ReadUrlsToPopulate(options, args):
+  """Returns the (url, revision) pairs to populate the cache with, from the
+  command line, --url-file and --deps. The revision may be None."""
+  urls = [gclient_utils.SplitUrlRevision(url) for url in args]
+  if options.url_file:
+    for line in gclient_utils.FileRead(options.url_file).splitlines():
+      line = line.split('#', 1)[0].strip()
+      if line:
+        urls.append(gclient_utils.SplitUrlRevision(line))
+  if options.deps:
+    content = gclient_utils.FileRead(options.deps)
+    if os.path.basename(options.deps) == '.gclient':
+      config_dict = {}
+      exec(content, config_dict)
+      urls.extend(gclient_utils.SplitUrlRevision(s['url'])
+                  for s in config_dict.get('solutions', []) if s.get('url'))
+    else:
+      # Conditions are ignored; a cache can hold more than a checkout needs.
+      deps = gclient_eval.Parse(content, options.deps).get('deps', {})
+      for dep in deps.values():
+        if dep.get('dep_type', 'git') == 'git' and dep.get('url'):
+          urls.append(gclient_utils.SplitUrlRevision(dep['url']))
+  return urls
+
+
+def _PopulateMany(urls, options):
+  """Populates the mirrors of the (url, revision) pairs |urls|, fetching the
+  pinned revisions too.
+
+  At most options.jobs mirrors are populated at once, and options.host_jobs
+  from a single host. Mirrors whose lock is busy are skipped. Returns a list
+  of dicts with the url, mirror_path, success, seconds and error of each
+  mirror.
+  """
+  # Several deps may share a repo.
+  commits = collections.OrderedDict()
+  for url, revision in urls:
+    commits.setdefault(url, set())
+    if revision and gclient_utils.IsGitSha(revision):
+      commits[url].add(revision)
+
+  progress_lock = threading.Lock()
+  progress = {'done': 0, 'failed': 0}
+
+  def populate(url):
+    out = []
+    mirror = Mirror(url, commits=sorted(commits[url]), print_func=out.append)
+    result = {'url': url, 'mirror_path': mirror.mirror_path}
+    start = time.time()
+    try:
+      mirror.populate(depth=getattr(options, 'depth', None),
+                      no_fetch_tags=options.no_fetch_tags,
+                      bootstrap=not options.no_bootstrap,
+                      verbose=options.verbose,
+                      lock_timeout=options.timeout,
+                      partial_clone=mirror.is_partial())
+      result['success'] = True
+      status = 'Populated'
+    except lockfile.LockError as e:
+      # Someone else is fetching it.
+      result['success'] = True
+      result['error'] = str(e)
+      status = 'Skipped busy'
+    except Exception as e:
+      result['success'] = False
+      result['error'] = str(e) or type(e).__name__
+      status = 'Failed to populate'
+    result['seconds'] = round(time.time() - start, 3)
+    with progress_lock:
+      progress['done'] += 1
+      if not result['success']:
+        progress['failed'] += 1
+        print('\n'.join(out), file=sys.stderr)
+      print('[%d/%d, %d failed] %s %s in %.1fs' % (
+          progress['done'], len(commits), progress['failed'], status, url,
+          result['seconds']))
+    return result
+
+  return _RunInParallel(populate, list(commits), options.jobs,
+                        key=lambda url: urlparse.urlparse(url).netloc,
+                        key_jobs=max(1, options.host_jobs))
+
+
+def _ReadGclientEntries(root):
+  """Returns the (url, revision) pairs of the git checkouts listed in the
+  .gclient_entries file of the gclient root |root|."""
+  scope = {}
+  exec(gclient_utils.FileRead(os.path.join(root, '.gclient_entries')), scope)
+  urls = []
+  for name, url in sorted(scope.get('entries', {}).items()):
+    # CIPD packages are listed as <path>:<package>.
+    if url and ':' not in name:
+      urls.append(gclient_utils.SplitUrlRevision(url))
+  return urls
+
+
+def _ReadGclientCacheDir(root):
+  """Returns the absolute cache_dir set in the .gclient file of the gclient
+  root |root|, None if it disables the cache, or '' if it isn't set."""
+  config_dict = {}
+  exec(gclient_utils.FileRead(os.path.join(root, '.gclient')), config_dict)
+  if 'cache_dir' not in config_dict:
+    return ''
+  cache_dir = config_dict['cache_dir']
+  if not cache_dir:
+    return None
+  # Like gclient, relative to the root.
+  return os.path.abspath(os.path.join(root, cache_dir))
+
+
+@subcommand.usage('[gclient root directories]')
+@metrics.collector.collect_metrics('git cache prefetch-daemon')
+def CMDprefetch_daemon(parser, args):
+  """Keep the mirrors used by gclient checkouts fresh in the background.
+
+  Periodically populates the mirror of every repo listed in the
+  .gclient_entries files of the given gclient roots, so that syncs mostly find
+  what they need already fetched. Mirrors go in the cache_dir of each root's
+  .gclient file, unless --cache-dir is given. Use --once to run a single pass,
+  e.g. from a systemd timer.
+  """
+  parser.add_option('--interval', type='int', default=15 * 60,
+                    help='Seconds between passes (Default 15 minutes)')
+  parser.add_option('--jitter', type='int', default=60,
+                    help='Randomize the start of each pass by up to this many '
+                         'seconds, so that machines don\'t fetch in lockstep')
+  parser.add_option('--once', action='store_true',
+                    help='Run a single pass and exit')
+  parser.add_option('--jobs', '-j', type='int', default=4,
+                    help='Number of repos to populate in parallel')
+  parser.add_option('--host-jobs', type='int', default=2,
+                    help='Number of repos to populate in parallel from a '
+                         'single host')
+  parser.add_option('--no-fetch-tags', action='store_true',
+                    help='Don\'t fetch tags from the server.')
+  parser.add_option('--no_bootstrap', '--no-bootstrap', action='store_true',
+                    help='Don\'t bootstrap from Google Storage')
+  options, args = parser.parse_args(args)
+  if not args:
+    parser.error('At least one gclient root is required.')
+
+  try:
+    default_cache_dir = Mirror.GetCachePath()
+  except RuntimeError:
+    default_cache_dir = None
+
+  while True:
+    time.sleep(random.uniform(0, max(0, options.jitter)))
+    urls_by_cache_dir = collections.OrderedDict()
+    failed = False
+    for root in args:
+      try:
+        urls = _ReadGclientEntries(root)
+        cache_dir = options.cache_dir or _ReadGclientCacheDir(root)
+      except (IOError, OSError, SyntaxError) as e:
+        print('Could not read the entries of %s: %s' % (root, e),
+              file=sys.stderr)
+        failed = True
+        continue
+      if cache_dir is None:
+        print('%s doesn\'t use a cache, skipping it.' % root)
+        continue
+      cache_dir = cache_dir or default_cache_dir
+      if not cache_dir:
+        print('%s has no cache_dir and no cache.cachepath git configuration '
+              'or $GIT_CACHE_PATH is set, skipping it.' % root,
+              file=sys.stderr)
+        failed = True
+        continue
+      urls_by_cache_dir.setdefault(cache_dir, []).extend(urls)
+    results = []
+    for cache_dir, urls in urls_by_cache_dir.items():
+      print('%s: refreshing %d repos in %s.' % (
+          time.ctime(), len(urls), cache_dir))
+      Mirror.SetCachePath(cache_dir)
+      results.extend(_PopulateMany(urls, options))
+    if options.once:
+      return 1 if failed or not all(r['success'] for r in results) else 0
+    time.sleep(options.interval)
+
+
+@subcommand.usage('[urls of repos to add to or update in cache]')
+@metrics.collector.collect_metrics('git cache populate-many')
+def CMDpopulate_many(parser, args):
+  """Populate the cache with many repos in parallel.
+
+  Repos are given as urls on the command line, in a file with a url per line
+  (--url-file) or as the deps of a DEPS file, e.g. one written by
+  `gclient flatten`, or the solutions of a .gclient file (--deps). Pinned
+  revisions are fetched too.
+  """
+  parser.add_option('--url-file',
+                    help='File with a url, optionally @revision, per line')
+  parser.add_option('--deps',
+                    help='DEPS or .gclient file whose repos to populate')
+  parser.add_option('--jobs', '-j', type='int', default=8,
+                    help='Number of repos to populate in parallel')
+  parser.add_option('--host-jobs', type='int', default=4,
+                    help='Number of repos to populate in parallel from a '
+                         'single host')
+  parser.add_option('--depth', type='int',
+                    help='Only cache DEPTH commits of history')
+  parser.add_option('--no-fetch-tags', action='store_true',
+                    help='Don\'t fetch tags from the server.')
+  parser.add_option('--no_bootstrap', '--no-bootstrap', action='store_true',
+                    help='Don\'t bootstrap from Google Storage')
+  parser.add_option('--json-output',
+                    help='Write a JSON summary with per-repo timings to this '
+                         'file')
+  options, args = parser.parse_args(args)
+  try:
+    urls = _ReadUrlsToPopulate(options, args)
+  except (IOError, OSError, SyntaxError, ValueError, KeyError) as e:
+    parser.error('Could not read the repos to populate: %s' % e)
+  if not urls:
+    parser.error('No repos to populate.')
+
+  results = _PopulateMany(urls, options)
+  if options.json_output:
+    with open(options.json_output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  return 0 if all(r['success'] for r in results) else 1
+
+
 @subcommand.usage('Fetch new commits into cache and current checkout')
 @metrics.collector.collect_metrics('git cache fetch')
 def CMDfetch(parser, args):
@@ -733,7 +2150,8 @@ def CMDfetch(parser, args):
     mirror.populate(
         bootstrap=not options.no_bootstrap,
         no_fetch_tags=options.no_fetch_tags,
-        lock_timeout=options.timeout)
+        lock_timeout=options.timeout,
+        partial_clone=mirror.is_partial())
     return 0
   for remote in remotes:
     remote_url = subprocess.check_output(
@@ -746,11 +2164,237 @@ def CMDfetch(parser, args):
       mirror.populate(
           bootstrap=not options.no_bootstrap,
           no_fetch_tags=options.no_fetch_tags,
-          lock_timeout=options.timeout)
+          lock_timeout=options.timeout,
+          partial_clone=mirror.is_partial())
     subprocess.check_call([Mirror.git_exe, 'fetch', remote])
   return 0
 
 
+def _ListMirrors():
+  """Returns the paths of all the mirrors in the cache directory."""
+  cachepath = Mirror.GetCachePath()
+  if not os.path.isdir(cachepath):
+    return []
+  return [os.path.join(cachepath, d) for d in sorted(os.listdir(cachepath))
+          if os.path.isfile(os.path.join(cachepath, d, 'config'))]
+
+
+def _MirrorUrl(path):
+  """Returns the url of the mirror at |path|."""
+  # Cache dir names can't always be converted back, e.g. for local repos.
+  try:
+    for key, value in scm.GIT.ReadConfigFile(os.path.join(path, 'config')):
+      if key == 'remote.origin.url' and value:
+        return value
+  except (IOError, OSError, subprocess.CalledProcessError):
+    pass
+  return Mirror.CacheDirToUrl(path)
+
+
+def _ForEachMirror(fn, paths, jobs):
+  """Runs |fn| on a Mirror for each of |paths|, |jobs| at a time.
+
+  Output of each mirror is printed at once when |fn| is done with it. Returns
+  the list of |fn| results.
+  """
+  print_lock = threading.Lock()
+
+  def run(path):
+    out = []
+    mirror = Mirror(_MirrorUrl(path),
+                    print_func=out.append if jobs > 1 else None)
+    try:
+      result = fn(mirror)
+    except Exception as e:
+      out.append('%s failed: %s' % (path, e))
+      result = False
+    if out:
+      with print_lock:
+        print('\n'.join(out))
+    return result
+
+  return _RunInParallel(run, paths, jobs)
+
+
+@subcommand.usage('[url of repo to maintain]')
+@metrics.collector.collect_metrics('git cache maintain')
+def CMDmaintain(parser, args):
+  """Repack cached repos and write their commit-graphs and bitmaps.
+
+  Maintains all the repos in the cache unless a repo url is given.
+  """
+  parser.add_option('--jobs', '-j', type='int',
+                    default=min(4, gclient_utils.NumLocalCpus()),
+                    help='Number of repos to maintain in parallel')
+  options, args = parser.parse_args(args)
+  if len(args) > 1:
+    parser.error('git cache maintain takes at most one repo url.')
+  if args:
+    mirror = Mirror(args[0])
+    if not mirror.exists():
+      print('%s is not cached.' % args[0], file=sys.stderr)
+      return 1
+    paths = [mirror.mirror_path]
+  else:
+    paths = _ListMirrors()
+
+  def maintain(mirror):
+    # Repacking deletes packs that clones from the mirror may be reading.
+    try:
+      with mirror.lock(options.timeout):
+        return mirror.maintain()
+    except lockfile.LockError as e:
+      mirror.print('Skipping %s: %s' % (mirror.mirror_path, e))
+      return True
+
+  results = _ForEachMirror(maintain, paths, options.jobs)
+  return 0 if all(results) else 1
+
+
+def _ParseSize(size):
+  """Parses a size like 1024, 500M or 2G into a number of bytes."""
+  m = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$', size.strip().upper())
+  if not m:
+    raise ValueError('Invalid size %r' % size)
+  return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2) or ' '))
+
+
+def _DirSize(path):
+  """Returns the disk usage of the files under |path|, in bytes."""
+  total = 0
+  for root, _, files in os.walk(path):
+    for f in files:
+      try:
+        total += os.lstat(os.path.join(root, f)).st_size
+      except OSError:
+        pass
+  return total
+
+
+@subcommand.usage('--max-size SIZE')
+@metrics.collector.collect_metrics('git cache gc')
+def CMDgc(parser, args):
+  """Evict the least recently used repos until the cache fits in a size.
+
+  Repos still used by a checkout, through objects/info/alternates or as
+  worktrees, are never evicted. Repos created by older versions may be used by
+  checkouts which weren't recorded, and are only evicted with --force.
+  """
+  parser.add_option('--max-size',
+                    help='Maximum size of the cache, e.g. 500G, 800M')
+  parser.add_option('--dry-run', '-n', action='store_true',
+                    help='Only print the repos that would be evicted')
+  parser.add_option('--force', action='store_true',
+                    help='Also evict repos which may be used by checkouts '
+                         'that were not recorded')
+  options, args = parser.parse_args(args)
+  if args:
+    parser.error('git cache gc takes no arguments.')
+  if not options.max_size:
+    parser.error('--max-size is required.')
+  try:
+    max_size = _ParseSize(options.max_size)
+  except ValueError as e:
+    parser.error(str(e))
+
+  mirrors = [Mirror(_MirrorUrl(path)) for path in _ListMirrors()]
+  sizes = dict((m.mirror_path, _DirSize(m.mirror_path)) for m in mirrors)
+  total = sum(sizes.values())
+  print('Cache is %.1f MiB, limit is %.1f MiB.' % (
+      total / 1024.0 ** 2, max_size / 1024.0 ** 2))
+  for mirror in sorted(mirrors, key=lambda m: m.last_access()):
+    if total <= max_size:
+      break
+    try:
+      # Clones and fetches hold the lock while using the mirror.
+      with mirror.lock(options.timeout):
+        checkouts = mirror.live_checkouts(forget=not options.dry_run)
+        if checkouts:
+          print('Keeping %s, used by %s' % (
+              mirror.mirror_path, ', '.join(checkouts)))
+          continue
+        if mirror.has_worktrees():
+          print('Keeping %s, it has worktrees' % mirror.mirror_path)
+          continue
+        if not options.force and not mirror.tracks_checkouts():
+          print('Keeping %s, it may be used by checkouts which were not '
+                'recorded (use --force to evict it)' % mirror.mirror_path)
+          continue
+        print('%s %s (%.1f MiB, last used %s)' % (
+            'Would evict' if options.dry_run else 'Evicting',
+            mirror.mirror_path, sizes[mirror.mirror_path] / 1024.0 ** 2,
+            time.ctime(mirror.last_access())))
+        if not options.dry_run:
+          gclient_utils.rmtree(mirror.mirror_path)
+        total -= sizes[mirror.mirror_path]
+    except lockfile.LockError as e:
+      print('Keeping %s: %s' % (mirror.mirror_path, e))
+  if total > max_size:
+    print('Cache is still %.1f MiB.' % (total / 1024.0 ** 2), file=sys.stderr)
+    return 1
+  return 0
+
+
+def _MirrorStats(mirror):
+  """Returns a dict describing the mirror, for `git cache ls`."""
+  pack_files = mirror._pack_files()
+  pack_count = len(pack_files)
+  needs_repack = pack_count > GC_AUTOPACKLIMIT
+  holders = lockfile.get_holders(mirror.mirror_path)
+  if not holders:
+    lock_state = 'unlocked'
+  elif all(h.get('shared') for h in holders):
+    lock_state = 'shared'
+  else:
+    lock_state = 'exclusive'
+  return {
+      'url': mirror.url,
+      'path': mirror.mirror_path,
+      'size': _DirSize(mirror.mirror_path),
+      'pack_count': pack_count,
+      'last_fetch': mirror.read_fetch_state().get('last_fetch'),
+      'last_access': mirror.last_access(),
+      'lock': lock_state,
+      'lock_holders': [h.get('pid') for h in holders],
+      # See Mirror._ensure_bootstrapped(). Repacking comes first, and partial
+      # mirrors are fetched from scratch rather than bootstrapped.
+      'needs_repack': needs_repack,
+      'needs_bootstrap': (not needs_repack and not mirror.is_partial() and
+                          mirror.needs_bootstrap(pack_files)),
+  }
+
+
+@subcommand.usage('')
+@metrics.collector.collect_metrics('git cache ls')
+def CMDls(parser, args):
+  """List the cached repos with their size, pack count and state."""
+  parser.add_option('--json', action='store_true',
+                    help='Print the list as JSON')
+  parser.add_option('--jobs', '-j', type='int', default=8,
+                    help='Number of repos to inspect in parallel')
+  options, args = parser.parse_args(args)
+  if args:
+    parser.error('git cache ls takes no arguments.')
+
+  stats = _ForEachMirror(_MirrorStats, _ListMirrors(), options.jobs)
+  stats = [s for s in stats if s]
+  if options.json:
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    print()
+    return 0
+
+  def format_time(t):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(t)) if t else '-'
+
+  for s in stats:
+    flags = [f for f in ('needs_repack', 'needs_bootstrap') if s[f]]
+    print('%s\n  %s, %d packs, fetched %s, used %s, %s%s' % (
+        s['url'], '%.1f MiB' % (s['size'] / 1024.0 ** 2), s['pack_count'],
+        format_time(s['last_fetch']), format_time(s['last_access']),
+        s['lock'], ''.join(', ' + f.replace('_', ' ') for f in flags)))
+  return 0
+
+
 @subcommand.usage('do not use - it is a noop.')
 @metrics.collector.collect_metrics('git cache unlock')
 def CMDunlock(parser, args):
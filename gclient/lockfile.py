@@ -1,15 +1,20 @@
 # Copyright 2020 The Chromium Authors. All rights reserved.
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
-"""Exclusive filelocking for all supported platforms."""
+"""Shared and exclusive filelocking for all supported platforms."""
 
 from __future__ import print_function
 
 import contextlib
+import errno
+import json
 import logging
 import os
+import socket
 import sys
+import threading
 import time
+import uuid
 
 
 class LockError(Exception):
@@ -22,14 +27,20 @@ if sys.platform.startswith('win'):
 
   BYTES_TO_LOCK = 1
 
+  # Not all of these are exported by win32imports.
+  FILE_SHARE_READ = 0x1
+  FILE_SHARE_WRITE = 0x2
+  OPEN_ALWAYS = 4
+
   def _open_file(lockfile):
     return win32imports.Handle(
         win32imports.CreateFileW(
             lockfile,  # lpFileName
             win32imports.GENERIC_WRITE,  # dwDesiredAccess
-            0,  # dwShareMode=prevent others from opening file
+            # Let other lockers open the file; LockFileEx arbitrates.
+            FILE_SHARE_READ | FILE_SHARE_WRITE,  # dwShareMode
             None,  # lpSecurityAttributes
-            win32imports.CREATE_ALWAYS,  # dwCreationDisposition
+            OPEN_ALWAYS,  # dwCreationDisposition
             win32imports.FILE_ATTRIBUTE_NORMAL,  # dwFlagsAndAttributes
             None  # hTemplateFile
         ))
@@ -38,11 +49,15 @@ if sys.platform.startswith('win'):
     # CloseHandle releases lock too.
     win32imports.CloseHandle(handle)
 
-  def _lock_file(handle):
+  def _lock_file(handle, shared, blocking):
+    flags = 0
+    if not shared:
+      flags |= win32imports.LOCKFILE_EXCLUSIVE_LOCK
+    if not blocking:
+      flags |= win32imports.LOCKFILE_FAIL_IMMEDIATELY
     ret = win32imports.LockFileEx(
         handle,  # hFile
-        win32imports.LOCKFILE_FAIL_IMMEDIATELY
-        | win32imports.LOCKFILE_EXCLUSIVE_LOCK,  # dwFlags
+        flags,  # dwFlags
         0,  #dwReserved
         BYTES_TO_LOCK,  # nNumberOfBytesToLockLow
         0,  # nNumberOfBytesToLockHigh
@@ -53,6 +68,24 @@ if sys.platform.startswith('win'):
     if ret == 0:
       error_code = win32imports.GetLastError()
       raise OSError('Failed to lock handle (error code: %d).' % error_code)
+
+  def _is_alive(pid):
+    import ctypes
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    ERROR_ACCESS_DENIED = 5
+    STILL_ACTIVE = 259
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+      # The process exists but belongs to someone else.
+      return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+    try:
+      exit_code = ctypes.c_ulong()
+      if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+        return True
+      return exit_code.value == STILL_ACTIVE
+    finally:
+      kernel32.CloseHandle(handle)
 else:
   # Unix implementation
   import fcntl
@@ -64,43 +97,183 @@ else:
   def _close_file(fd):
     os.close(fd)
 
-  def _lock_file(fd):
-    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  def _lock_file(fd, shared, blocking):
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+      flags |= fcntl.LOCK_NB
+    fcntl.flock(fd, flags)
+
+  def _is_alive(pid):
+    try:
+      os.kill(pid, 0)
+    except OSError as e:
+      # The process exists but belongs to someone else.
+      return e.errno == errno.EPERM
+    return True
 
 
-def _try_lock(lockfile):
+def _try_lock(lockfile, shared):
   f = _open_file(lockfile)
   try:
-    _lock_file(f)
+    _lock_file(f, shared, blocking=False)
   except Exception:
     _close_file(f)
     raise
   return lambda: _close_file(f)
 
 
-def _lock(path, timeout=0):
-  """_lock returns function to release the lock if locking was successful.
+def _wait_for_lock(lockfile, shared, timeout):
+  """Blocks until the lock is acquired or |timeout| seconds have passed.
+
+  The blocking call can't be interrupted, so it is made on a helper thread. If
+  the timeout expires first, the helper releases the lock as soon as it gets
+  it.
+  """
+  f = _open_file(lockfile)
+  done = threading.Event()
+  state_lock = threading.Lock()
+  state = {'error': None, 'abandoned': False}
 
-  _lock also implements simple retry logic."""
-  elapsed = 0
-  while True:
+  def waiter():
     try:
-      return _try_lock(path + '.locked')
+      _lock_file(f, shared, blocking=True)
     except (OSError, IOError) as e:
-      if elapsed < timeout:
-        sleep_time = min(10, timeout - elapsed)
-        logging.info(
-            'Could not create git cache lockfile; '
-            'will retry after sleep(%d).', sleep_time)
-        elapsed += sleep_time
-        time.sleep(sleep_time)
-        continue
-      raise LockError("Error locking %s (err: %s)" % (path, str(e)))
+      state['error'] = e
+    with state_lock:
+      if state['abandoned'] or state['error']:
+        _close_file(f)
+      done.set()
+
+  thread = threading.Thread(target=waiter, name='lock %s' % lockfile)
+  thread.daemon = True
+  thread.start()
+  done.wait(timeout)
+  with state_lock:
+    if not done.is_set():
+      state['abandoned'] = True
+      raise OSError('Timed out after %d seconds' % timeout)
+  if state['error']:
+    raise state['error']
+  return lambda: _close_file(f)
+
+
+def _holders_dir(path):
+  return path + '.lockinfo'
+
+
+def _add_holder(path, shared):
+  """Records who holds the lock on |path|. Returns a function removing the
+  record."""
+  holders_dir = _holders_dir(path)
+  holder_path = os.path.join(
+      holders_dir, '%d-%s.json' % (os.getpid(), uuid.uuid4().hex))
+  try:
+    if not os.path.isdir(holders_dir):
+      os.makedirs(holders_dir)
+  except OSError:
+    # Another process created it in the meantime.
+    if not os.path.isdir(holders_dir):
+      raise
+  with open(holder_path, 'w') as f:
+    json.dump({
+        'pid': os.getpid(),
+        'host': socket.gethostname(),
+        'command': sys.argv,
+        'start_time': time.time(),
+        'shared': shared,
+    }, f)
+
+  def remove():
+    try:
+      os.remove(holder_path)
+    except OSError:
+      pass
+
+  return remove
+
+
+def get_holders(path):
+  """Returns the holders of the lock on |path| as a list of dicts with the pid,
+  host, command, start_time and shared keys.
+
+  The records of holders which are known to be dead are removed.
+  """
+  holders_dir = _holders_dir(path)
+  try:
+    names = sorted(os.listdir(holders_dir))
+  except OSError:
+    return []
+  holders = []
+  hostname = socket.gethostname()
+  for name in names:
+    holder_path = os.path.join(holders_dir, name)
+    try:
+      with open(holder_path) as f:
+        holder = json.load(f)
+    except (IOError, OSError, ValueError):
+      # Being written or removed.
+      continue
+    pid = holder.get('pid')
+    if holder.get('host') == hostname and (
+        not isinstance(pid, int) or not _is_alive(pid)):
+      # Left behind by a process that crashed.
+      try:
+        os.remove(holder_path)
+      except OSError:
+        pass
+      continue
+    holders.append(holder)
+  return holders
+
+
+def _describe_holders(path):
+  holders = get_holders(path)
+  if not holders:
+    return ''
+  return '; held by ' + ', '.join(
+      'pid %s (%s lock since %s: %s)' % (
+          h.get('pid'), 'shared' if h.get('shared') else 'exclusive',
+          time.strftime('%H:%M:%S', time.localtime(h.get('start_time', 0))),
+          ' '.join(h.get('command') or []))
+      for h in holders)
+
+
+def _lock(path, timeout=0, shared=False):
+  """_lock returns function to release the lock if locking was successful.
+
+  If the lock is busy, _lock waits for up to |timeout| seconds for it."""
+  lockfile = path + '.locked'
+  try:
+    try:
+      release_fn = _try_lock(lockfile, shared)
+    except (OSError, IOError):
+      if timeout <= 0:
+        raise
+      logging.info('Waiting up to %d seconds for git cache lock %s.', timeout,
+                   lockfile)
+      release_fn = _wait_for_lock(lockfile, shared, timeout)
+  except (OSError, IOError) as e:
+    raise LockError("Error locking %s (err: %s)%s" % (
+        path, str(e), _describe_holders(path)))
+  try:
+    remove_holder_fn = _add_holder(path, shared)
+  except (OSError, IOError) as e:
+    logging.warning('Could not record lock holder for %s: %s', path, e)
+    remove_holder_fn = lambda: None
+
+  def release():
+    remove_holder_fn()
+    release_fn()
+
+  return release
 
 
 @contextlib.contextmanager
-def lock(path, timeout=0):
-  """Get exclusive lock to path.
+def lock(path, timeout=0, shared=False):
+  """Get exclusive lock to path, or a shared one if |shared| is true.
+
+  Any number of shared locks can be held at once, but an exclusive lock
+  excludes all other locks.
 
   Usage:
     import lockfile
@@ -109,7 +282,7 @@ def lock(path, timeout=0):
       pass
 
    """
-  release_fn = _lock(path, timeout)
+  release_fn = _lock(path, timeout, shared)
   try:
     yield
   finally:
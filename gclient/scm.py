@@ -10,6 +10,7 @@ import io
 import os
 import platform
 import re
+import shutil
 import sys
 
 import gclient_utils
@@ -171,6 +172,178 @@ class GIT(object):
     key = 'branch.%s.%s' % (branch, key)
     GIT.SetConfig(cwd, key, value)
 
+  # Escape sequences allowed in git config values.
+  _CONFIG_ESCAPES = {'n': '\n', 't': '\t', 'b': '\b', '\\': '\\', '"': '"'}
+
+  @staticmethod
+  def _ParseConfigFile(content):
+    """Parses the content of a git config file into a list of (key, value)
+    tuples. Raises ValueError on includes and on syntax it doesn't support.
+    """
+    entries = []
+    section = None
+    lines = content.splitlines()
+    i = 0
+    while i < len(lines):
+      line = lines[i].strip()
+      i += 1
+      if not line or line[0] in '#;':
+        continue
+      if line.startswith('['):
+        m = re.match(
+            r'^\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*'
+            r'(?:[#;].*)?$', line)
+        if not m:
+          raise ValueError('Unsupported section header: %s' % line)
+        name, subsection = m.groups()
+        if name.lower() in ('include', 'includeif'):
+          raise ValueError('Config includes are not supported')
+        section = name.lower()
+        if subsection is not None:
+          section += '.' + re.sub(r'\\(.)', r'\1', subsection)
+        continue
+      m = re.match(r'^([A-Za-z][A-Za-z0-9-]*)\s*(?:=(.*)|[#;].*)?$', line)
+      if not m or section is None:
+        raise ValueError('Unsupported config line: %s' % line)
+      name, raw = m.groups()
+      key = '%s.%s' % (section, name.lower())
+      if raw is None:
+        # A key without value is a boolean set to true.
+        entries.append((key, None))
+        continue
+      value = ''
+      whitespace = ''
+      in_quote = False
+      while True:
+        continued = False
+        j = 0
+        while j < len(raw):
+          c = raw[j]
+          j += 1
+          if c == '\\':
+            if j == len(raw):
+              continued = True
+              break
+            if raw[j] not in GIT._CONFIG_ESCAPES:
+              raise ValueError('Unsupported escape in: %s' % line)
+            c = GIT._CONFIG_ESCAPES[raw[j]]
+            j += 1
+          elif c == '"':
+            in_quote = not in_quote
+            value += whitespace
+            whitespace = ''
+            continue
+          elif not in_quote and c in '#;':
+            break
+          elif not in_quote and c.isspace():
+            # Whitespace outside of quotes is kept only between words.
+            if value:
+              whitespace += c
+            continue
+          value += whitespace + c
+          whitespace = ''
+        if not continued:
+          break
+        if i == len(lines):
+          raise ValueError('Unterminated line continuation')
+        raw = lines[i]
+        i += 1
+      if in_quote:
+        raise ValueError('Unterminated quote in: %s' % line)
+      entries.append((key, value))
+    return entries
+
+  @staticmethod
+  def ReadConfigFile(path):
+    """Returns the entries of the git config file |path| as a list of
+    (key, value) tuples, in file order, with keys normalized the way
+    `git config --list` does. Boolean keys without a value map to None.
+    """
+    try:
+      return GIT._ParseConfigFile(gclient_utils.FileRead(path))
+    except ValueError:
+      # Let git handle includes and the more exotic syntax.
+      output = GIT.Capture(
+          ['config', '--file', path, '--null', '--list'], strip_out=False)
+      entries = []
+      for item in output.split('\0'):
+        if item:
+          key, newline, value = item.partition('\n')
+          entries.append((key, value if newline else None))
+      return entries
+
+  @staticmethod
+  def UpdateConfigFile(path, changes):
+    """Applies |changes| to the git config file |path|, only running git if
+    some of them actually change the file.
+
+    Each change is one of:
+      ('set', key, value): like `git config --replace-all key value`.
+      ('replace', key, value, value_regex): like
+          `git config --replace-all key value value_regex`.
+      ('unset', key): like `git config --unset-all key`.
+
+    The changes are written to a copy of the file which then replaces it, so
+    readers never see a partially updated config.
+
+    Returns True if the file was modified.
+    """
+    entries = initial_entries = GIT.ReadConfigFile(path)
+    needed = []
+    for change in changes:
+      op, key = change[0], change[1].lower()
+      # Only the section and the variable name are case insensitive.
+      if key.count('.') >= 2:
+        section, _, rest = change[1].partition('.')
+        subsection, _, name = rest.rpartition('.')
+        key = '%s.%s.%s' % (section.lower(), subsection, name.lower())
+      if op == 'unset':
+        matches = [e for e in entries if e[0] == key]
+      elif op == 'set':
+        matches = [e for e in entries if e[0] == key]
+      elif op == 'replace':
+        matches = [e for e in entries
+                   if e[0] == key and re.search(change[3], e[1] or '')]
+      else:
+        raise ValueError('Unknown config change %r' % (change,))
+      if op == 'unset':
+        new_entries = [e for e in entries if e not in matches]
+      elif matches == [(key, change[2])]:
+        continue
+      else:
+        new_entries = [e for e in entries if e not in matches]
+        new_entries.append((key, change[2]))
+      if new_entries != entries:
+        entries = new_entries
+        needed.append(change)
+    # The order of the values of multi-valued keys doesn't matter.
+    sort_key = lambda e: (e[0], e[1] or '')
+    if sorted(entries, key=sort_key) == sorted(initial_entries, key=sort_key):
+      return False
+
+    tmp_path = path + '.gclient-tmp'
+    shutil.copy2(path, tmp_path)
+    try:
+      for change in needed:
+        if change[0] == 'unset':
+          args = ['--unset-all', change[1]]
+        else:
+          args = ['--replace-all'] + list(change[1:])
+        try:
+          GIT.Capture(['config', '--file', tmp_path] + args)
+        except subprocess2.CalledProcessError as e:
+          # Exit code 5 means that there was nothing to unset.
+          if change[0] != 'unset' or e.returncode != 5:
+            raise
+      if hasattr(os, 'replace'):
+        os.replace(tmp_path, path)
+      else:
+        gclient_utils.safe_rename(tmp_path, path)
+    finally:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return True
+
   @staticmethod
   def IsWorkTreeDirty(cwd):
     return GIT.Capture(['status', '-s'], cwd=cwd) != ''
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# Copyright 2021 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the hook fingerprints in gclient.py."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ['DEPOT_TOOLS_COLLECT_METRICS'] = '0'
+
+import gclient
+import gclient_utils
+
+
+class HookFingerprintTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.tmpdir, 'src', 'build'))
+    self.write('src/build/a.py', 'a')
+    self.write('src/build/b.py', 'b')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def write(self, path, content):
+    gclient_utils.FileWrite(os.path.join(self.tmpdir, path), content)
+
+  def hook(self, action=('python3', 'build/a.py'), condition=None,
+           variables=None, inputs=None):
+    if inputs is None:
+      inputs = {'files': ['build/*.py'], 'deps': ['src/third_party/x']}
+    return gclient.Hook(
+        list(action), None, 'a', None, condition, variables=variables,
+        cwd_base=os.path.join(self.tmpdir, 'src'), inputs=inputs)
+
+  def testNoInputs(self):
+    hook = gclient.Hook(['true'], None, 'a', None, None,
+                        cwd_base=self.tmpdir)
+    self.assertIsNone(hook.fingerprint({}))
+
+  def testStable(self):
+    revisions = {'src/third_party/x': 'abc'}
+    self.assertEqual(self.hook().fingerprint(revisions),
+                     self.hook().fingerprint(revisions))
+
+  def testInputFileChanged(self):
+    before = self.hook().fingerprint({})
+    self.write('src/build/b.py', 'B')
+    self.assertNotEqual(before, self.hook().fingerprint({}))
+
+  def testInputFileAdded(self):
+    before = self.hook().fingerprint({})
+    self.write('src/build/c.py', 'c')
+    self.assertNotEqual(before, self.hook().fingerprint({}))
+
+  def testOtherFileChanged(self):
+    before = self.hook().fingerprint({})
+    self.write('src/build/a.txt', 'a')
+    self.assertEqual(before, self.hook().fingerprint({}))
+
+  def testDirectoryInput(self):
+    hook = self.hook(inputs={'files': ['build']})
+    before = hook.fingerprint({})
+    self.write('src/build/a.txt', 'a')
+    self.assertNotEqual(before, hook.fingerprint({}))
+
+  def testMissingInput(self):
+    hook = self.hook(inputs={'files': ['out/args.gn']})
+    before = hook.fingerprint({})
+    os.makedirs(os.path.join(self.tmpdir, 'src', 'out'))
+    self.write('src/out/args.gn', '')
+    self.assertNotEqual(before, hook.fingerprint({}))
+
+  def testDepRevisionChanged(self):
+    self.assertNotEqual(
+        self.hook().fingerprint({'src/third_party/x': 'abc'}),
+        self.hook().fingerprint({'src/third_party/x': 'def'}))
+
+  def testActionChanged(self):
+    self.assertNotEqual(
+        self.hook().fingerprint({}),
+        self.hook(action=('python3', 'build/a.py', '--x')).fingerprint({}))
+
+  def testConditionOutcomeChanged(self):
+    def fingerprint(value):
+      return self.hook(condition='checkout_x',
+                       variables={'checkout_x': value}).fingerprint({})
+    self.assertNotEqual(fingerprint(True), fingerprint(False))
+
+
+class HookFingerprintsTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, '.gclient_hook_fingerprints')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testPersisted(self):
+    fingerprints = gclient.HookFingerprints(self.path)
+    self.assertIsNone(fingerprints.get('src:a'))
+    fingerprints.set('src:a', '1')
+    fingerprints.set('src:b', '2')
+    fingerprints.save()
+    fingerprints = gclient.HookFingerprints(self.path)
+    self.assertEqual('1', fingerprints.get('src:a'))
+    fingerprints.set('src:a', None)
+    fingerprints.save()
+    fingerprints = gclient.HookFingerprints(self.path)
+    self.assertIsNone(fingerprints.get('src:a'))
+    self.assertEqual('2', fingerprints.get('src:b'))
+
+  def testOnlySavedWhenChanged(self):
+    fingerprints = gclient.HookFingerprints(self.path)
+    fingerprints.save()
+    self.assertFalse(os.path.exists(self.path))
+    fingerprints.set('src:a', '1')
+    fingerprints.save()
+    os.remove(self.path)
+    fingerprints.set('src:a', '1')
+    fingerprints.save()
+    self.assertFalse(os.path.exists(self.path))
+
+  def testCorrupted(self):
+    gclient_utils.FileWrite(self.path, '{')
+    self.assertIsNone(gclient.HookFingerprints(self.path).get('src:a'))
+
+
+if __name__ == '__main__':
+  unittest.main()
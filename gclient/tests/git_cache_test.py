@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Copyright 2021 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for git_cache.py."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ['DEPOT_TOOLS_COLLECT_METRICS'] = '0'
+
+import git_cache
+
+
+class MirrorTestBase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.config_path = os.path.join(self.tmpdir, 'gitconfig')
+    with open(self.config_path, 'w'):
+      pass
+    self.cache_dir = os.path.join(self.tmpdir, 'cache')
+    os.mkdir(self.cache_dir)
+    self.old_config_location = git_cache.Mirror._GIT_CONFIG_LOCATION
+    git_cache.Mirror._GIT_CONFIG_LOCATION = ['--file', self.config_path]
+    git_cache.Mirror._url_configs = {}
+    git_cache.Mirror.SetCachePath(self.cache_dir)
+
+  def tearDown(self):
+    git_cache.Mirror._GIT_CONFIG_LOCATION = self.old_config_location
+    git_cache.Mirror._url_configs = {}
+    shutil.rmtree(self.tmpdir)
+
+  def set_config(self, key, value):
+    subprocess.check_call(
+        ['git', 'config', '--file', self.config_path, key, value])
+
+  def mirror(self, url, **kwargs):
+    return git_cache.Mirror(url, print_func=lambda *args: None, **kwargs)
+
+
+class ObjectsFromTest(MirrorTestBase):
+  def borrow(self, *pairs):
+    for fork, project in pairs:
+      self.set_config('cache.https://h/%s.objectsFrom' % fork,
+                      'https://h/%s' % project)
+
+  def testNotSet(self):
+    self.assertIsNone(self.mirror('https://h/a').objects_from)
+
+  def testChain(self):
+    self.borrow(('a', 'b'), ('b', 'c'))
+    self.assertEqual('https://h/b', self.mirror('https://h/a').objects_from.url)
+    self.assertEqual('https://h/c', self.mirror('https://h/b').objects_from.url)
+    self.assertIsNone(self.mirror('https://h/c').objects_from)
+
+  def testSelf(self):
+    self.borrow(('a', 'a'))
+    self.assertIsNone(self.mirror('https://h/a').objects_from)
+
+  def testTwoCycle(self):
+    self.borrow(('a', 'b'), ('b', 'a'))
+    self.assertIsNone(self.mirror('https://h/a').objects_from)
+    self.assertIsNone(self.mirror('https://h/b').objects_from)
+
+  def testThreeCycle(self):
+    self.borrow(('a', 'b'), ('b', 'c'), ('c', 'a'))
+    for name in 'abc':
+      self.assertIsNone(self.mirror('https://h/%s' % name).objects_from)
+
+  def testCycleFurtherDown(self):
+    self.borrow(('a', 'b'), ('b', 'c'), ('c', 'b'))
+    self.assertIsNone(self.mirror('https://h/a').objects_from)
+
+
+class FetchStateTest(MirrorTestBase):
+  def setUp(self):
+    super(FetchStateTest, self).setUp()
+    self.mirror_ = self.mirror('https://h/a', refs=['refs/branch-heads/*'])
+    os.makedirs(self.mirror_.mirror_path)
+
+  def write_state(self, age, refs):
+    self.mirror_._write_fetch_state({
+        'generation': 1,
+        'last_fetch': time.time() - age,
+        'fetch_specs': [
+            self.mirror_.parse_fetch_spec(ref)[0] for ref in refs],
+    })
+
+  def testNoState(self):
+    self.assertFalse(self.mirror_.has_fetched_refs())
+    self.assertFalse(self.mirror_.is_fresh(60))
+
+  def testFresh(self):
+    self.write_state(10, ['refs/heads/*', 'refs/branch-heads/*'])
+    self.assertTrue(self.mirror_.has_fetched_refs())
+    self.assertTrue(self.mirror_.is_fresh(60))
+    self.assertFalse(self.mirror_.is_fresh(5))
+
+  def testMissingRefs(self):
+    self.write_state(10, ['refs/heads/*'])
+    self.assertFalse(self.mirror_.has_fetched_refs())
+    self.assertFalse(self.mirror_.is_fresh(60))
+
+  def testFromTheFuture(self):
+    self.write_state(-3600, ['refs/heads/*', 'refs/branch-heads/*'])
+    self.assertFalse(self.mirror_.is_fresh(60))
+
+
+class BootstrapSourceTest(MirrorTestBase):
+  def setUp(self):
+    super(BootstrapSourceTest, self).setUp()
+    self.old_gsutil_exe = git_cache.Mirror.gsutil_exe
+    git_cache.Mirror.gsutil_exe = os.path.join(self.tmpdir, 'gsutil.py')
+
+  def tearDown(self):
+    git_cache.Mirror.gsutil_exe = self.old_gsutil_exe
+    super(BootstrapSourceTest, self).tearDown()
+
+  def testWithoutGsutil(self):
+    mirror = self.mirror('https://chromium.googlesource.com/chromium/src')
+    self.assertTrue(mirror.supported_project())
+    self.assertIsNone(mirror.bootstrap_source)
+    self.assertEqual(
+        'gs://chromium-git-cache/v2/chromium.googlesource.com-chromium-src',
+        mirror._gs_path)
+
+  def testGsutilCreatedWhenUsed(self):
+    self.set_config('cache.https://h/.bootstrapSource', 'gs://bucket/dir')
+    with open(git_cache.Mirror.gsutil_exe, 'w'):
+      pass
+    source = self.mirror('https://h/a').bootstrap_source
+    self.assertIsInstance(source, git_cache.GcsBootstrapSource)
+    self.assertEqual('gs://bucket/dir/h-a', source.url('h-a'))
+    self.assertIsNone(source._gsutil)
+
+  def testLocalSource(self):
+    self.set_config('cache.https://h/.bootstrapSource', self.tmpdir)
+    mirror = self.mirror('https://h/a')
+    self.assertTrue(mirror.supported_project())
+    self.assertIsInstance(
+        mirror.bootstrap_source, git_cache.LocalBootstrapSource)
+
+  def testNotSupported(self):
+    mirror = self.mirror('https://h/a')
+    self.assertFalse(mirror.supported_project())
+    self.assertIsNone(mirror.bootstrap_source)
+
+
+class PopulateTest(MirrorTestBase):
+  def setUp(self):
+    super(PopulateTest, self).setUp()
+    self.origin = os.path.join(self.tmpdir, 'origin')
+    self.git('init', '-q', self.origin)
+    self.git('config', 'uploadpack.allowFilter', 'true', cwd=self.origin)
+    self.commit('a')
+    self.url = 'file://' + self.origin
+
+  def git(self, *args, **kwargs):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=a', '-c', 'user.email=a@a'] + list(args),
+        **kwargs).decode('utf-8').strip()
+
+  def commit(self, name):
+    with open(os.path.join(self.origin, name), 'w') as f:
+      f.write(name)
+    self.git('add', name, cwd=self.origin)
+    self.git('commit', '-q', '-m', name, cwd=self.origin)
+
+  def has_blob(self, mirror, name):
+    blob = self.git('rev-parse', 'HEAD:' + name, cwd=self.origin)
+    # Unlike cat-file, doesn't fetch missing blobs from promisor remotes.
+    missing = self.git('rev-list', '--objects', '--missing=print', '--all',
+                       cwd=mirror.mirror_path).splitlines()
+    return '?' + blob not in missing
+
+  def testPartialMirrorStaysPartial(self):
+    self.mirror(self.url).populate(partial_clone=True)
+    self.commit('b')
+    mirror = self.mirror(self.url)
+    mirror.populate()
+    self.assertTrue(mirror.is_partial())
+    self.assertFalse(self.has_blob(mirror, 'b'))
+
+  def testNeedBlobs(self):
+    self.mirror(self.url).populate(partial_clone=True)
+    mirror = self.mirror(self.url)
+    mirror.populate(need_blobs=True)
+    self.assertFalse(mirror.is_partial())
+    self.assertTrue(self.has_blob(mirror, 'a'))
+
+  def testFullMirrorStaysFull(self):
+    self.mirror(self.url).populate()
+    self.commit('b')
+    mirror = self.mirror(self.url)
+    mirror.populate(partial_clone=True)
+    self.assertFalse(mirror.is_partial())
+    self.assertTrue(self.has_blob(mirror, 'b'))
+
+
+if __name__ == '__main__':
+  unittest.main()
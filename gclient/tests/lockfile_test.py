@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Copyright 2021 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for lockfile.py."""
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ['DEPOT_TOOLS_COLLECT_METRICS'] = '0'
+
+import lockfile
+
+
+class LockTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'repo')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testExclusiveExcludesAll(self):
+    with lockfile.lock(self.path):
+      with self.assertRaises(lockfile.LockError):
+        with lockfile.lock(self.path):
+          pass
+      with self.assertRaises(lockfile.LockError):
+        with lockfile.lock(self.path, shared=True):
+          pass
+
+  def testSharedLocksCoexist(self):
+    with lockfile.lock(self.path, shared=True):
+      with lockfile.lock(self.path, shared=True):
+        self.assertEqual(2, len(lockfile.get_holders(self.path)))
+
+  def testSharedExcludesExclusive(self):
+    with lockfile.lock(self.path, shared=True):
+      with self.assertRaises(lockfile.LockError):
+        with lockfile.lock(self.path):
+          pass
+
+  def testReleased(self):
+    with lockfile.lock(self.path):
+      pass
+    with lockfile.lock(self.path):
+      pass
+
+  def testWaitsForRelease(self):
+    release = lockfile._lock(self.path)
+    timer = threading.Timer(0.2, release)
+    timer.start()
+    try:
+      start = time.time()
+      with lockfile.lock(self.path, timeout=10):
+        self.assertGreater(time.time() - start, 0.1)
+    finally:
+      timer.join()
+
+  def testTimeout(self):
+    with lockfile.lock(self.path):
+      with self.assertRaises(lockfile.LockError):
+        with lockfile.lock(self.path, timeout=0.2):
+          pass
+    # The lock abandoned by the timed out waiter is released.
+    with lockfile.lock(self.path, timeout=10):
+      pass
+
+  def testHolders(self):
+    self.assertEqual([], lockfile.get_holders(self.path))
+    with lockfile.lock(self.path, shared=True):
+      holders = lockfile.get_holders(self.path)
+      self.assertEqual(1, len(holders))
+      self.assertEqual(os.getpid(), holders[0]['pid'])
+      self.assertTrue(holders[0]['shared'])
+      with self.assertRaises(lockfile.LockError) as cm:
+        with lockfile.lock(self.path):
+          pass
+      self.assertIn('pid %d (shared lock' % os.getpid(), str(cm.exception))
+    self.assertEqual([], lockfile.get_holders(self.path))
+
+  def testDeadHoldersAreRemoved(self):
+    holders_dir = lockfile._holders_dir(self.path)
+    os.makedirs(holders_dir)
+    for name, host in (('dead.json', socket.gethostname()),
+                       ('remote.json', 'some-other-host')):
+      with open(os.path.join(holders_dir, name), 'w') as f:
+        # Pids are far below 2**22 on Linux and macOS.
+        json.dump({'pid': 2**30, 'host': host, 'shared': False}, f)
+    holders = lockfile.get_holders(self.path)
+    self.assertEqual(['some-other-host'], [h['host'] for h in holders])
+    self.assertEqual(['remote.json'], os.listdir(holders_dir))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# Copyright 2021 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for the git config file reader and updater in scm.py."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ['DEPOT_TOOLS_COLLECT_METRICS'] = '0'
+
+import gclient_utils
+import scm
+
+
+CONFIG = '''\
+# A comment.
+[core]
+\trepositoryformatversion = 0 ; a comment
+\tbare
+[Remote "origin"]
+\turl = https://example.com/repo
+\tfetch = +refs/heads/*:refs/heads/*
+\tfetch = +refs/branch-heads/*:refs/branch-heads/*
+[cache "https://Example.com/Fork"]
+\tobjectsFrom = "https://example.com/a;b # c"
+[alias]
+\tlong = log \\
+--oneline
+\tquoted = "a\\tb\\"c\\\\"
+'''
+
+
+class GitConfigFileTestBase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'config')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def write(self, content):
+    with open(self.path, 'w') as f:
+      f.write(content)
+
+  def git_list(self):
+    output = subprocess.check_output(
+        ['git', 'config', '--file', self.path, '--null', '--list'])
+    entries = []
+    for item in output.decode('utf-8').split('\0'):
+      if item:
+        key, newline, value = item.partition('\n')
+        entries.append((key, value if newline else None))
+    return entries
+
+
+class ReadConfigFileTest(GitConfigFileTestBase):
+  def testParse(self):
+    self.write(CONFIG)
+    self.assertEqual([
+        ('core.repositoryformatversion', '0'),
+        ('core.bare', None),
+        ('remote.origin.url', 'https://example.com/repo'),
+        ('remote.origin.fetch', '+refs/heads/*:refs/heads/*'),
+        ('remote.origin.fetch', '+refs/branch-heads/*:refs/branch-heads/*'),
+        ('cache.https://Example.com/Fork.objectsfrom',
+         'https://example.com/a;b # c'),
+        ('alias.long', 'log --oneline'),
+        ('alias.quoted', 'a\tb"c\\'),
+    ], scm.GIT.ReadConfigFile(self.path))
+
+  def testMatchesGit(self):
+    self.write(CONFIG)
+    self.assertEqual(self.git_list(), scm.GIT.ReadConfigFile(self.path))
+
+  def testIncludesAreLeftToGit(self):
+    included = os.path.join(self.tmpdir, 'included')
+    with open(included, 'w') as f:
+      f.write('[user]\n\tname = a\n')
+    self.write('[include]\n\tpath = %s\n[core]\n\tbare = true\n' % included)
+    self.assertEqual(self.git_list(), scm.GIT.ReadConfigFile(self.path))
+
+  def testUnsupportedSyntax(self):
+    for content in ('[include]\n\tpath = x\n', 'key = value\n',
+                    '[core\n', '[core]\n\tkey = "\\q"\n'):
+      self.assertRaises(ValueError, scm.GIT._ParseConfigFile, content)
+
+
+class UpdateConfigFileTest(GitConfigFileTestBase):
+  def setUp(self):
+    super(UpdateConfigFileTest, self).setUp()
+    self.write(CONFIG)
+
+  def testNoChange(self):
+    before = gclient_utils.FileRead(self.path)
+    with mock.patch('scm.GIT.Capture') as capture:
+      self.assertFalse(scm.GIT.UpdateConfigFile(self.path, [
+          ('set', 'core.repositoryformatversion', '0'),
+          ('set', 'Remote.origin.URL', 'https://example.com/repo'),
+          ('replace', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*',
+           r'\+refs/heads/\*:.*'),
+          ('unset', 'gc.autodetach'),
+      ]))
+    capture.assert_not_called()
+    self.assertEqual(before, gclient_utils.FileRead(self.path))
+
+  def testSet(self):
+    self.assertTrue(scm.GIT.UpdateConfigFile(self.path, [
+        ('set', 'core.repositoryformatversion', '1'),
+        ('set', 'gc.autodetach', '0'),
+    ]))
+    entries = scm.GIT.ReadConfigFile(self.path)
+    self.assertIn(('core.repositoryformatversion', '1'), entries)
+    self.assertNotIn(('core.repositoryformatversion', '0'), entries)
+    self.assertIn(('gc.autodetach', '0'), entries)
+    self.assertEqual(self.git_list(), entries)
+
+  def testSetReplacesAllValues(self):
+    scm.GIT.UpdateConfigFile(
+        self.path, [('set', 'remote.origin.fetch', '+refs/tags/*')])
+    self.assertEqual(
+        [('remote.origin.fetch', '+refs/tags/*')],
+        [e for e in scm.GIT.ReadConfigFile(self.path)
+         if e[0] == 'remote.origin.fetch'])
+
+  def testReplaceKeepsOtherValues(self):
+    self.assertTrue(scm.GIT.UpdateConfigFile(self.path, [
+        ('replace', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/x/*',
+         r'\+refs/heads/\*:.*'),
+    ]))
+    self.assertEqual(
+        ['+refs/branch-heads/*:refs/branch-heads/*',
+         '+refs/heads/*:refs/remotes/x/*'],
+        sorted(v for k, v in scm.GIT.ReadConfigFile(self.path)
+               if k == 'remote.origin.fetch'))
+
+  def testUnset(self):
+    self.assertTrue(scm.GIT.UpdateConfigFile(self.path, [
+        ('unset', 'remote.origin.fetch'),
+        ('unset', 'gc.autodetach'),
+    ]))
+    self.assertEqual(
+        [], [e for e in scm.GIT.ReadConfigFile(self.path)
+             if e[0] == 'remote.origin.fetch'])
+
+  def testSubsectionIsCaseSensitive(self):
+    self.assertTrue(scm.GIT.UpdateConfigFile(self.path, [
+        ('set', 'cache.https://example.com/fork.objectsFrom', 'x'),
+    ]))
+    entries = scm.GIT.ReadConfigFile(self.path)
+    self.assertIn(('cache.https://Example.com/Fork.objectsfrom',
+                   'https://example.com/a;b # c'), entries)
+    self.assertIn(('cache.https://example.com/fork.objectsfrom', 'x'), entries)
+
+  def testUnknownChange(self):
+    self.assertRaises(ValueError, scm.GIT.UpdateConfigFile, self.path,
+                      [('add', 'core.bare', 'true')])
+
+  def testNoTemporaryFileLeft(self):
+    scm.GIT.UpdateConfigFile(self.path, [('set', 'core.bare', 'false')])
+    self.assertEqual(['config'], os.listdir(self.tmpdir))
+
+
+if __name__ == '__main__':
+  unittest.main()